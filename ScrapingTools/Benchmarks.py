@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""
+TTB offline benchmarks
+
+Runs the crawl, the sequential probe, form scraping, image downloading/decoding and the image metrics against a
+local stand-in of the COLA registry (see Stand_In_Server), and reports records/sec and per stage latency
+percentiles. Fixtures are either generated or recorded from the live site:
+
+    python Benchmarks.py generate fixtures --days 14 --per-day 40
+    python Benchmarks.py record fixtures 09/01/2017 09/03/2017 --limit 200
+    python Benchmarks.py run fixtures --latency 0.02 --error-rate 0.01 --json results.json
+    python Benchmarks.py serve fixtures --port 8080
+"""
+
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qs
+
+from Session_Manager import (AdaptiveRateLimiter, SessionManager, get_base_url, set_base_url, get_session_manager,
+                             set_session_manager)
+from Stand_In_Server import StandInServer, SEARCH_COLUMNS
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+BENCHMARKS = ('crawl', 'sequential', 'forms', 'parse', 'images', 'metrics')
+
+# the form fields of a publicDisplaySearchBasic page, in page order
+FORM_FIELDS = ('TTB ID', 'Status', 'Vendor Code', 'Serial #', 'Type of Application', 'For Sale In',
+               'Total Bottle Capacity', 'Formula', 'Qualifications',
+               'Plant Registry/Basic Permit/Brewers No (Principal Place of Business)',
+               'Plant Registry/Basic Permit/Brewers No (Other)', 'Origin Code', 'Class/Type Code', 'Brand Name',
+               'Fanciful Name', 'Approval Date', 'Contact Information')
+
+CLASS_TYPES = (('901', 'BEER'), ('906', 'MALT BEVERAGES SPECIALITIES - FLAVORED'), ('80', 'TABLE RED WINE'),
+               ('84', 'TABLE WHITE WINE'), ('101', 'STRAIGHT BOURBON WHISKY'), ('641', 'VODKA'))
+
+LABEL_TYPES = ('Brand (front)', 'Back', 'Neck', 'Other')
+
+# share of applications by receive code (001 e-filed, 002 & 003 mailed/overnight, 000 hand delivered)
+RECEIVE_CODES = ((1, 0.85), (2, 0.08), (3, 0.05), (0, 0.02))
+
+
+class LatencyRecorder(object):
+
+    def __init__(self):
+        """Thread safe collection of timings, grouped by stage"""
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """Time the body of a with statement"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, perf_counter() - start)
+
+    @staticmethod
+    def percentile(values, q):
+        """Nearest rank percentile of sorted values"""
+        rank = max(0, min(len(values) - 1, int(round(q / 100.0 * len(values) + 0.5)) - 1))
+        return values[rank]
+
+    def summary(self):
+        """stage -> count, mean and p50/p90/p99 latency in milliseconds"""
+        with self._lock:
+            timings = {stage: sorted(values) for stage, values in self.timings.items()}
+        return {stage: {'count': len(values),
+                        'mean_ms': 1000 * sum(values) / len(values),
+                        'p50_ms': 1000 * self.percentile(values, 50),
+                        'p90_ms': 1000 * self.percentile(values, 90),
+                        'p99_ms': 1000 * self.percentile(values, 99)}
+                for stage, values in sorted(timings.items())}
+
+
+class RecordingSessionManager(SessionManager):
+
+    def __init__(self, recorder, **kwargs):
+        """
+        SessionManager timing every response it receives, by endpoint (ex 'http viewColaDetails.do')
+
+        :param recorder: LatencyRecorder the timings go to
+        :param kwargs: see SessionManager
+        """
+        super(RecordingSessionManager, self).__init__(**kwargs)
+        self.recorder = recorder
+
+    def session(self):
+        session = super(RecordingSessionManager, self).session()
+        session.hooks['response'].append(self._record)
+        return session
+
+    def _record(self, response, *args, **kwargs):
+        endpoint = urlsplit(response.url).path.rsplit('/', 1)[-1]
+        self.recorder.add('http {}'.format(endpoint), response.elapsed.total_seconds())
+
+
+class CountingWriter(object):
+
+    def __init__(self):
+        """Stands in for a BulkWriter, counting records instead of writing them"""
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def add(self, collection, doc):
+        with self._lock:
+            self.counts[collection] = self.counts.get(collection, 0) + 1
+
+    def on_flush(self, callback):
+        callback()
+
+    def flush(self, collection=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def result(name, records, seconds, recorder, **extra):
+    """Summary of one benchmark"""
+    res = {'benchmark': name,
+           'records': records,
+           'seconds': seconds,
+           'records_per_sec': records / seconds if seconds else 0.0,
+           'stages': recorder.summary()}
+    res.update(extra)
+    return res
+
+
+def load_index(directory):
+    with open(os.path.join(directory, 'index.json')) as f:
+        return json.load(f)
+
+
+def receive_date(ttbid):
+    return datetime.datetime.strptime(ttbid[:5], '%y%j')
+
+
+def form_page(ttbid, values):
+    """
+    Build a publicDisplaySearchBasic page
+
+    :param ttbid: TTBID of the COLA
+    :param values: field name -> list of lines (the first line is shown next to the field name)
+    :return: html as bytes
+    """
+    rows = []
+    for field in FORM_FIELDS:
+        lines = values.get(field) or ['']
+        first = '\n                {}\n'.format(lines[0]) if lines[0] else ''
+        printable = '<a href="javascript:void(0)">Printable Version</a>' if field == 'TTB ID' else ''
+        rows.append('<tr><td><strong>{field}:</strong>{first}{printable}</td></tr>'.format(
+            field=field, first=first, printable=printable))
+        rows.extend('<tr><td>\n                {}\n</td></tr>'.format(line) for line in lines[1:])
+
+    return ('<html><head><title>COLAs Online</title></head><body><div id="main">\n'
+            '<form name="colaApplicationForm" method="post"><div class="box"><table>\n{rows}\n</table></div>\n'
+            '</form></div></body></html>').format(rows='\n'.join(rows)).encode('utf-8')
+
+
+def images_page(labels):
+    """
+    Build a publicFormDisplay page
+
+    :param labels: list of (label type, file name) tuples
+    :return: html as bytes
+    """
+    imgs = ''.join('<img alt="Label Image: {label_type}" height="400" src="/colasonline/publicViewAttachment.do?'
+                   'filename={name}&amp;filetype=l">'.format(label_type=label_type, name=name)
+                   for label_type, name in labels)
+    return ('<html><body><form name="colaApplicationForm"><table><tr><td>'
+            '<img alt="Authorized Signature" src="/colasonline/images/signature.gif">{imgs}'
+            '</td></tr></table></form></body></html>').format(imgs=imgs).encode('utf-8')
+
+
+def label_image(rng, size=(600, 400)):
+    """A synthetic label: a flat background with a few colored blocks, a gradient band and some noise"""
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    img = np.empty((height, width, 3), dtype=np.float64)
+    img[:] = [rng.randint(0, 255) for _ in range(3)]
+    for _ in range(rng.randint(2, 5)):
+        x0, y0 = rng.randint(0, width - 40), rng.randint(0, height - 40)
+        img[y0:y0 + rng.randint(20, height // 2), x0:x0 + rng.randint(20, width // 2)] = \
+            [rng.randint(0, 255) for _ in range(3)]
+    y0 = rng.randint(0, height - 60)
+    img[y0:y0 + 60] *= np.linspace(0.4, 1.0, width)[:, None]
+
+    noise = np.random.RandomState(rng.randint(0, 2 ** 31)).normal(0, 6, img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def generate_fixtures(directory, start_date='01/04/2016', days=14, per_day=40, labels=20, gap_rate=0.05,
+                      no_image_rate=0.05, seed=0):
+    """
+    Write a synthetic fixture directory for the stand-in server
+
+    TTBIDs follow the real numbering (a sequence per receive date and receive code, with the odd withdrawn number
+    left as a gap), so the sequential probe and the search see the same COLAs. Label images are drawn from a small
+    shared pool, like the many COLAs that reuse a label.
+
+    :param directory: folder to write to
+    :param start_date: first receive date, mm/dd/yyyy
+    :param days: number of receive dates
+    :param per_day: COLAs received per day
+    :param labels: size of the label image pool
+    :param gap_rate: chance a sequence number is skipped
+    :param no_image_rate: chance a COLA has no label images
+    :param seed: random seed
+    :return: number of COLAs written
+    """
+    from Sequential_Crawl import make_ttbid
+    from TTB_crawler import US_ORIGIN_CODES
+
+    rng = random.Random(seed)
+    for name in ('forms', 'images', 'labels'):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    pool = []
+    for i in range(labels):
+        name = 'label_{:04d}.jpg'.format(i)
+        with open(os.path.join(directory, 'labels', name), 'wb') as f:
+            f.write(label_image(rng))
+        pool.append(name)
+
+    codes, weights = zip(*RECEIVE_CODES)
+    rows = []
+    start = datetime.datetime.strptime(start_date, '%m/%d/%Y')
+    for day in range(days):
+        received = start + datetime.timedelta(days=day)
+        seqnums = {code: 0 for code in codes}
+
+        for _ in range(per_day):
+            reccode = rng.choices(codes, weights)[0]
+            seqnums[reccode] += 2 if rng.random() < gap_rate else 1
+            ttbid = make_ttbid(received, reccode, seqnums[reccode])
+
+            completed = (received + datetime.timedelta(days=rng.randint(1, 10))).strftime('%m/%d/%Y')
+            origin = rng.choice(US_ORIGIN_CODES)
+            class_code, class_desc = rng.choice(CLASS_TYPES)
+            permit = 'BR-{}-{:05d}'.format(origin, rng.randint(1, 30000))
+            serial = '{}{:04d}'.format(received.strftime('%y'), rng.randint(1, 9999))
+            brand = 'BRAND {:04d}'.format(rng.randint(1, 2000))
+            fanciful = 'FANCIFUL {:04d}'.format(rng.randint(1, 5000)) if rng.random() < 0.6 else ''
+
+            rows.append(dict(zip(SEARCH_COLUMNS, (ttbid, permit, serial, completed, fanciful, brand, origin,
+                                                  'ORIGIN {}'.format(origin), class_code, class_desc))))
+
+            values = {'TTB ID': [ttbid],
+                      'Status': ['APPROVED'],
+                      'Vendor Code': ['{:05d}'.format(rng.randint(1, 99999))],
+                      'Serial #': [serial],
+                      'Type of Application': ['LABEL APPROVAL'],
+                      'Qualifications': ['TTB has not reviewed this label for type size, characters per inch or '
+                                         'contrasting background.'] * rng.randint(0, 2),
+                      'Plant Registry/Basic Permit/Brewers No (Principal Place of Business)':
+                          ['', permit, 'COMPANY {:04d} INC.'.format(rng.randint(1, 9999)),
+                           '{} MAIN ST'.format(rng.randint(1, 9999)), 'SOMEWHERE, ST {:05d}'.format(rng.randint(1, 99999))],
+                      'Origin Code': ['ORIGIN {}'.format(origin)],
+                      'Class/Type Code': [class_desc],
+                      'Brand Name': [brand],
+                      'Fanciful Name': [fanciful],
+                      'Approval Date': [completed],
+                      'Contact Information': ['', 'FIRST LAST', 'Phone Number:(555) 555-{:04d}'.format(
+                          rng.randint(0, 9999))]}
+            with open(os.path.join(directory, 'forms', ttbid + '.html'), 'wb') as f:
+                f.write(form_page(ttbid, values))
+
+            n_labels = 0 if rng.random() < no_image_rate else rng.randint(1, len(LABEL_TYPES))
+            cola_labels = list(zip(LABEL_TYPES, rng.sample(pool, min(n_labels, len(pool)))))
+            with open(os.path.join(directory, 'images', ttbid + '.html'), 'wb') as f:
+                f.write(images_page(cola_labels))
+
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(rows, f, indent=0)
+    return len(rows)
+
+
+def record_fixtures(directory, date_start, date_end, origin_codes=None, limit=None, workers=4):
+    """
+    Record a fixture directory from the live site
+
+    :param directory: folder to write to
+    :param date_start: first approval date to search, mm/dd/yyyy
+    :param date_end: last approval date to search, mm/dd/yyyy
+    :param origin_codes: origin codes to search (default: US states)
+    :param limit: only record the pages and labels of this many COLAs
+    :param workers: COLAs recorded at the same time
+    :return: number of COLAs recorded
+    """
+    from TTB_crawler import TTB_crawler, US_ORIGIN_CODES
+
+    for name in ('forms', 'images', 'labels'):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    rows = TTB_crawler.crawl(date_start, date_end, origin_codes or US_ORIGIN_CODES, workers=workers)
+    rows = rows[:limit] if limit is not None else rows
+    manager = get_session_manager()
+    url = get_base_url() + '/colasonline/viewColaDetails.do'
+
+    def record(ttbid):
+        page = manager.shared.get(url, params={'action': 'publicDisplaySearchBasic', 'ttbid': ttbid})
+        with open(os.path.join(directory, 'forms', ttbid + '.html'), 'wb') as f:
+            f.write(page.content)
+
+        session = manager.session()  # the labels need this page's JSESSIONID
+        page = session.get(url, params={'action': 'publicFormDisplay', 'ttbid': ttbid})
+        with open(os.path.join(directory, 'images', ttbid + '.html'), 'wb') as f:
+            f.write(page.content)
+
+        from TTB_scraping import TTB_Scraper
+        from Html_Parsing import parse_page
+        for _, img_url in TTB_Scraper.extract_img_meta(parse_page(page.text, 'images')):
+            filename = os.path.basename(parse_qs(urlsplit(img_url).query).get('filename', [''])[0])
+            path = os.path.join(directory, 'labels', filename)
+            if filename and not os.path.exists(path):
+                response = session.get(img_url)
+                if response.status_code == 200:
+                    with open(path, 'wb') as f:
+                        f.write(response.content)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(record, [row['TTB ID'] for row in rows]))
+
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump([{column: row.get(column, '') for column in SEARCH_COLUMNS} for row in rows], f, indent=0)
+    return len(rows)
+
+
+def bench_crawl(directory, recorder, workers=4):
+    """TTB_crawler.crawl over every completed date of the fixtures (large ranges are split as on the real site)"""
+    from TTB_crawler import TTB_crawler, US_ORIGIN_CODES
+
+    dates = sorted(datetime.datetime.strptime(row['Completed Date'], '%m/%d/%Y') for row in load_index(directory))
+    start = perf_counter()
+    rows = TTB_crawler.crawl(dates[0].strftime('%m/%d/%Y'), dates[-1].strftime('%m/%d/%Y'), US_ORIGIN_CODES,
+                             workers=workers)
+    return len(rows), perf_counter() - start
+
+
+def bench_sequential(directory, recorder, skip_tol=3):
+    """Sequential_Crawl._sequential over every receive date of the fixtures, writing to a CountingWriter"""
+    from Sequential_Crawl import _sequential
+
+    dates = sorted(receive_date(row['TTB ID']) for row in load_index(directory))
+    writer = CountingWriter()
+    logger = logging.getLogger('Benchmarks.sequential')
+    start = perf_counter()
+    _sequential(dates[0], dates[-1] + datetime.timedelta(days=1), skip_tol, writer, logger)
+    return writer.counts.get('TTB', 0), perf_counter() - start
+
+
+def bench_forms(directory, recorder, workers=4, limit=None):
+    """TTB_Scraper.get_basic_form_data (download and parse) of the indexed COLAs"""
+    from TTB_scraping import TTB_Scraper
+
+    ttbids = [row['TTB ID'] for row in load_index(directory)][:limit]
+
+    def scrape(ttbid):
+        with recorder.time('get_basic_form_data'):
+            return TTB_Scraper(ttbid).get_basic_form_data()
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        forms = [form for form in executor.map(scrape, ttbids) if form]
+    return len(forms), perf_counter() - start
+
+
+def bench_parse(directory, recorder, backend=None):
+    """Parsing of the saved form pages alone (parse_page, extract_basic_form, assign_basic_results), no network"""
+    from Html_Parsing import parse_page
+    from TTB_scraping import TTB_Scraper
+
+    form_dir = os.path.join(directory, 'forms')
+    pages = []
+    for name in sorted(os.listdir(form_dir)):
+        with open(os.path.join(form_dir, name), encoding='utf-8', errors='replace') as f:
+            pages.append(f.read())
+
+    records = 0
+    start = perf_counter()
+    for page in pages:
+        with recorder.time('parse_page'):
+            soup = parse_page(page, 'form', backend)
+        with recorder.time('extract_basic_form'):
+            res = TTB_Scraper.extract_basic_form(soup)
+        if res:
+            with recorder.time('assign_basic_results'):
+                TTB_Scraper.assign_basic_results(*res)
+            records += 1
+    return records, perf_counter() - start
+
+
+def bench_images(directory, recorder, workers=4, limit=100):
+    """TTB_Scraper.get_images (label page, downloads and thumbnail decoding) of the first COLAs of the index"""
+    from TTB_scraping import TTB_Scraper
+
+    ttbids = [row['TTB ID'] for row in load_index(directory)][:limit]
+
+    def scrape(ttbid):
+        with recorder.time('get_images'):
+            return TTB_Scraper(ttbid).get_images()[1]
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        n_images = sum(len(imgs) for imgs in executor.map(scrape, ttbids))
+    return n_images, perf_counter() - start
+
+
+def bench_metrics(directory, recorder, engines=('kmeans', 'histogram')):
+    """Thumbnail decoding and CalcImgMetrics.calc_all_metrics of every label image, once per dominant color engine"""
+    from TTB_scraping import TTB_Scraper
+    from Image_Processing import CalcImgMetrics
+
+    label_dir = os.path.join(directory, 'labels')
+    blobs = []
+    for name in sorted(os.listdir(label_dir)):
+        with open(os.path.join(label_dir, name), 'rb') as f:
+            blobs.append(f.read())
+
+    records = 0
+    start = perf_counter()
+    for engine in engines:
+        for data in blobs:
+            with recorder.time('decode_image'):
+                img = TTB_Scraper.decode_image(data)
+            with recorder.time('calc_all_metrics[{}]'.format(engine)):
+                CalcImgMetrics(img.convert('RGB')).calc_all_metrics(engine)
+            records += 1
+    return records, perf_counter() - start
+
+
+def run_benchmarks(directory, names=BENCHMARKS, latency=0.0, jitter=0.0, error_rate=0.0, rate=1000.0, min_rate=None,
+                   workers=4, seed=0):
+    """
+    Run benchmarks against a stand-in server started on a free local port
+
+    The process wide base url and SessionManager are swapped for the run and restored afterwards.
+
+    :param directory: fixture directory
+    :param names: benchmarks to run, from BENCHMARKS
+    :param latency: seconds the server adds to every response
+    :param jitter: up to this many seconds are added at random on top of latency
+    :param error_rate: fraction of requests the server answers with a 503
+    :param rate: requests per second allowed by the rate limiter (it is also the ceiling it ramps up to)
+    :param min_rate: floor the limiter may back off to on injected errors, None keeps the rate fixed
+    :param workers: threads used by the benchmarks that run requests concurrently
+    :param seed: seed for the server's jitter and errors
+    :return: list of result dicts (benchmark, records, seconds, records_per_sec, stages, requests, errors)
+    """
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark: {}'.format(name))
+
+    results = []
+    old_base_url, old_manager = get_base_url(), get_session_manager()
+    with StandInServer(directory, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed) as server:
+        set_base_url(server.url)
+        try:
+            for name in names:
+                recorder = LatencyRecorder()
+                limiter = AdaptiveRateLimiter(rate=rate, min_rate=min_rate or rate, max_rate=rate,
+                                              burst=max(1, rate / 10))
+                set_session_manager(RecordingSessionManager(recorder, pool_size=max(workers, 8), limiter=limiter))
+                requests_before, errors_before = dict(server.requests), dict(server.errors)
+
+                if name == 'crawl':
+                    records, seconds = bench_crawl(directory, recorder, workers)
+                elif name == 'sequential':
+                    records, seconds = bench_sequential(directory, recorder)
+                elif name == 'forms':
+                    records, seconds = bench_forms(directory, recorder, workers)
+                elif name == 'parse':
+                    records, seconds = bench_parse(directory, recorder)
+                elif name == 'images':
+                    records, seconds = bench_images(directory, recorder, workers)
+                else:
+                    records, seconds = bench_metrics(directory, recorder)
+
+                results.append(result(name, records, seconds, recorder,
+                                      requests=sum(server.requests.values()) - sum(requests_before.values()),
+                                      errors=sum(server.errors.values()) - sum(errors_before.values())))
+                get_session_manager().close()
+        finally:
+            set_base_url(old_base_url)
+            set_session_manager(old_manager)
+    return results
+
+
+def print_report(results):
+    """Print the records/sec of each benchmark followed by its stage latencies"""
+    for res in results:
+        print('{benchmark:<12}{records:>8} records {seconds:>9.2f} s {records_per_sec:>10.1f} records/s  '
+              '({requests} requests, {errors} errors injected)'.format(**res))
+        for stage, stats in res['stages'].items():
+            print('    {stage:<44}{count:>7}  p50 {p50_ms:>8.2f} ms  p90 {p90_ms:>8.2f} ms  p99 {p99_ms:>8.2f} ms'
+                  .format(stage=stage, **stats))
+
+
+def main():
+    """ Main entry point of the app """
+
+    parser = argparse.ArgumentParser(description='Offline TTB scraper benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    generate = subparsers.add_parser('generate', help='write synthetic fixtures')
+    generate.add_argument('directory')
+    generate.add_argument('--start', default='01/04/2016', help='first receive date, mm/dd/yyyy')
+    generate.add_argument('--days', type=int, default=14, help='number of receive dates')
+    generate.add_argument('--per-day', type=int, default=40, help='COLAs received per day')
+    generate.add_argument('--labels', type=int, default=20, help='size of the label image pool')
+    generate.add_argument('--seed', type=int, default=0)
+
+    record = subparsers.add_parser('record', help='record fixtures from the live site')
+    record.add_argument('directory')
+    record.add_argument('start', help='first approval date, mm/dd/yyyy')
+    record.add_argument('stop', help='last approval date, mm/dd/yyyy')
+    record.add_argument('--origin-codes', nargs='+', help='origin codes to search (default: US states)')
+    record.add_argument('--limit', type=int, help='only record this many COLAs')
+
+    serve = subparsers.add_parser('serve', help='serve fixtures until interrupted')
+    serve.add_argument('directory')
+    serve.add_argument('--port', type=int, default=8080)
+
+    run = subparsers.add_parser('run', help='run the benchmarks')
+    run.add_argument('directory')
+    run.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    run.add_argument('--json', metavar='FILE', help='also write the results to FILE')
+    run.add_argument('--rate', type=float, default=1000.0, help='rate limit, requests per second')
+    run.add_argument('--min-rate', type=float, help='let the rate limiter back off down to this rate on errors')
+    run.add_argument('--workers', type=int, default=4)
+    run.add_argument('--seed', type=int, default=0)
+
+    for sub in (serve, run):
+        sub.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+        sub.add_argument('--jitter', type=float, default=0.0, help='random extra seconds, up to this many')
+        sub.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        n = generate_fixtures(args.directory, args.start, args.days, args.per_day, args.labels, seed=args.seed)
+        print('Wrote {n} COLAs to {directory}'.format(n=n, directory=args.directory))
+    elif args.command == 'record':
+        n = record_fixtures(args.directory, args.start, args.stop, args.origin_codes, args.limit)
+        print('Recorded {n} COLAs to {directory}'.format(n=n, directory=args.directory))
+    elif args.command == 'serve':
+        with StandInServer(args.directory, port=args.port, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate) as server:
+            print('Serving {n} COLAs at {url} (TTB_BASE_URL={url})'.format(n=len(server.rows), url=server.url))
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+    else:
+        results = run_benchmarks(args.directory, args.benchmarks, args.latency, args.jitter, args.error_rate,
+                                 args.rate, args.min_rate, args.workers, args.seed)
+        print_report(results)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+TTB buffered MongoDB writer
+"""
+
+
+import logging
+import threading
+from time import monotonic
+
+import pymongo
+from pymongo import DeleteMany, ReplaceOne
+
+from Instrumentation import incr, timer
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# fields that identify a document in each collection, used to upsert so re-runs replace rather than duplicate
+COLLECTION_KEYS = {'TTB': ('_id',),
+                   'COLORS': ('TTBID', 'img_num', 'color_num'),
+                   'IMG_META': ('TTBID', 'img_num'),
+                   'IMG_SUP': ('TTBID', 'img_num'),
+                   'SEARCH': ('TTB ID',)}
+
+# collections whose documents come in groups that are replaced as a whole, the stored group is deleted before the
+# new one is written (an image measured again can have fewer dominant colors than last time)
+REPLACE_GROUPS = {'COLORS': ('TTBID', 'img_num')}
+
+
+class WriteError(Exception):
+    """Raised by flush when documents were rejected by the server since the last flush"""
+    pass
+
+
+class BulkWriter(object):
+
+    def __init__(self, db, batch_size=500, flush_interval=5.0, keys=None, groups=None, logger=None):
+        """
+        Buffers documents per collection and writes them as unordered bulk upserts
+
+        A collection's buffer is flushed once it holds batch_size documents, everything is flushed once
+        flush_interval seconds have passed since the last flush, and on close (or leaving a with block).
+
+        A buffer is only dropped once it has been written, a connection error leaves it in place for the next flush.
+        Documents the server rejects are logged and reported by the next explicit flush (WriteError), and the
+        on_flush callbacks waiting on them are discarded rather than run.
+
+        In the collections of groups, the documents of a group (ex the colors of one image) are expected to be added
+        one after the other. The first write of a group deletes whatever is stored for it, so no document of an
+        earlier run is left behind, and later writes of the group while it is still being added only upsert.
+
+        :param db: pymongo database
+        :param batch_size: documents buffered per collection before it is written
+        :param flush_interval: maximum seconds a document waits in the buffer (checked whenever one is added)
+        :param keys: dict of collection name -> key fields, defaults to COLLECTION_KEYS
+        :param groups: dict of collection name -> fields identifying a group, defaults to REPLACE_GROUPS
+        :param logger: logger for write errors, defaults to this module's logger
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keys = keys if keys is not None else COLLECTION_KEYS
+        self.groups = groups if groups is not None else REPLACE_GROUPS
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self._buffers = {}  # collection name -> {key values: document}
+        self._open_groups = {}  # collection name -> the group documents were last added to
+        self._replaced = {}  # collection name -> the open group, once its stored documents have been deleted
+        self._callbacks = []  # run once everything buffered before them is written
+        self._rejected = 0  # documents rejected since the last explicit flush
+        self._last_flush = monotonic()
+        self._lock = threading.RLock()
+
+    def ensure_indexes(self):
+        """Create the indexes the upserts (and later TTBID lookups) rely on"""
+        for name, fields in self.keys.items():
+            if fields == ('_id',):
+                continue  # always indexed
+            index = [(field, pymongo.ASCENDING) for field in fields]
+            try:
+                self.db[name].create_index(index, unique=True)
+            except pymongo.errors.OperationFailure:
+                # older data may hold duplicates, fall back on a plain index
+                self.logger.warning('Unable to create unique index on {name} {fields}'.format(name=name, fields=fields))
+                self.db[name].create_index(index)
+
+    def add(self, collection, doc):
+        """
+        Queue a document for writing
+
+        :param collection: collection name (a key of keys)
+        :param doc: the document, must contain the collection's key fields
+        """
+        key = tuple(doc[field] for field in self.keys[collection])
+
+        with self._lock:
+            if collection in self.groups:
+                group = tuple(doc[field] for field in self.groups[collection])
+                if group != self._open_groups.get(collection):
+                    self._open_groups[collection] = group
+                    self._replaced.pop(collection, None)  # a group added to again is replaced again
+            buffer = self._buffers.setdefault(collection, {})
+            buffer[key] = doc  # a later copy of the same document replaces the earlier one
+
+            try:
+                if len(buffer) >= self.batch_size:
+                    self._write(collection)
+                elif monotonic() - self._last_flush >= self.flush_interval:
+                    self._write_all()
+            except pymongo.errors.PyMongoError as e:
+                # still buffered, the next flush tries again
+                self.logger.warning('Deferred write failed: {}'.format(e))
+
+    def on_flush(self, callback):
+        """
+        Run callback once every document added so far has been written (ex to checkpoint progress)
+
+        :param callback: function taking no arguments
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def _write(self, name):
+        """Write out one collection's buffer, it is only dropped once the server has seen it"""
+        buffer = self._buffers.get(name)
+        if not buffer:
+            return
+
+        fields = self.keys[name]
+        requests = [ReplaceOne(dict(zip(fields, key)), doc, upsert=True) for key, doc in buffer.items()]
+
+        group_fields = self.groups.get(name)
+        open_group = self._open_groups.get(name)
+        if group_fields is not None:
+            groups = {tuple(doc[field] for field in group_fields) for doc in buffer.values()}
+            groups.discard(self._replaced.get(name))  # deleted by an earlier write, and added to since
+            deletes = [DeleteMany(dict(zip(group_fields, group))) for group in sorted(groups, key=str)]
+            if deletes:
+                with timer('ttb_db_write_seconds', sink='mongo', collection=name):
+                    self.db[name].bulk_write(deletes, ordered=False)
+            if open_group in groups:
+                self._replaced[name] = open_group
+
+        try:
+            with timer('ttb_db_write_seconds', sink='mongo', collection=name):
+                self.db[name].bulk_write(requests, ordered=False)
+            incr('ttb_db_records_total', len(requests), sink='mongo', collection=name)
+            self.logger.info('Wrote {n} documents to {name}'.format(n=len(requests), name=name))
+        except pymongo.errors.BulkWriteError as e:
+            # the rest of the batch was written, the rejected documents would only be rejected again
+            errors = e.details.get('writeErrors', [])
+            incr('ttb_db_records_total', len(requests) - len(errors), sink='mongo', collection=name)
+            incr('ttb_db_write_errors_total', len(errors), sink='mongo', collection=name)
+            for error in errors:
+                self.logger.warning('Failed to write to {name}: {msg}'.format(name=name, msg=error.get('errmsg')))
+            if errors:
+                # everything registered so far waits on a document that will never be written
+                self._rejected += len(errors)
+                self._callbacks = []
+        del self._buffers[name]
+
+    def _write_all(self):
+        """Write out every buffer and run the callbacks waiting on them"""
+        for name in list(self._buffers):
+            self._write(name)
+
+        self._last_flush = monotonic()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def flush(self, collection=None):
+        """
+        Write out buffered documents
+
+        :param collection: only flush this collection, flushes all of them if None
+        :raises WriteError: if the server rejected documents since the last flush
+        :raises pymongo.errors.PyMongoError: if the write failed (the documents stay buffered)
+        """
+        with self._lock:
+            if collection is not None:
+                self._write(collection)
+            else:
+                self._write_all()
+
+            if self._rejected:
+                rejected, self._rejected = self._rejected, 0
+                raise WriteError('{} documents were rejected, see the log'.format(rejected))
+
+    def close(self):
+        """Flush everything that is still buffered"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
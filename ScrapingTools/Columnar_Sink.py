@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+TTB columnar (Parquet) output
+"""
+
+
+import datetime
+import logging
+import os
+import threading
+import uuid
+from time import monotonic, time
+
+from Instrumentation import incr, timer
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# column types of the collections we write, fields not listed here (ex. the many form fields) are stored as strings
+COLUMN_TYPES = {'COLORS': {'percentage': 'float64', 'r': 'float64', 'g': 'float64', 'b': 'float64',
+                           'color_num': 'int64'},
+                'IMG_SUP': {'EntropySum': 'float64'}}
+
+# fields a TTBID is read from to partition the rows by receive date
+TTBID_FIELDS = ('TTBID', '_id', 'TTB ID')
+
+# file in each collection's directory holding every field written to it so far (the Parquet _common_metadata
+# convention, files starting with _ or . are not read as data)
+SCHEMA_FILE = '_common_metadata'
+
+
+def receive_date(doc):
+    """
+    Partition of a record, the date its TTBID was received on
+
+    :param doc: record holding a TTBID in one of TTBID_FIELDS
+    :return: 'YYYY-MM-DD', or 'unknown'
+    """
+    for field in TTBID_FIELDS:
+        ttbid = doc.get(field)
+        if ttbid:
+            try:
+                return datetime.datetime.strptime(str(ttbid)[:5], '%y%j').strftime('%Y-%m-%d')
+            except ValueError:
+                break
+    return 'unknown'
+
+
+def open_dataset(directory, collection):
+    """
+    Open a collection written by ColumnarSink as a pyarrow dataset
+
+    Files written by different flushes can hold different fields, so the dataset gets the collection's stored schema
+    (see SCHEMA_FILE) rather than the schema of whichever file pyarrow would look at first.
+
+    :param directory: root of the dataset
+    :param collection: collection, ex 'TTB'
+    :return: pyarrow.dataset.Dataset, with the date partition as a string column, None if nothing was written
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    path = os.path.join(directory, collection)
+    if not os.path.isdir(path):
+        return None
+
+    partitioning = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+    schema_path = os.path.join(path, SCHEMA_FILE)
+    if os.path.exists(schema_path):
+        schema = pq.read_schema(schema_path)
+    else:
+        # written before the schema was kept, read every file's footer instead
+        found = ds.dataset(path, format='parquet', partitioning=partitioning)
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in found.get_fragments()] or [pa.schema([])])
+    if 'date' not in schema.names:
+        schema = schema.append(pa.field('date', pa.string()))
+    return ds.dataset(path, schema=schema, format='parquet', partitioning=partitioning)
+
+
+def stored_values(directory, collection, field, values):
+    """
+    Which of some values a field of a collection written by ColumnarSink already holds
+
+    Only the one column is read, and row groups are skipped using their statistics where pyarrow can.
+
+    :param directory: root of the dataset
+    :param collection: collection, ex 'TTB'
+    :param field: field to look in, ex '_id'
+    :param values: iterable of str
+    :return: set of the values found
+    """
+    import pyarrow.dataset as ds
+
+    values = list(values)
+    dataset = open_dataset(directory, collection) if values else None
+    if dataset is None or field not in dataset.schema.names:
+        return set()
+    table = dataset.to_table(columns=[field], filter=ds.field(field).isin(values))
+    return set(table.column(field).to_pylist())
+
+
+def read_collection(directory, collection, columns=None):
+    """
+    Read a collection written by ColumnarSink, keeping the latest copy of each record
+
+    The sink only ever appends, so a record scraped again (a re-run, a work unit run twice) is stored once per run.
+    Files are read in the order they were written and, like the upserts of Bulk_Writer.BulkWriter, the last copy of
+    each key (COLLECTION_KEYS) wins, with the collections of REPLACE_GROUPS (COLORS) replaced a whole group at a time.
+
+    :param directory: root of the dataset
+    :param collection: collection, ex 'TTB'
+    :param columns: fields to return, defaults to all of them (and the date partition)
+    :return: pandas DataFrame, None if nothing was written
+    """
+    import pandas as pd
+    from Bulk_Writer import COLLECTION_KEYS, REPLACE_GROUPS
+
+    dataset = open_dataset(directory, collection)
+    if dataset is None:
+        return None
+
+    keys = [field for field in COLLECTION_KEYS.get(collection, ()) if field in dataset.schema.names]
+    group = [field for field in REPLACE_GROUPS.get(collection, ()) if field in dataset.schema.names]
+    read = None
+    if columns is not None:
+        read = list(columns) + [field for field in keys + group if field not in columns]
+
+    # file names start with the time they were written at (see ColumnarSink.flush)
+    fragments = sorted(dataset.get_fragments(), key=lambda fragment: os.path.basename(fragment.path))
+    frames = [fragment.to_table(schema=dataset.schema, columns=read).to_pandas() for fragment in fragments]
+    if not frames:
+        return dataset.to_table(columns=columns).to_pandas()
+
+    written = pd.Series([n for n, frame in enumerate(frames) for _ in range(len(frame))])
+    frame = pd.concat(frames, ignore_index=True)
+    if group:
+        frame = frame[written == written.groupby([frame[field] for field in group], dropna=False).transform('max')]
+    if keys:
+        frame = frame.drop_duplicates(keys, keep='last')
+    frame = frame.reset_index(drop=True)
+    return frame[list(columns)] if columns is not None else frame
+
+
+class ColumnarSink(object):
+
+    def __init__(self, directory, row_group_size=100000, flush_interval=300.0, compression='snappy',
+                 partition=receive_date, logger=None):
+        """
+        Buffers records column by column and writes them to Parquet files partitioned by date
+
+        Has the same add / on_flush / flush / close interface as Bulk_Writer.BulkWriter, so it can be used in its
+        place (or next to it, see TeeSink). Each flush of a collection writes one file per date, holding a single row
+        group, to <directory>/<collection>/date=<YYYY-MM-DD>/, and widens the collection's stored schema
+        (SCHEMA_FILE) with any new fields. open_dataset reads the files back as one dataset.
+
+        Unlike the BulkWriter, records are only ever appended: a record written twice is stored twice, and
+        read_collection keeps the last copy.
+
+        A collection is written once it holds row_group_size records, everything is written once flush_interval
+        seconds have passed since the last flush, and on close. Buffered records are only dropped once all of their
+        files are in place, a failed write leaves them for the next flush. An on_flush callback runs as soon as every
+        collection that held records when it was registered has been written.
+
+        :param directory: root of the dataset
+        :param row_group_size: records buffered per collection before it is written
+        :param flush_interval: maximum seconds a record waits in the buffer (checked whenever one is added), longer
+                               intervals give fewer, larger files
+        :param compression: Parquet compression codec
+        :param partition: function of a record giving its date partition
+        :param logger: logger, defaults to this module's logger
+        """
+        try:
+            import pyarrow  # only needed when writing Parquet, and slow to import
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required to write Parquet files')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.partition = partition
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self._columns = {}  # collection -> partition -> field -> list of values
+        self._counts = {}  # collection -> records buffered
+        self._callbacks = []  # [collections still to be written, callback]
+        self._last_flush = monotonic()
+        self._lock = threading.RLock()
+
+    def ensure_indexes(self):
+        """Nothing to index, here so the sink can stand in for a BulkWriter"""
+        pass
+
+    def add(self, collection, doc):
+        """
+        Append a record
+
+        :param collection: collection name, also the name of the dataset's top level directory
+        :param doc: the record, a dict of field -> value
+        """
+        with self._lock:
+            partitions = self._columns.setdefault(collection, {})
+            part = self.partition(doc)
+            columns = partitions.setdefault(part, {})
+            n_rows = len(next(iter(columns.values()))) if columns else 0
+
+            for field in doc:
+                if field not in columns:
+                    columns[field] = [None] * n_rows  # field first seen now, earlier records don't have it
+            for field, values in columns.items():
+                values.append(doc.get(field))
+
+            self._counts[collection] = self._counts.get(collection, 0) + 1
+            try:
+                if self._counts[collection] >= self.row_group_size:
+                    self.flush(collection)
+                elif monotonic() - self._last_flush >= self.flush_interval:
+                    self.flush()
+            except OSError as e:
+                # still buffered, the next flush tries again
+                self.logger.warning('Deferred write failed: {}'.format(e))
+
+    def on_flush(self, callback):
+        """
+        Run callback once every record added so far has been written
+
+        :param callback: function taking no arguments
+        """
+        with self._lock:
+            waiting = {name for name, count in self._counts.items() if count}
+            if waiting:
+                self._callbacks.append([waiting, callback])
+            else:
+                callback()
+
+    def _table(self, collection, columns):
+        """Build an Arrow table from buffered columns"""
+        pa = self._pa
+        types = COLUMN_TYPES.get(collection, {})
+        arrays = []
+        for field, values in columns.items():
+            dtype = types.get(field, 'string')
+            if dtype == 'string':
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type=pa.type_for_alias(dtype)))
+        return pa.Table.from_arrays(arrays, names=[str(field) for field in columns])
+
+    def _widen_schema(self, name, schema):
+        """Add the fields of schema to the collection's stored schema"""
+        path = os.path.join(self.directory, name, SCHEMA_FILE)
+        if os.path.exists(path):
+            stored = self._pq.read_schema(path)
+            widened = self._pa.unify_schemas([stored, schema])
+            if widened.equals(stored):
+                return
+        else:
+            widened = schema
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        self._pq.write_metadata(widened, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _write(self, name, partitions):
+        """Write one collection's buffered partitions, every file is moved into place only once all were written"""
+        # every file of the flush gets the same columns
+        fields = []
+        for columns in partitions.values():
+            fields.extend(field for field in columns if field not in fields)
+
+        # names start with the time, so read_collection can tell which copy of a record is the latest
+        stem = 'part-{:020d}-{}'.format(int(time() * 1e6), uuid.uuid4().hex)
+        written = []  # (temporary path, final path)
+        try:
+            for part, columns in partitions.items():
+                n_rows = len(next(iter(columns.values())))
+                table = self._table(name, {field: columns.get(field, [None] * n_rows) for field in fields})
+                if not written:
+                    self._widen_schema(name, table.schema)
+
+                path = os.path.join(self.directory, name, 'date={}'.format(part))
+                os.makedirs(path, exist_ok=True)
+                final_path = os.path.join(path, stem + '.parquet')
+                tmp_path = os.path.join(path, '.{}.parquet.tmp'.format(stem))  # hidden from readers until renamed
+                written.append((tmp_path, final_path))
+                self._pq.write_table(table, tmp_path, row_group_size=table.num_rows, compression=self.compression)
+        except Exception:
+            for tmp_path, _ in written:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            raise
+
+        for tmp_path, final_path in written:
+            os.replace(tmp_path, final_path)
+
+    def flush(self, collection=None):
+        """
+        Write out buffered records
+
+        :param collection: only flush this collection, flushes all of them if None
+        :raises OSError: if a write failed (its records stay buffered, and the callbacks waiting on them stay queued)
+        """
+        with self._lock:
+            names = [collection] if collection is not None else list(self._columns)
+
+            for name in names:
+                partitions = self._columns.get(name)
+                if partitions:
+                    n_records = self._counts.get(name, 0)
+                    with timer('ttb_db_write_seconds', sink='parquet', collection=name):
+                        self._write(name, partitions)
+                    incr('ttb_db_records_total', n_records, sink='parquet', collection=name)
+                    self.logger.info('Wrote {n} records to {name}'.format(n=n_records, name=name))
+
+                self._columns.pop(name, None)
+                self._counts.pop(name, None)
+                for waiting, _ in self._callbacks:
+                    waiting.discard(name)
+
+            if collection is None:
+                self._last_flush = monotonic()
+
+            ready = [callback for waiting, callback in self._callbacks if not waiting]
+            self._callbacks = [entry for entry in self._callbacks if entry[0]]
+            for callback in ready:
+                callback()
+
+    def close(self):
+        """Write everything that is still buffered"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TeeSink(object):
+
+    def __init__(self, *sinks):
+        """
+        Sends every record to several sinks (ex. a BulkWriter and a ColumnarSink)
+
+        :param sinks: objects with the BulkWriter interface
+        """
+        self.sinks = sinks
+
+    def ensure_indexes(self):
+        for sink in self.sinks:
+            sink.ensure_indexes()
+
+    def add(self, collection, doc):
+        for sink in self.sinks:
+            sink.add(collection, dict(doc))  # a sink may add fields (ex. pymongo's _id)
+
+    def on_flush(self, callback):
+        """Run callback once every sink has written the records added so far"""
+        lock = threading.Lock()
+        remaining = [len(self.sinks)]
+
+        def countdown():
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback()
+
+        for sink in self.sinks:
+            sink.on_flush(countdown)
+
+    @staticmethod
+    def _each(methods, *args):
+        """Call the same method of every sink even if one of them fails, then raise the first failure"""
+        error = None
+        for method in methods:
+            try:
+                method(*args)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def flush(self, collection=None):
+        self._each([sink.flush for sink in self.sinks], collection)
+
+    def close(self):
+        self._each([sink.close for sink in self.sinks])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
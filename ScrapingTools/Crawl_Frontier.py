@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+TTB crawl frontier (checkpointing for resumable crawls)
+"""
+
+
+import sqlite3
+import threading
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+class CrawlFrontier(object):
+
+    def __init__(self, path='frontier.sqlite'):
+        """
+        Persistent record of how far a crawl has progressed, stored in SQLite
+
+        Tracks, for every (julian date, receive code) sequence, the last sequence number probed and how many misses
+        in a row we had there, every TTBID known to be empty, the TTBIDs whose image metrics are stored, and the
+        watermarks of incremental crawls (see Sequential_Crawl.incremental) with the forms still missing below them.
+
+        :param path: SQLite file (created if missing)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)  # autocommit
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sequences ('
+                           'jdate TEXT, reccode TEXT, last_seqnum INTEGER, retry_count INTEGER, complete INTEGER, '
+                           'PRIMARY KEY (jdate, reccode))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS empty_ids (ttbid TEXT PRIMARY KEY)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS imaged_ids (ttbid TEXT PRIMARY KEY)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS watermarks (name TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS missing_forms (ttbid TEXT PRIMARY KEY, attempts INTEGER)')
+
+    @staticmethod
+    def _split(ttbid):
+        """TTBID -> (jdate, reccode, seqnum)"""
+        ttbid = str(ttbid)
+        return ttbid[:5], ttbid[5:8], int(ttbid[8:])
+
+    def sequence_state(self, ttbid):
+        """
+        Where the sequence a TTBID belongs to was left off
+
+        :param ttbid: any TTBID of the sequence (only the date and receive code are used)
+        :return: (last_seqnum, retry_count, complete), (0, 0, False) for a sequence we have not started
+        """
+        jdate, reccode, _ = self._split(ttbid)
+        with self._lock:
+            row = self._conn.execute('SELECT last_seqnum, retry_count, complete FROM sequences '
+                                     'WHERE jdate = ? AND reccode = ?', (jdate, reccode)).fetchone()
+        if row is None:
+            return 0, 0, False
+        return row[0], row[1], bool(row[2])
+
+    def record_probe(self, ttbid, found, retry_count, complete=False):
+        """
+        Checkpoint a probe of the sequence
+
+        :param ttbid: the TTBID just processed
+        :param found: whether a form was found for it (False only for a page that was fetched and had no form, the
+                      TTBID is then never requested again)
+        :param retry_count: misses in a row after processing this TTBID
+        :param complete: True if the sequence is finished
+        """
+        jdate, reccode, seqnum = self._split(ttbid)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO sequences VALUES (?, ?, ?, ?, ?)',
+                               (jdate, reccode, seqnum, retry_count, int(complete)))
+            if not found:
+                self._conn.execute('INSERT OR IGNORE INTO empty_ids VALUES (?)', (str(ttbid),))
+
+    def is_known_empty(self, ttbid):
+        """True if an earlier probe found no form for this TTBID"""
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM empty_ids WHERE ttbid = ?', (str(ttbid),)).fetchone()
+        return row is not None
+
+    def mark_imaged(self, ttbid):
+        """Record that the image metrics of a TTBID are stored"""
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO imaged_ids VALUES (?)', (str(ttbid),))
+
+    def imaged_ids(self, ttbids):
+        """
+        Which of the given TTBIDs already have image metrics
+
+        :param ttbids: iterable of TTBIDs
+        :return: set of TTBID strings
+        """
+        ttbids = [str(ttbid) for ttbid in ttbids]
+        found = set()
+        with self._lock:
+            # stay under SQLite's limit on the number of host parameters
+            for i in range(0, len(ttbids), 500):
+                batch = ttbids[i:i + 500]
+                query = 'SELECT ttbid FROM imaged_ids WHERE ttbid IN ({})'.format(','.join('?' * len(batch)))
+                found.update(row[0] for row in self._conn.execute(query, batch))
+        return found
+
+    def watermark(self, name='approval'):
+        """The date an incremental crawl has been brought up to, 'mm/dd/yyyy' or None if it never ran"""
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM watermarks WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_watermark(self, value, name='approval'):
+        """
+        Move the watermark of an incremental crawl
+
+        :param value: date everything up to (and including) is stored, 'mm/dd/yyyy'
+        :param name: which crawl
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (name, value))
+
+    def record_missing_forms(self, missing, found=()):
+        """
+        Count another failed attempt at the forms of an incremental crawl
+
+        :param missing: TTBIDs whose form is still not stored
+        :param found: TTBIDs whose form is now stored, their count is dropped
+        :return: dict of TTBID -> attempts so far, for the missing TTBIDs
+        """
+        missing = [str(ttbid) for ttbid in missing]
+        with self._lock:
+            self._conn.executemany('DELETE FROM missing_forms WHERE ttbid = ?', [(str(ttbid),) for ttbid in found])
+            self._conn.executemany('INSERT OR IGNORE INTO missing_forms VALUES (?, 0)', [(ttbid,) for ttbid in missing])
+            self._conn.executemany('UPDATE missing_forms SET attempts = attempts + 1 WHERE ttbid = ?',
+                                   [(ttbid,) for ttbid in missing])
+            attempts = {}
+            for i in range(0, len(missing), 500):
+                batch = missing[i:i + 500]
+                query = 'SELECT ttbid, attempts FROM missing_forms WHERE ttbid IN ({})'.format(
+                    ','.join('?' * len(batch)))
+                attempts.update(self._conn.execute(query, batch))
+        return attempts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+TTB dominant color engines
+"""
+
+
+import sys
+from time import time
+
+import numpy as np
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# selectable dominant color engines (see CalcImgMetrics.calc_all_metrics)
+DOM_COLOR_ENGINES = ('kmeans', 'histogram')
+
+# histogram cells merged one at a time by histogram_dom_color, smaller cells are merged in bulk
+_MERGE_CELLS = 64
+
+
+def _distances(a, b):
+    """Euclidean distance between every row of a and every row of b (small arrays, no sklearn needed)"""
+    return np.sqrt(((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2))
+
+
+class KMeansSelector(object):
+
+    def __init__(self, min_colors=2, max_colors=10, n_init=25, sample_size=1000, strategy='full', random_state=0):
+        """
+        Picks the number of dominant colors by fitting kmeans for each candidate k and comparing silhouette scores
+
+        Every fitted model is kept (so the winner is never refit) and the pairwise distances of the pixel sample are
+        computed once and shared by all of the silhouette evaluations.
+
+        Strategies:
+            'full': n_init kmeans++ restarts for every k, gives the same palettes as refitting from scratch
+            'warm': a single fit per k, seeded with the centers for k - 1 plus the worst fit pixel
+            'minibatch': MiniBatchKMeans with a few restarts per k
+
+        :param min_colors: smallest number of colors tried
+        :param max_colors: one more than the largest number of colors tried
+        :param n_init: restarts per k for the 'full' strategy
+        :param sample_size: number of pixels the models are fit on
+        :param strategy: 'full', 'warm' or 'minibatch'
+        :param random_state: seed for the sample and the fits (same seed, same palette)
+        """
+        if strategy not in ('full', 'warm', 'minibatch'):
+            raise ValueError('Unknown kmeans strategy: {}'.format(strategy))
+
+        self.min_colors = min_colors
+        self.max_colors = max_colors
+        self.n_init = n_init
+        self.sample_size = sample_size
+        self.strategy = strategy
+        self.random_state = random_state
+
+        self.models = {}  # k -> fitted model of the last call to select
+        self.scores = {}  # k -> silhouette score of the last call to select
+
+    def sample(self, pixels):
+        """
+        Random sample of the pixels, without shuffling the whole array
+
+        Picks the same pixels as sklearn.utils.shuffle(pixels, random_state=random_state)[:sample_size].
+
+        :param pixels: numpy array shape (n, 3)
+        """
+        rng = np.random.RandomState(self.random_state)
+        return pixels[rng.permutation(len(pixels))[:self.sample_size]]
+
+    def _fit(self, sample, n_colors, previous=None):
+        """Fit a single model with n_colors clusters"""
+        from sklearn import cluster  # sklearn is slow to import, only load it when kmeans is used
+        from sklearn.metrics import pairwise_distances
+        if self.strategy == 'minibatch':
+            model = cluster.MiniBatchKMeans(n_clusters=n_colors, random_state=self.random_state, n_init=3,
+                                            batch_size=256)
+        elif self.strategy == 'warm' and previous is not None:
+            # seed with the previous centers plus the pixel furthest from all of them
+            dist = pairwise_distances(sample, previous.cluster_centers_).min(axis=1)
+            init = np.vstack([previous.cluster_centers_, sample[np.argmax(dist)]])
+            model = cluster.KMeans(n_clusters=n_colors, init=init, n_init=1)
+        elif self.strategy == 'warm':
+            model = cluster.KMeans(n_clusters=n_colors, random_state=self.random_state, n_init=1)
+        else:
+            model = cluster.KMeans(n_clusters=n_colors, random_state=self.random_state, n_init=self.n_init)
+
+        return model.fit(sample)
+
+    def select(self, pixels, sample=None):
+        """
+        Find the best number of clusters for a set of pixels
+
+        :param pixels: numpy array shape (n, 3)
+        :param sample: float64 sample of the pixels to fit on, if it was already taken (see sample)
+        :return: (fitted model, the sample it was fit on)
+        """
+        from sklearn.metrics import pairwise_distances, silhouette_score
+        sample = self.sample(pixels).astype(np.float64) if sample is None else sample
+        distances = None  # computed once, on first use
+
+        self.models = {}
+        self.scores = {}
+
+        best_silhouette = 0
+        best_n_colors = self.min_colors
+        previous = None
+        for n_colors in range(self.min_colors, self.max_colors):
+            model = self._fit(sample, n_colors, previous)
+            self.models[n_colors] = model
+            previous = model
+
+            # single color, more clusters won't help
+            if len(np.unique(model.labels_)) == 1:
+                return model, sample
+
+            if distances is None:
+                distances = pairwise_distances(sample, metric='euclidean')
+            silhouette = silhouette_score(distances, model.labels_, metric='precomputed')
+            self.scores[n_colors] = silhouette
+
+            # Find the best one
+            if silhouette > best_silhouette:
+                best_silhouette = silhouette
+                best_n_colors = n_colors
+
+        return self.models[best_n_colors], sample
+
+
+def assign_pixels(pixels, centers, chunk_size=16384):
+    """
+    Index of the nearest center of every pixel
+
+    Distances are computed a chunk of pixels at a time, as |c|^2 - 2 p.c (|p|^2 is the same for every center), so
+    memory stays at chunk_size x k no matter the size of the image.
+
+    :param pixels: numpy array shape (n, 3)
+    :param centers: numpy array shape (k, 3)
+    :param chunk_size: pixels per chunk
+    :return: numpy array shape (n,) of center indices
+    """
+    pixels = np.asarray(pixels).reshape(-1, 3)
+    centers = np.asarray(centers, dtype=np.float64)
+    center_sq = (centers ** 2).sum(axis=1)
+
+    labels = np.empty(len(pixels), dtype=np.intp)
+    for i in range(0, len(pixels), chunk_size):
+        chunk = pixels[i:i + chunk_size].astype(np.float64)
+        labels[i:i + chunk_size] = np.argmin(center_sq - 2 * chunk.dot(centers.T), axis=1)
+    return labels
+
+
+def pixel_percentages(pixels, centers, chunk_size=16384):
+    """
+    Fraction of the pixels closest to each center
+
+    :param pixels: numpy array shape (n, 3), or an image (n, m, 3)
+    :param centers: numpy array shape (k, 3)
+    :param chunk_size: see assign_pixels
+    :return: numpy array shape (k, 1)
+    """
+    labels = assign_pixels(pixels, centers, chunk_size)
+    counts = np.bincount(labels, minlength=len(centers)).astype('float')
+    return (counts / max(len(labels), 1)).reshape(-1, 1)
+
+
+def pixel_percentages_batch(images, centers_list, chunk_size=16384):
+    """
+    pixel_percentages for a batch of images, each against its own palette
+
+    Each thumbnail fits in one chunk, so this is one matrix product and one bincount per image; comparing every pixel
+    of a batch against all of the batch's palettes at once (and masking) measured slower.
+
+    :param images: list of numpy arrays shape (n, 3) or (n, m, 3)
+    :param centers_list: list of the centers of each image, numpy arrays shape (k_i, 3)
+    :param chunk_size: see assign_pixels
+    :return: list of numpy arrays shape (k_i, 1)
+    """
+    return [pixel_percentages(img, centers, chunk_size) for img, centers in zip(images, centers_list)]
+
+
+def histogram_dom_color(img, bins=8, max_colors=9, min_fraction=0.01, color_space='rgb', merge_distance=None):
+    """
+    Dominant colors from a quantized 3-D color histogram, no iterative clustering
+
+    Every pixel is dropped into one of bins ** 3 cells (of RGB or Lab space), the most populated cells are the
+    dominant colors and each color is the mean RGB value of the pixels in its cell(s).  Costs a few bincounts over
+    the pixels, so the whole thumbnail is used rather than a sample.
+
+    :param img: numpy array shape (n,m,3) or (n,3), RGB values 0-255
+    :param bins: cells per channel
+    :param max_colors: the maximum number of colors returned (kmeans tops out at 9)
+    :param min_fraction: cells holding less than this fraction of the pixels are ignored (the largest is always kept)
+    :param color_space: 'rgb' or 'lab', the space the cells are laid out in
+    :param merge_distance: cells whose mean colors are closer than this (RGB distance) are merged, defaults to the
+                           width of a cell
+    :return hist: fraction of the kept pixels that each color represents, shape (k, 1), largest first
+    :return centers: the RGB values of the colors, shape (k, 3)
+    """
+    pixels = np.asarray(img).reshape(-1, 3)
+
+    if color_space == 'rgb':
+        cells = pixels.astype(np.int64) * bins // 256
+    elif color_space == 'lab':
+        from skimage import color as skcolor
+        lab = skcolor.rgb2lab(pixels.reshape(-1, 1, 3).astype(np.uint8)).reshape(-1, 3)
+        lo = np.array([0.0, -128.0, -128.0])
+        span = np.array([100.0, 256.0, 256.0])
+        cells = np.clip(((lab - lo) / span * bins).astype(np.int64), 0, bins - 1)
+    else:
+        raise ValueError('Unknown color space: {}'.format(color_space))
+
+    codes = (cells[:, 0] * bins + cells[:, 1]) * bins + cells[:, 2]
+    counts = np.bincount(codes, minlength=bins ** 3)
+
+    sums = np.stack([np.bincount(codes, weights=pixels[:, c], minlength=bins ** 3) for c in range(3)], axis=1)
+
+    # a color that straddles a cell boundary fills neighbouring cells, fold cells into a larger one with a close mean;
+    # the largest cells are merged one by one, the long tail of small ones in one step onto the colors that found
+    merge_distance = 256.0 / bins if merge_distance is None else merge_distance
+    occupied = np.flatnonzero(counts)
+    occupied = occupied[np.argsort(counts[occupied], kind='stable')[::-1]]
+    head, tail = occupied[:_MERGE_CELLS], occupied[_MERGE_CELLS:]
+
+    merged_counts = np.zeros(len(head))
+    merged_sums = np.zeros((len(head), 3))
+    n_merged = 0
+    for cell in head:
+        mean = sums[cell] / counts[cell]
+        if n_merged:
+            dist = np.linalg.norm(merged_sums[:n_merged] / merged_counts[:n_merged, None] - mean, axis=1)
+            num = np.argmin(dist)
+            if dist[num] < merge_distance:
+                merged_counts[num] += counts[cell]
+                merged_sums[num] += sums[cell]
+                continue
+        merged_counts[n_merged] = counts[cell]
+        merged_sums[n_merged] = sums[cell]
+        n_merged += 1
+    merged_counts, merged_sums = merged_counts[:n_merged], merged_sums[:n_merged]
+
+    if len(tail):
+        dist = _distances(sums[tail] / counts[tail, None], merged_sums / merged_counts[:, None])
+        nearest = np.argmin(dist, axis=1)
+        close = dist[np.arange(len(tail)), nearest] < merge_distance
+        merged_counts += np.bincount(nearest[close], weights=counts[tail][close], minlength=n_merged)
+        for c in range(3):
+            merged_sums[:, c] += np.bincount(nearest[close], weights=sums[tail][close][:, c], minlength=n_merged)
+    order = np.argsort(merged_counts, kind='stable')[::-1][:max_colors]
+    keep = order[merged_counts[order] >= min_fraction * len(pixels)]
+    if len(keep) == 0:
+        keep = order[:1]
+
+    centers = merged_sums[keep] / merged_counts[keep, None]
+    hist = merged_counts[keep] / merged_counts[keep].sum()
+
+    return hist.reshape(-1, 1), centers
+
+
+def palette_distance(hist_a, colors_a, hist_b, colors_b):
+    """
+    How far apart two palettes are
+
+    Each color is matched to the nearest color of the other palette; the RGB distances are weighted by the
+    percentages and the two directions averaged.  0 for identical palettes, 441 (black vs white) at most.
+
+    :return: weighted mean RGB distance
+    """
+    hist_a, colors_a = np.ravel(hist_a), np.asarray(colors_a, dtype=np.float64)
+    hist_b, colors_b = np.ravel(hist_b), np.asarray(colors_b, dtype=np.float64)
+    dist = _distances(colors_a, colors_b)
+    return (np.dot(hist_a, dist.min(axis=1)) / hist_a.sum() + np.dot(hist_b, dist.min(axis=0)) / hist_b.sum()) / 2
+
+
+def compare_engines(images, kmeans_kwargs=None, histogram_kwargs=None):
+    """
+    Benchmark the histogram engine against kmeans and report how well the palettes agree
+
+    :param images: iterable of RGB PIL images
+    :param kmeans_kwargs: passed on to CalcImgMetrics.kmeans_dom_color
+    :param histogram_kwargs: passed on to histogram_dom_color
+    :return: (list of per image dicts, summary dict)
+    """
+    from Image_Processing import CalcImgMetrics  # Image_Processing imports this module
+
+    kmeans_kwargs = kmeans_kwargs or {}
+    histogram_kwargs = histogram_kwargs or {}
+
+    rows = []
+    for num, img in enumerate(images):
+        metrics = CalcImgMetrics(img)
+
+        t0 = time()
+        k_hist, k_colors = metrics.kmeans_dom_color(metrics.scaled, **kmeans_kwargs)
+        kmeans_secs = time() - t0
+
+        t0 = time()
+        h_hist, h_colors = histogram_dom_color(metrics.scaled, **histogram_kwargs)
+        histogram_secs = time() - t0
+
+        k_top = np.asarray(k_colors, dtype=np.float64)[np.argmax(np.ravel(k_hist))]
+        rows.append({'img': num,
+                     'kmeans_secs': kmeans_secs,
+                     'histogram_secs': histogram_secs,
+                     'kmeans_colors': len(k_colors),
+                     'histogram_colors': len(h_colors),
+                     'palette_distance': palette_distance(k_hist, k_colors, h_hist, h_colors),
+                     'top_color_distance': float(np.linalg.norm(k_top - h_colors[0]))})
+
+    if not rows:
+        return rows, {}
+
+    kmeans_total = sum(row['kmeans_secs'] for row in rows)
+    histogram_total = sum(row['histogram_secs'] for row in rows)
+    summary = {'images': len(rows),
+               'kmeans_secs': kmeans_total,
+               'histogram_secs': histogram_total,
+               'speedup': kmeans_total / max(histogram_total, 1e-9),
+               'mean_palette_distance': float(np.mean([row['palette_distance'] for row in rows])),
+               'median_top_color_distance': float(np.median([row['top_color_distance'] for row in rows])),
+               'same_color_count': float(np.mean([row['kmeans_colors'] == row['histogram_colors'] for row in rows]))}
+
+    return rows, summary
+
+
+def main():
+    """ Compare the dominant color engines on the images given on the command line """
+    from PIL import Image
+
+    paths = sys.argv[1:]
+    if not paths:
+        print('usage: Dominant_Colors.py IMAGE [IMAGE ...]')
+        return
+
+    rows, summary = compare_engines(Image.open(path).convert('RGB') for path in paths)
+
+    for path, row in zip(paths, rows):
+        print('{path}: kmeans {kmeans_secs:.3f}s ({kmeans_colors} colors), histogram {histogram_secs:.4f}s '
+              '({histogram_colors} colors), palette distance {palette_distance:.1f}'.format(path=path, **row))
+    print('{images} images: kmeans {kmeans_secs:.2f}s, histogram {histogram_secs:.3f}s ({speedup:.0f}x faster), '
+          'mean palette distance {mean_palette_distance:.1f}, median top color distance '
+          '{median_top_color_distance:.1f}, same number of colors {same_color_count:.0%}'.format(**summary))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+TTB local entropy engine
+"""
+
+
+import sys
+from time import time
+
+import numpy as np
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# ITU-R 709 luma weights, the same ones skimage.color.rgb2grey uses
+LUMA_WEIGHTS = np.array([0.2125, 0.7154, 0.0721])
+
+# histogram bin of the padding around each image, never counted
+_INVALID = 256
+
+# Largest difference seen between the sum of the entropy from local_entropy and
+# np.sum(skimage.filters.rank.entropy(skimage.color.rgb2grey(img), disk(4))), relative to the latter.  The entropies
+# of a given grey image agree to float precision; the only source of disagreement is the grey level of a pixel
+# landing on the other side of a .5 when luminance is done in uint8 rather than float (a handful of pixels in a few
+# images).  Run this module on a set of images to re-measure.
+ENTROPY_TOLERANCE = 1e-4
+
+
+def disk(radius):
+    """
+    Disk shaped footprint (same as skimage.morphology.disk)
+
+    :param radius: radius of the disk in pixels
+    :return: boolean array shape (2 * radius + 1, 2 * radius + 1)
+    """
+    y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    return x ** 2 + y ** 2 <= radius ** 2
+
+
+def luminance(img):
+    """
+    Grey levels of an RGB image, computed directly in uint8
+
+    Equal to img_as_ubyte(rgb2grey(img)) except, rarely, by one level where the value is within float error of .5
+
+    :param img: numpy array shape (n,m,3) of uint8 RGB values (or an already grey (n,m) array, returned as is)
+    :return: uint8 numpy array shape (n,m)
+    """
+    img = np.asarray(img)
+    if img.ndim == 2:
+        return img.astype(np.uint8, copy=False)
+    return np.rint(img[:, :, :3].dot(LUMA_WEIGHTS)).astype(np.uint8)
+
+
+def _edges(footprint):
+    """
+    Offsets (dy, dx) of the pixels that leave and join the window when it moves one column to the right
+
+    :return: (leaving, joining) lists of (dy, dx), relative to the center of the footprint
+    """
+    footprint = np.asarray(footprint, dtype=bool)
+    cy, cx = footprint.shape[0] // 2, footprint.shape[1] // 2
+    padded = np.pad(footprint, ((0, 0), (1, 1)))
+
+    leaving = []
+    joining = []
+    for y, x in zip(*np.nonzero(footprint)):
+        if not padded[y, x]:  # left neighbour (x - 1, shifted by the padding) is not in the footprint
+            leaving.append((y - cy, x - cx))
+        if not padded[y, x + 2]:  # right neighbour is not in the footprint
+            joining.append((y - cy, x - cx))
+    return leaving, joining
+
+
+def local_entropy_batch(greys, footprint=None, strip_width=16):
+    """
+    Local entropy (base 2) of every pixel of a batch of grey images
+
+    Every row of every image keeps a histogram of the grey levels in its window, along with the running sum of
+    c * log2(c) over the bins.  As the window slides one column to the right only the pixels on its leading and
+    trailing edges update the histogram (18 of the 49 pixels of disk(4)), and the entropy of each window is
+    log2(n) - sum(c * log2(c)) / n.  Each image is cut into strips of strip_width columns that slide side by side, and
+    the update is vectorized over all of the rows of all of the strips of all of the images at once.  Short strips
+    and small batches keep the histograms in cache; 16 columns and a few thumbnails at a time is about the fastest.
+
+    Pixels outside of an image are not counted, as in skimage.filters.rank.entropy.
+
+    :param greys: list of uint8 numpy arrays shape (n,m), may differ in size (see luminance)
+    :param footprint: boolean array for the neighbourhood, defaults to disk(4)
+    :param strip_width: columns each window slides over (starting a strip costs a full window)
+    :return: list of float64 arrays, the local entropy of each image
+    """
+    footprint = disk(4) if footprint is None else np.asarray(footprint, dtype=bool)
+    if not len(greys):
+        return []
+
+    leaving, joining = _edges(footprint)
+    offsets = list(zip(*np.nonzero(footprint)))
+    cy, cx = footprint.shape[0] // 2, footprint.shape[1] // 2
+    pad_y, pad_x = max(cy, footprint.shape[0] - 1 - cy), max(cx, footprint.shape[1] - 1 - cx)
+
+    # stack the batch into one padded array, smaller images are padded out with the invalid bin
+    height = max(grey.shape[0] for grey in greys)
+    n_strips = -(-max(grey.shape[1] for grey in greys) // strip_width)
+    padded = np.full((len(greys), height + 2 * pad_y, n_strips * strip_width + 2 * pad_x), _INVALID, dtype=np.int64)
+    for num, grey in enumerate(greys):
+        padded[num, pad_y:pad_y + grey.shape[0], pad_x:pad_x + grey.shape[1]] = grey
+
+    # cut into overlapping strips, which are then handled like separate images
+    width = strip_width
+    padded = np.stack([padded[:, :, i * width:(i + 1) * width + 2 * pad_x] for i in range(n_strips)], axis=1)
+    padded = padded.reshape(len(greys) * n_strips, height + 2 * pad_y, width + 2 * pad_x)
+
+    # for each row offset of the footprint, the flat histogram index (row * bins + grey level) of every pixel, laid
+    # out column by column so each step of the slide reads contiguous memory
+    bins = _INVALID + 1
+    n_rows = len(padded) * height
+    base = np.arange(n_rows)[None, :] * bins
+    flat = {dy: np.ascontiguousarray(padded[:, pad_y + dy:pad_y + dy + height, :].reshape(n_rows, -1).T) + base
+            for dy in range(-cy, footprint.shape[0] - cy)}
+
+    size = int(footprint.sum())
+    hist = np.zeros(n_rows * bins, dtype=np.uint8 if size < 256 else np.int64)  # small enough to stay in cache
+    one = hist.dtype.type(1)
+    xlogx = np.zeros(size + 2)  # c * log2(c) for every possible count
+    xlogx[1:] = np.arange(1, size + 2) * np.log2(np.arange(1, size + 2))
+    grow = xlogx[1:] - xlogx[:-1]  # change in the sum when a bin goes from c to c + 1
+    shrink = np.concatenate([[0.0], -grow])  # ... and from c to c - 1
+    xlogx_sum = np.zeros(n_rows)
+
+    def update(dy, dx, x, add):
+        """Move the pixel at offset (dy, dx) from column x into (add=True) or out of each window"""
+        index = flat[dy][pad_x + dx + x]
+        counts = hist[index]
+        if add:
+            xlogx_sum[:] += grow[counts]
+            hist[index] = counts + one
+        else:
+            xlogx_sum[:] += shrink[counts]
+            hist[index] = counts - one
+
+    # the full window at the first column, then slide
+    entropy = np.zeros((width, n_rows))
+    invalid = np.arange(n_rows) * bins + _INVALID
+    for x in range(width):
+        if x == 0:
+            for dy, dx in offsets:
+                update(dy - cy, dx - cx, 0, True)
+        else:
+            for dy, dx in leaving:
+                update(dy, dx, x - 1, False)
+            for dy, dx in joining:
+                update(dy, dx, x, True)
+
+        # the invalid bin counts towards the sum, take it back out
+        n_invalid = hist[invalid].astype(np.intp)
+        n = np.maximum(size - n_invalid, 1)
+        entropy[x] = np.log2(n) - (xlogx_sum - xlogx[n_invalid]) / n
+
+    # (column, strip row) -> image, row, strip, column
+    entropy = entropy.T.reshape(len(greys), n_strips, height, width).transpose(0, 2, 1, 3)
+    entropy = entropy.reshape(len(greys), height, n_strips * width)
+    return [entropy[num, :grey.shape[0], :grey.shape[1]] for num, grey in enumerate(greys)]
+
+
+def local_entropy(grey, footprint=None, strip_width=16):
+    """
+    Local entropy (base 2) of every pixel of a grey image, see local_entropy_batch
+
+    :param grey: uint8 numpy array shape (n,m)
+    :param footprint: boolean array for the neighbourhood, defaults to disk(4)
+    :param strip_width: see local_entropy_batch
+    """
+    return local_entropy_batch([grey], footprint, strip_width)[0]
+
+
+def total_entropy_batch(imgs, footprint=None, batch_size=4):
+    """
+    Sum of the local entropy of each of a batch of images
+
+    :param imgs: list of RGB (n,m,3) or grey (n,m) uint8 numpy arrays
+    :param footprint: boolean array for the neighbourhood, defaults to disk(4)
+    :param batch_size: images processed per vectorized pass
+    :return: list of floats
+    """
+    sums = []
+    for i in range(0, len(imgs), batch_size):
+        greys = [luminance(img) for img in imgs[i:i + batch_size]]
+        sums.extend(float(np.sum(ent)) for ent in local_entropy_batch(greys, footprint))
+    return sums
+
+
+def main():
+    """ Check the engine against skimage on the images given on the command line """
+    from PIL import Image
+    from skimage import color, filters, morphology, util
+
+    paths = sys.argv[1:]
+    if not paths:
+        print('usage: Entropy.py IMAGE [IMAGE ...]')
+        return
+
+    imgs = []
+    for path in paths:
+        img = Image.open(path).convert('RGB')
+        img.thumbnail((128, 128))
+        imgs.append(np.array(img))
+
+    t0 = time()
+    reference = [np.sum(filters.rank.entropy(util.img_as_ubyte(color.rgb2gray(img)), morphology.disk(4)))
+                 for img in imgs]
+    skimage_secs = time() - t0
+
+    t0 = time()
+    sums = total_entropy_batch(imgs)
+    engine_secs = time() - t0
+
+    worst = max(abs(total - ref) / max(ref, 1e-9) for total, ref in zip(sums, reference))
+    print('{n} images: skimage {skimage_secs:.3f}s, engine {engine_secs:.3f}s, largest relative difference {worst:.2e} '
+          '(tolerance {tol:.0e})'.format(n=len(imgs), skimage_secs=skimage_secs, engine_secs=engine_secs, worst=worst,
+                                         tol=ENTROPY_TOLERANCE))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
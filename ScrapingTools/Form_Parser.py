@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+TTB form parsing
+
+Turns publicDisplaySearchBasic pages into form records. The layout of the COLA form hardly ever changes, so the
+table of field labels is built once per layout and reused for every form, and each page is matched in one pass.
+"""
+
+
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from Html_Parsing import parse_page
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# rows of the form and the field labels in them
+FORM_ROWS = 'form[name=colaApplicationForm] div.box tr'
+FORM_LABELS = 'form[name=colaApplicationForm] div.box tr strong'
+
+_CLEAN = re.compile(r'\n|\s{2,}')  # line breaks and the indentation of the page
+_FIELD_KEY = re.compile(r'\s|:')  # removed from a label to make its key ('TTB ID:' -> 'TTBID')
+_PRINTABLE = re.compile(r'Printable Version')
+
+
+class FormParser(object):
+
+    def __init__(self, max_layouts=64):
+        """
+        Parses the field rows of COLA forms
+
+        :param max_layouts: how many different field layouts to keep tables for
+        """
+        self.max_layouts = max_layouts
+        self._tables = {}  # tuple of field labels -> tuple of (label, key)
+        self._lock = threading.Lock()
+
+    def field_table(self, field_names):
+        """
+        (label, key) of each field, built once per layout
+
+        :param field_names: field labels in page order, ex ['TTB ID:', 'Status:', ...]
+        :return: tuple of (label, key) tuples
+        """
+        layout = tuple(field_names)
+        table = self._tables.get(layout)
+        if table is None:
+            table = tuple((label, _FIELD_KEY.sub('', label)) for label in layout)
+            with self._lock:
+                if len(self._tables) >= self.max_layouts:
+                    self._tables.clear()
+                self._tables[layout] = table
+        return table
+
+    @staticmethod
+    def _in_box_row(tag, form):
+        """Whether tag is (or is inside) a tr that is inside a div.box of form, ie matches FORM_ROWS / FORM_LABELS"""
+        in_row = tag.name == 'tr'
+        for parent in tag.parents:
+            if parent is form:
+                return False
+            if not in_row:
+                in_row = parent.name == 'tr'
+            elif parent.name == 'div' and 'box' in (parent.get('class') or ()):
+                return True
+        return False
+
+    @staticmethod
+    def extract(soup):
+        """
+        Pull the field names and rows out of a parsed basic form page
+
+        Finds the same nodes as the FORM_ROWS and FORM_LABELS selectors, walking the tree directly rather than going
+        through the (much slower) CSS selector engine.
+
+        :param soup: soup of a publicDisplaySearchBasic page
+        :return: [field_names, cleaned_form] or None if the page has no form
+        """
+        trs = []
+        strongs = []
+        for form in soup.find_all('form', attrs={'name': 'colaApplicationForm'}):
+            for tag in form.find_all(('tr', 'strong')):
+                if FormParser._in_box_row(tag, form):
+                    (trs if tag.name == 'tr' else strongs).append(tag)
+        if not trs:
+            return None
+
+        field_names = [field.get_text().strip() for field in strongs]
+
+        # remove blanks and unnecessary chars
+        cleaned_form = [_CLEAN.sub('', line.get_text().replace(u'\xa0', u' ')) for line in trs]
+        cleaned_form[0] = _PRINTABLE.sub('', cleaned_form[0])
+        cleaned_form = [line for line in cleaned_form if line]  # filter out empty entries
+
+        return [field_names, cleaned_form]
+
+    def assign(self, field_names, cleaned_form):
+        """
+        Match the rows of a form to its fields
+
+        A row starting with the next expected label opens that field (with the rest of the row as its first value),
+        any other row is added as a line of the field opened last. Same results as the original
+        TTB_Scraper.assign_basic_results, which matched one freshly compiled regex per field.
+
+        :param field_names: field labels in page order
+        :param cleaned_form: rows of the form
+        :return: dict of field key -> value
+        """
+        table = self.field_table(field_names)
+        n_fields = len(table)
+        if not n_fields:
+            raise IndexError('form has no fields')
+
+        parts = {}  # key -> pieces of its value, joined once at the end
+        next_field = 0
+        label, key = table[0]
+        last_key = ''
+
+        for line in cleaned_form:
+            if line.startswith(label):
+                parts[key] = [line[len(label):]]
+                last_key = key
+                if next_field + 1 < n_fields:  # the last label stays the one to look for once all have been seen
+                    next_field += 1
+                    label, key = table[next_field]
+            else:
+                value = parts[last_key]  # KeyError for rows before the first field, like the original
+                value.append(line)
+                value.append('\n')
+
+        return {key: ''.join(value) for key, value in parts.items()}
+
+    def parse(self, markup, backend=None):
+        """
+        Parse a publicDisplaySearchBasic page
+
+        :param markup: html of the page
+        :param backend: Html_Parsing backend, defaults to its default backend
+        :return: dict of the form's fields, None if the page has no form
+        """
+        res = self.extract(parse_page(markup, 'form', backend))
+        return self.assign(*res) if res else None
+
+    def parse_many(self, pages, backend=None):
+        """Parse a list of pages in this process, see parse"""
+        return [self.parse(markup, backend) for markup in pages]
+
+
+# shared by TTB_scraping and the batch API, so every form of a run reuses the same field tables
+FORM_PARSER = FormParser()
+
+
+def _parse_chunk(pages, backend):
+    """Worker side of parse_forms"""
+    return FORM_PARSER.parse_many(pages, backend)
+
+
+def parse_forms(pages, workers=None, chunk_size=256, backend=None, executor=None):
+    """
+    Parse many stored form pages on all cores
+
+    Pages are sent to the workers in chunks, so every worker parses many forms per call and keeps its field tables
+    between them.
+
+    :param pages: iterable of page html (str or bytes)
+    :param workers: number of processes, defaults to the number of cores, 0 to parse in this process
+    :param chunk_size: pages handed to a worker at once
+    :param backend: Html_Parsing backend
+    :param executor: process pool to use instead of starting one
+    :return: generator of the parsed forms (None for pages without a form), in the order of pages
+    """
+    workers = workers if workers is not None else os.cpu_count()
+    chunks = _chunks(pages, chunk_size)
+
+    if not workers and executor is None:
+        for chunk in chunks:
+            for form in FORM_PARSER.parse_many(chunk, backend):
+                yield form
+        return
+
+    own_executor = executor is None
+    executor = executor if executor is not None else ProcessPoolExecutor(workers)
+    try:
+        # keep a couple of chunks per worker queued rather than submitting every page up front
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(_parse_chunk, chunk, backend))
+            if len(pending) > 2 * (workers or 1):
+                for form in pending.pop(0).result():
+                    yield form
+        for future in pending:
+            for form in future.result():
+                yield form
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main():
+    """ Main entry point of the app """
+
+    # parse every saved form page in a directory, ex python Form_Parser.py saved_pages/form
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'saved_pages/form'
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+            pages.append(f.read())
+
+    t0 = time()
+    forms = list(parse_forms(pages))
+    elapsed = time() - t0
+    print('Parsed {n} pages ({found} forms) in {t:.2f}s, {rate:.0f} pages/s'.format(
+        n=len(pages), found=sum(form is not None for form in forms), t=elapsed, rate=len(pages) / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
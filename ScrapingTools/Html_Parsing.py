@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+TTB HTML parsing backends
+"""
+
+
+import os
+import re
+import sys
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from Instrumentation import timer
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# the only parts of each page type that the scrapers ever look at
+PAGE_NODES = {
+    'form': SoupStrainer('form', attrs={'name': 'colaApplicationForm'}),  # form[name=colaApplicationForm] div.box tr
+    'images': SoupStrainer('img'),  # img[alt*=Label]
+    'search': SoupStrainer(class_=re.compile(r'(^|\s)(box|pagination)(\s|$)')),  # .box table tr, div.pagination
+}
+
+# sub directory the saved pages of each page type are kept in (the layout Benchmarks.record_fixtures writes)
+PAGE_DIRS = {'form': 'forms', 'images': 'images', 'search': 'search'}
+
+
+class ParserBackend(object):
+
+    def __init__(self, features, strain=True):
+        """
+        A way of turning a page into soup
+
+        :param features: BeautifulSoup tree builder (ex 'lxml')
+        :param strain: only build the nodes listed in PAGE_NODES (not supported by html5lib)
+        """
+        self.features = features
+        self.strain = strain
+
+    def parse(self, markup, page_type=None):
+        """
+        Parse a page
+
+        :param markup: the html text
+        :param page_type: key of PAGE_NODES, the full document is parsed if None
+        :return: BeautifulSoup object
+        """
+        if self.strain and page_type is not None:
+            return BeautifulSoup(markup, self.features, parse_only=PAGE_NODES[page_type])
+        return BeautifulSoup(markup, self.features)
+
+
+BACKENDS = {
+    'lxml': ParserBackend('lxml'),
+    'html.parser': ParserBackend('html.parser'),
+    'html5lib': ParserBackend('html5lib', strain=False),  # the original (slow, but most lenient) parser
+}
+
+try:
+    import lxml
+    _default_backend = 'lxml'
+except ImportError:
+    _default_backend = 'html5lib'
+
+
+def set_default_backend(name):
+    """Select the backend used when none is passed to parse_page (one of BACKENDS)"""
+    global _default_backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown parser backend: {}'.format(name))
+    _default_backend = name
+
+
+def get_default_backend():
+    """Name of the backend used when none is passed to parse_page"""
+    return _default_backend
+
+
+def parse_page(markup, page_type=None, backend=None):
+    """
+    Parse a TTB page with the selected backend
+
+    :param markup: the html text
+    :param page_type: 'form', 'images' or 'search' to only keep the nodes that page's callers use
+    :param backend: name of the backend, defaults to get_default_backend()
+    :return: BeautifulSoup object
+    """
+    with timer('ttb_parse_seconds', page_type=page_type or 'full'):
+        return BACKENDS[backend or _default_backend].parse(markup, page_type)
+
+
+def extract_records(markup, page_type, backend):
+    """Run the same extraction the scrapers do on a page, used to compare backends"""
+    from TTB_scraping import TTB_Scraper
+    from TTB_crawler import TTB_query
+
+    soup = parse_page(markup, page_type, backend)
+
+    if page_type == 'form':
+        res = TTB_Scraper.extract_basic_form(soup)
+        return TTB_Scraper.assign_basic_results(*res) if res else None
+    elif page_type == 'images':
+        return TTB_Scraper.extract_img_meta(soup)
+    else:
+        query = TTB_query.from_soup(soup)
+        return query.get_num_results(), query.get_ids(), query.get_table_data()
+
+
+def parity_report(directory, backends=None):
+    """
+    Check that every backend extracts identical records from a set of saved pages
+
+    Pages are read from the 'forms', 'images' and 'search' sub directories of directory (see PAGE_DIRS).
+
+    :param directory: folder of saved pages
+    :param backends: names of the backends to compare, defaults to all of them
+    :return: list of (page type, file name, {backend: records}) for every page where the backends disagree
+    """
+    backends = backends or sorted(BACKENDS)
+    mismatches = []
+
+    for page_type in PAGE_NODES:
+        page_dir = os.path.join(directory, PAGE_DIRS[page_type])
+        if not os.path.isdir(page_dir):
+            continue
+
+        for name in sorted(os.listdir(page_dir)):
+            with open(os.path.join(page_dir, name), encoding='utf-8', errors='replace') as f:
+                markup = f.read()
+
+            records = {backend: extract_records(markup, page_type, backend) for backend in backends}
+            reference = records[backends[0]]
+            if any(records[backend] != reference for backend in backends[1:]):
+                mismatches.append((page_type, name, records))
+
+    return mismatches
+
+
+def main():
+    """ Main entry point of the app """
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'saved_pages'
+    mismatches = parity_report(directory)
+    for page_type, name, records in mismatches:
+        print('Backends disagree on {page_type}/{name}'.format(page_type=page_type, name=name))
+        for backend, record in records.items():
+            print('    {backend}: {record}'.format(backend=backend, record=record))
+    print('Pages with mismatches: {}'.format(len(mismatches)))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
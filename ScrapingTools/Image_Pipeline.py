@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+TTB staged image metrics pipeline
+"""
+
+
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from time import time
+
+from tqdm import tqdm
+
+from TTB_scraping import TTB_Scraper, THUMBNAIL_SIZE
+from Instrumentation import collect, enabled, get_registry
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+_DONE = object()  # sent by each fetcher when it stops (out of TTBIDs, or failed)
+
+
+def compute_metrics(img, dom_color='kmeans', instrument=False):
+    """
+    Metric stage: calculate the metrics of one image (runs in a worker process)
+
+    :param dom_color: dominant color engine, see CalcImgMetrics.calc_all_metrics
+    :param instrument: record the timings of the image (see Instrumentation) and send them back
+    :return: (df_color, sum_entropy, img_format, seconds spent, Instrumentation snapshot or None)
+    """
+    from Image_Processing import CalcImgMetrics  # numpy/sklearn stack, only loaded by the processes measuring images
+
+    if instrument:
+        with collect() as registry:
+            return compute_metrics(img, dom_color)[:4] + (registry.snapshot(),)
+
+    t0 = time()
+    metrics = CalcImgMetrics(img)
+    df_color, sum_entropy = metrics.calc_all_metrics(dom_color)
+    return df_color, sum_entropy, metrics.img_format, time() - t0, None
+
+
+class _InlineExecutor(object):
+    """Stand in for a process pool that runs the work immediately, in the calling thread"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        """Throughput counter for one stage of the pipeline"""
+        self.name = name
+        self.count = 0
+        self.busy = 0.0  # seconds spent working, summed over all workers of the stage
+        self.started = time()
+
+    def add(self, seconds, n=1):
+        self.count += n
+        self.busy += seconds
+
+    def summary(self):
+        elapsed = max(time() - self.started, 1e-9)
+        return '{name}: {count} in {elapsed:.1f}s ({rate:.2f}/s), {busy:.1f}s busy'.format(
+            name=self.name, count=self.count, elapsed=elapsed, rate=self.count / elapsed, busy=self.busy)
+
+
+class ImagePipeline(object):
+
+    def __init__(self, fetch_workers=4, metric_workers=None, queue_size=32, draft_size=THUMBNAIL_SIZE,
+                 dom_color='kmeans', cache=None, logger=None):
+        """
+        Download, decode, measure and write label images in overlapping stages
+
+        Fetcher threads download and decode the images of each TTBID and hand them through a bounded queue to a
+        process pool that calculates the metrics; results are handed back to the calling thread for writing.
+
+        :param fetch_workers: number of download threads
+        :param metric_workers: number of metric processes, defaults to the number of cores, 0 to calculate in the
+                               calling thread
+        :param queue_size: bound on the TTBIDs waiting for metrics (and on the images in the pool, times two)
+        :param draft_size: see TTB_Scraper.decode_image
+        :param dom_color: dominant color engine, 'kmeans' or 'histogram' (see CalcImgMetrics.calc_all_metrics)
+        :param cache: optional Metric_Cache.MetricCache, images found in it skip the metric stage
+        :param logger: logger for per image failures
+        """
+        self.fetch_workers = fetch_workers
+        self.metric_workers = metric_workers if metric_workers is not None else os.cpu_count()
+        self.queue_size = queue_size
+        self.draft_size = draft_size
+        self.dom_color = dom_color
+        self.cache = cache
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self.stats = {name: StageStats(name) for name in ('fetch', 'metrics', 'write')}
+
+    def _executor(self):
+        """Pool for the metric stage"""
+        return ProcessPoolExecutor(self.metric_workers) if self.metric_workers else _InlineExecutor()
+
+    def _fetch(self, ttbids, ttbids_lock, fetched):
+        """Fetch stage: download and decode the images of each TTBID (always ends by putting _DONE)"""
+        try:
+            while True:
+                with ttbids_lock:
+                    curr_id = next(ttbids, None)
+                if curr_id is None:
+                    return
+
+                t0 = time()
+                try:
+                    meta, imgs = TTB_Scraper(curr_id).get_images(self.draft_size)
+                    # hash the images here, in parallel and before the metric stage shrinks them
+                    keys = [self.cache.key(img) if self.cache is not None else None for img in imgs]
+                except Exception as e:
+                    self.logger.warning('Failed to download images. TTBID: {ttbid} ({err})'.format(
+                        ttbid=curr_id, err=e))
+                    meta, imgs, keys = [], [], []
+                self.stats['fetch'].add(time() - t0)
+
+                fetched.put((curr_id, list(zip(meta, imgs, keys))))
+        finally:
+            fetched.put(_DONE)  # the run loop waits for one from every fetcher
+
+    def run(self, ttbid_list, handle_result, handle_done=None, handle_skip=None):
+        """
+        Process every TTBID
+
+        :param ttbid_list: TTBIDs to process (repeats are only processed once)
+        :param handle_result: called as handle_result(ttbid, im_num, metadata, df_color, sum_entropy, img_format)
+        :param handle_done: called as handle_done(ttbid) once every image of a TTBID was handled successfully
+        :param handle_skip: called as handle_skip(ttbid) for TTBIDs whose images could not be downloaded
+        """
+        self.stats = {name: StageStats(name) for name in ('fetch', 'metrics', 'write')}
+        ttbid_list = list(dict.fromkeys(ttbid_list))  # the bookkeeping below is per TTBID
+
+        fetched = queue.Queue(maxsize=self.queue_size)
+        ttbids = iter(ttbid_list)
+        ttbids_lock = threading.Lock()
+        fetchers = [threading.Thread(target=self._fetch, args=(ttbids, ttbids_lock, fetched), daemon=True)
+                    for _ in range(self.fetch_workers)]
+        for fetcher in fetchers:
+            fetcher.start()
+
+        executor = self._executor()
+        max_pending = max(2 * self.queue_size, 1)
+
+        pending = {}  # future -> [(ttbid, im_num, metadata, cache key)], one per copy of the image
+        in_flight = {}  # content hash -> future, so copies of an image that is being measured share the result
+        self.reused = 0  # images whose metrics came from the cache or from an identical image
+        remaining = {}  # ttbid -> [images not yet handled, all succeeded so far]
+        fetchers_running = len(fetchers)
+        progress = tqdm(total=len(ttbid_list))
+
+        def finish_image(curr_id, ok):
+            remaining[curr_id][0] -= 1
+            remaining[curr_id][1] &= ok
+            if remaining[curr_id][0] == 0:
+                if remaining.pop(curr_id)[1] and handle_done is not None:
+                    handle_done(curr_id)
+                progress.update(1)
+
+        try:
+            while fetchers_running or pending:
+
+                # hand fetched images to the metric workers while there is room
+                while fetchers_running and len(pending) < max_pending:
+                    try:
+                        item = fetched.get(block=not pending)
+                    except queue.Empty:
+                        break
+
+                    if item is _DONE:
+                        fetchers_running -= 1
+                        continue
+
+                    curr_id, images = item
+                    if not images:
+                        self.logger.warning('Skipping {ttbid}, unable to access images'.format(ttbid=curr_id))
+                        if handle_skip is not None:
+                            handle_skip(curr_id)
+                        progress.update(1)
+                        continue
+
+                    remaining[curr_id] = [len(images), True]
+                    for im_num, (metadata, img, key) in enumerate(images):
+                        if key is not None:
+                            if key[0] in in_flight:
+                                pending[in_flight[key[0]]].append((curr_id, im_num, metadata, key))
+                                self.reused += 1
+                                continue
+                            cached = self.cache.lookup(key, self.dom_color)
+                            if cached is not None:
+                                handle_result(curr_id, im_num, metadata, *cached)
+                                finish_image(curr_id, True)
+                                self.reused += 1
+                                continue
+
+                        try:
+                            future = executor.submit(compute_metrics, img, self.dom_color, enabled())
+                        except BrokenProcessPool:
+                            # a worker died (ex. killed for memory), the images it had fail below, carry on with
+                            # a new pool
+                            self.logger.warning('Metric process pool broke, starting a new one')
+                            executor.shutdown(wait=False)
+                            executor = self._executor()
+                            future = executor.submit(compute_metrics, img, self.dom_color, enabled())
+                        pending[future] = [(curr_id, im_num, metadata, key)]
+                        if key is not None:
+                            in_flight[key[0]] = future
+
+                if not pending:
+                    continue
+
+                # write stage: handle whatever the metric workers have finished
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    copies = pending.pop(future)
+                    key = copies[0][3]
+                    if key is not None:
+                        in_flight.pop(key[0], None)
+
+                    try:
+                        df_color, sum_entropy, img_format, seconds, recorded = future.result()
+                    except Exception as e:
+                        for curr_id, im_num, _, _ in copies:
+                            self.logger.warning('Failed to calculate metrics. TTBID: {ttbid} IMG: {im_num} '
+                                                '({err})'.format(ttbid=curr_id, im_num=im_num, err=e))
+                            finish_image(curr_id, False)
+                        continue
+
+                    self.stats['metrics'].add(seconds)
+                    if recorded is not None:
+                        get_registry().merge(recorded)
+                    if key is not None:
+                        self.cache.store(key, df_color, sum_entropy, img_format, self.dom_color)
+                    for curr_id, im_num, metadata, _ in copies:
+                        t0 = time()
+                        handle_result(curr_id, im_num, metadata, df_color, sum_entropy, img_format)
+                        self.stats['write'].add(time() - t0)
+                        finish_image(curr_id, True)
+
+                progress.set_postfix(ids=self.stats['fetch'].count, imgs=self.stats['metrics'].count)
+        finally:
+            progress.close()
+            executor.shutdown(wait=True)
+
+        for name in ('fetch', 'metrics', 'write'):
+            self.logger.info(self.stats[name].summary())
+            print(self.stats[name].summary())
+        if self.cache is not None:
+            for line in (self.cache.summary(), 'metrics reused for {} images'.format(self.reused)):
+                self.logger.info(line)
+                print(line)
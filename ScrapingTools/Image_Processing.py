@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """
 TTB Image Processing
+
+Metrics are registered in METRICS together with the intermediates they are computed from (thumbnail, pixels, grey,
+lab, pixel_sample, kmeans, clusters, see INTERMEDIATES). CalcImgMetrics computes an intermediate the first time a
+metric asks for it and keeps it, so the metrics of an image share their preprocessing.
 """
 
 
@@ -11,21 +15,11 @@ import pandas as pd
 # basic image handling
 from PIL import Image
 
-# image processing stuff
-from skimage import morphology
-from skimage import filters
-from skimage import color as skcolor
-
-
-# image metrics: kmeans (dominant colors)
-from sklearn import cluster
-from sklearn.utils import shuffle
-from sklearn.metrics import silhouette_score
-
-# visualization
-from matplotlib import pyplot as plt
-import bokeh.plotting as bkplt
-
+# image metrics: kmeans or color histogram (dominant colors), local entropy
+from Dominant_Colors import (KMeansSelector, DOM_COLOR_ENGINES, assign_pixels, histogram_dom_color,
+                             pixel_percentages)
+from Entropy import local_entropy, luminance
+from Instrumentation import timer
 
 from TTB_scraping import TTB_Scraper
 
@@ -34,16 +28,133 @@ __version__ = "0.1.0"
 __license__ = "MIT"
 
 
+# name -> (names of the intermediates it is computed from, function), see register_intermediate
+INTERMEDIATES = {}
+
+# name -> (names of the intermediates it needs, function), see register_metric
+METRICS = {}
+
+# what calc_metrics runs when no metrics are named
+DEFAULT_METRICS = ('dom_color_kmeans', 'entropy')
+
+# how the kmeans dominant colors are fit (see Dominant_Colors.KMeansSelector), the same random state every time for
+# repeatability
+KMEANS_SETTINGS = {'max_colors': 10, 'n_init': 25, 'strategy': 'full', 'random_state': 0}
+
+
+def register_intermediate(name, requires=()):
+    """
+    Decorator declaring a value derived from the image that metrics can share
+
+    The function is called with the intermediates named in requires (in that order), at most once per image and only
+    when a metric that needs it is run. 'thumbnail' (the scaled RGB array) is always available.
+
+    :param name: name metrics refer to it by
+    :param requires: names of the intermediates it is computed from
+    """
+    def register(func):
+        INTERMEDIATES[name] = (tuple(requires), func)
+        return func
+    return register
+
+
+def register_metric(name, requires=()):
+    """
+    Decorator adding a metric to METRICS
+
+    :param name: name callers pick it by, see CalcImgMetrics.calc_metrics
+    :param requires: names of the intermediates the function is called with, in that order
+    """
+    def register(func):
+        METRICS[name] = (tuple(requires), func)
+        return func
+    return register
+
+
+@register_intermediate('pixels', requires=('thumbnail',))
+def _pixels(thumbnail):
+    """The thumbnail as a list of RGB values, shape (n, 3)"""
+    return np.reshape(thumbnail, (-1, 3))
+
+
+@register_intermediate('grey', requires=('thumbnail',))
+def _grey(thumbnail):
+    return luminance(thumbnail)
+
+
+@register_intermediate('lab', requires=('thumbnail',))
+def _lab(thumbnail):
+    """The thumbnail in CIE Lab, shape (n, m, 3)"""
+    from skimage import color as skcolor  # only loaded by metrics that work in Lab
+    return skcolor.rgb2lab(thumbnail)
+
+
+@register_intermediate('pixel_sample', requires=('pixels',))
+def _pixel_sample(pixels):
+    """The pixels kmeans is fit on, the same ones KMeansSelector picks"""
+    return KMeansSelector(random_state=KMEANS_SETTINGS['random_state']).sample(pixels).astype(np.float64)
+
+
+@register_intermediate('kmeans', requires=('pixels', 'pixel_sample'))
+def _kmeans(pixels, pixel_sample, **settings):
+    """
+    The kmeans model with the best number of colors
+
+    :param settings: overrides of KMEANS_SETTINGS
+    """
+    return KMeansSelector(**dict(KMEANS_SETTINGS, **settings)).select(pixels, pixel_sample)[0]
+
+
+@register_intermediate('clusters', requires=('pixels', 'kmeans'))
+def _clusters(pixels, kmeans):
+    """Index of the nearest kmeans color of every pixel"""
+    return assign_pixels(pixels, kmeans.cluster_centers_)
+
+
+@register_metric('dom_color_kmeans', requires=('kmeans', 'clusters'))
+def _dom_color_kmeans(kmeans, clusters):
+    """Dominant colors by kmeans: the share of the pixels nearest to each color, and the colors"""
+    # if single color
+    if len(np.unique(kmeans.labels_)) == 1:
+        return np.ones((1, 1)), [kmeans.cluster_centers_[0]]
+    counts = np.bincount(clusters, minlength=len(kmeans.cluster_centers_)).astype('float')
+    return (counts / max(len(clusters), 1)).reshape(-1, 1), kmeans.cluster_centers_
+
+
+@register_metric('dom_color_histogram', requires=('pixels',))
+def _dom_color_histogram(pixels):
+    """Dominant colors from a color histogram, see Dominant_Colors.histogram_dom_color"""
+    return histogram_dom_color(pixels)
+
+
+@register_metric('entropy', requires=('grey',))
+def _entropy(grey):
+    """Sum of the local entropy, see CalcImgMetrics.total_entropy"""
+    return np.sum(local_entropy(grey))
+
+
+@register_metric('lab_moments', requires=('lab',))
+def _lab_moments(lab):
+    """Mean and standard deviation of L*, a* and b*, shape (2, 3)"""
+    lab = lab.reshape(-1, 3)
+    return np.vstack([lab.mean(axis=0), lab.std(axis=0)])
+
+
 class CalcImgMetrics(object):
 
-    def __init__(self, img):
+    def __init__(self, img, keep_raw=False):
         """
         Helper class to run image processing scripts
 
-        :param img: the full size, RGB PIL image
+        :param img: the RGB PIL image (ideally already decoded at reduced size, see TTB_Scraper.decode_image)
+        :param keep_raw: keep an untouched copy of img in self.raw, otherwise img itself is shrunk in place
         """
-        self.raw = img
-        tmp = Image.Image.copy(img)  # silly non-sense work around for PIL (thumbnail is done in place)
+        if keep_raw:
+            self.raw = img
+            tmp = Image.Image.copy(img)  # silly non-sense work around for PIL (thumbnail is done in place)
+        else:
+            self.raw = None  # don't hold on to the full resolution pixels
+            tmp = img
         tmp.thumbnail((128, 128))  # TODO: change to skimage scaling
         self.scaled = np.array(tmp)  # scaled down version of the image, storing as np array
         self.img_format = None
@@ -61,87 +172,104 @@ class CalcImgMetrics(object):
             elif self.scaled.shape[2] == 3:
                 self.img_format = 'RGB'
 
-    @staticmethod
-    def centroid_histogram(clt):
+        self.intermediates = {'thumbnail': self.scaled}  # name -> value, filled in as metrics ask for them
+
+    def get(self, name):
         """
-        Calculates the percentage of each dominant color
+        An intermediate of this image, computed (along with what it is computed from) the first time it is asked for
 
-        Source: pyimagesearch.com
+        :param name: one of INTERMEDIATES, or 'thumbnail'
+        """
+        value = self.intermediates.get(name)
+        if value is None:
+            if name not in INTERMEDIATES:
+                raise ValueError('Unknown image intermediate: {}'.format(name))
+            requires, func = INTERMEDIATES[name]
+            args = [self.get(dependency) for dependency in requires]
+            with timer('ttb_image_intermediate_seconds', intermediate=name):
+                value = self.intermediates[name] = func(*args)
+        return value
+
+    def calc_metrics(self, names=DEFAULT_METRICS):
+        """
+        Run a selection of the registered metrics
 
-        :param clt: kmeans cluster after fitting
-        :return: percentages for each cluster
+        :param names: names of METRICS to run
+        :return: dict of name -> value
         """
+        unknown = [name for name in names if name not in METRICS]
+        if unknown:
+            raise ValueError('Unknown image metric: {}'.format(', '.join(unknown)))
+
+        results = {}
+        for name in names:
+            requires, func = METRICS[name]
+            args = [self.get(intermediate) for intermediate in requires]
+            with timer('ttb_image_metric_seconds', metric=name):
+                results[name] = func(*args)
+        return results
 
-        # grab the number of different clusters and create a histogram
-        # based on the number of pixels assigned to each cluster
-        numLabels = len(np.unique(clt.labels_))
-        (hist, _) = np.histogram(clt.cluster_centers_, bins=numLabels)
+    @staticmethod
+    def centroid_histogram(pixels, centers):
+        """
+        Calculates the percentage of each dominant color
 
-        # normalize the histogram, such that it sums to one
-        hist = hist.astype("float")
-        hist /= hist.sum()
+        Every pixel of the image is assigned to its nearest center (not just the sample kmeans was fit on), see
+        Dominant_Colors.pixel_percentages
 
-        # return the histogram (percentage described by each cluster)
-        return hist.reshape(numLabels, 1)
+        :param pixels: numpy array shape (n, 3) or (n, m, 3)
+        :param centers: the cluster centers, numpy array shape (k, 3)
+        :return: percentages for each cluster, shape (k, 1)
+        """
+        return pixel_percentages(pixels, centers)
 
-    def kmeans_dom_color(self, img, max_colors=10, n_init=25, verbose=False):
+    def kmeans_dom_color(self, img, max_colors=None, n_init=None, verbose=False, strategy=None):
         """
         Calculates the dominant colors in an image using kmeans
 
+        The same code as the dom_color_kmeans metric. For this image's thumbnail with the default settings the
+        metric's result (and intermediates) are shared.
+
         :param img: numpy array shape (n,m,3)
-        :param max_colors: the maximum number of possible colors to get out
-        :param n_init: the number of different starting positions to try for kmeans
+        :param max_colors: the maximum number of possible colors to get out, defaults to KMEANS_SETTINGS
+        :param n_init: the number of different starting positions to try for kmeans, defaults to KMEANS_SETTINGS
         :param verbose: output info when running
+        :param strategy: how the models are fit, see Dominant_Colors.KMeansSelector, defaults to KMEANS_SETTINGS
         :return hist: fraction of image that each color represents
         :return clusters.cluster_centers_: the 3 tuple values
         """
         t0 = time()
 
-        w, h, d = original_shape = tuple(img.shape)
+        w, h, d = tuple(img.shape)
         assert d == 3
-        image_array = np.reshape(img, (w * h, d))
-
-        image_array_sample = shuffle(image_array, random_state=0)[:1000]  # take a random sample of 1000 points
-
-        rand_state = 0  # same random state is used for repeatability
 
-        best_silhouette = 0
-        for n_colors in range(2, max_colors):
-            clt = cluster.KMeans(n_clusters=n_colors, random_state=rand_state, n_init=n_init)
-            clt.fit(image_array_sample)
-
-            # if single color
-            if len(np.unique(clt.labels_)) == 1:
-                clusters = clt.fit(image_array_sample)
-                hist = self.centroid_histogram(clusters)
-                return hist, [clusters.cluster_centers_[0]]
-
-            silhouette = silhouette_score(image_array_sample, clt.labels_, metric='euclidean')
+        settings = {name: value for name, value in (('max_colors', max_colors), ('n_init', n_init),
+                                                     ('strategy', strategy)) if value is not None}
+        if img is self.scaled and all(KMEANS_SETTINGS[name] == value for name, value in settings.items()):
+            hist, colors = self.calc_metrics(('dom_color_kmeans',))['dom_color_kmeans']
+            clusters = self.get('kmeans')
+        else:
+            pixels = _pixels(img)
+            clusters = _kmeans(pixels, _pixel_sample(pixels), **settings)  # fit on a random sample of 1000 points
+            hist, colors = _dom_color_kmeans(clusters, _clusters(pixels, clusters))
 
-            # Find the best one
-            if silhouette > best_silhouette:
-                best_silhouette = silhouette
-                best_nClusters = n_colors
         if verbose:
             print("KMeans completed in: %0.3fs." % (time() - t0))
-            print("Optimal number of clusters:  {}".format(best_nClusters))
-
-        clt = cluster.KMeans(n_clusters=best_nClusters, random_state=rand_state, n_init=n_init)
-        clusters = clt.fit(image_array_sample)
-        hist = self.centroid_histogram(clusters)
+            print("Optimal number of clusters:  {}".format(clusters.n_clusters))
 
-        return hist, clusters.cluster_centers_
+        return hist, colors
 
     @staticmethod
     def total_entropy(img):
         """
         Calculate the sum of the entropy of an image
 
+        Same as the sum of skimage.filters.rank.entropy(rgb2grey(img), disk(4)), within Entropy.ENTROPY_TOLERANCE
+
         :param img: an m x n x 3 numpy array
         """
 
-        img_grey = skcolor.rgb2grey(img)
-        ent = filters.rank.entropy(img_grey, morphology.disk(4))
+        ent = local_entropy(luminance(img))
         return np.sum(ent)
 
     @staticmethod
@@ -151,6 +279,9 @@ class CalcImgMetrics(object):
 
         Please excuse the horrendous mixing of bokeh and matplotlib
         """
+        # only loaded when plotting, they are slow to import
+        from matplotlib import pyplot as plt
+        import bokeh.plotting as bkplt
 
         fig = bkplt.figure()
 
@@ -164,18 +295,21 @@ class CalcImgMetrics(object):
         plt.imshow(img)
         plt.show()
 
-    def calc_all_metrics(self):
+    def calc_all_metrics(self, dom_color='kmeans'):
         """
-        Calls all metrics
+        Calls the dominant color and entropy metrics
 
-        :return: a pandas dataframe
+        :param dom_color: dominant color engine, 'kmeans' or 'histogram' (see Dominant_Colors.histogram_dom_color)
+        :return: (dominant colors as a pandas dataframe, sum of the entropy)
         """
-
-        # kmeans dominant clusters
-        percentage, rgb_vals = self.kmeans_dom_color(self.scaled)
-
-        # entropy
-        ent = self.total_entropy(self.scaled)
+        if dom_color not in DOM_COLOR_ENGINES:
+            raise ValueError('Unknown dominant color engine: {}'.format(dom_color))
+
+        # dominant colors and entropy
+        dom_color_metric = 'dom_color_{}'.format(dom_color)
+        results = self.calc_metrics((dom_color_metric, 'entropy'))
+        percentage, rgb_vals = results[dom_color_metric]
+        ent = results['entropy']
 
         # must be done with concatination so that pandas expands df appropriately
         df_color = pd.concat([pd.DataFrame(percentage), pd.DataFrame(rgb_vals)], axis=1)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+TTB instrumentation
+
+Counters and timers for every stage of the scrapers (HTTP, parsing, decoding, image metrics, database writes,
+retries and cache hits). Nothing is recorded until enable() is called, until then incr/observe/timer return
+straight away. Recorded values can be served in the Prometheus text format (MetricsServer) or written out as
+periodic JSON snapshots (SnapshotWriter).
+"""
+
+
+import json
+import sys
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# upper bounds (seconds) of the timer histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# what is recorded where, for the HELP lines of the Prometheus output
+DESCRIPTIONS = {
+    'ttb_http_request_seconds': 'HTTP request latency by endpoint and status (Session_Manager)',
+    'ttb_http_retries_total': 'HTTP requests retried after a 429/5xx or a dropped connection (Session_Manager)',
+    'ttb_rate_limit_wait_seconds': 'time spent waiting on the rate limiter before a request (Session_Manager)',
+    'ttb_cache_requests_total': 'response and metric cache lookups by result (Response_Cache, Metric_Cache)',
+    'ttb_parse_seconds': 'HTML parse time by page type (Html_Parsing)',
+    'ttb_image_decode_seconds': 'label image decode time (TTB_scraping)',
+    'ttb_image_metric_seconds': 'image metric time by metric, ex dom_color_kmeans, entropy (Image_Processing)',
+    'ttb_image_intermediate_seconds': 'time to compute the intermediates metrics share, ex grey (Image_Processing)',
+    'ttb_db_write_seconds': 'time to write a batch of records by sink and collection (Bulk_Writer, Columnar_Sink)',
+    'ttb_db_records_total': 'records written by sink and collection (Bulk_Writer, Columnar_Sink)',
+    'ttb_db_write_errors_total': 'records that failed to write by sink and collection (Bulk_Writer)',
+}
+
+
+class MetricRegistry(object):
+
+    def __init__(self):
+        """Thread safe store of counters and timer histograms, keyed by name and labels"""
+        self._counters = {}  # (name, labels) -> value
+        self._timers = {}  # (name, labels) -> [count, sum, [count per bucket (not cumulative), overflow last]]
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount, labels):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels):
+        key = (name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = [0, 0.0, [0] * (len(BUCKETS) + 1)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2][bisect_left(BUCKETS, seconds)] += 1  # first bucket with seconds <= its bound
+
+    def snapshot(self):
+        """Everything recorded so far as a json serializable dict"""
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            timers = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'buckets': list(buckets)}
+                      for (name, labels), (count, total, buckets) in sorted(self._timers.items())]
+        return {'counters': counters, 'timers': timers}
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot (ex one taken in a worker process)"""
+        with self._lock:
+            for counter in snapshot['counters']:
+                key = (counter['name'], tuple(sorted(counter['labels'].items())))
+                self._counters[key] = self._counters.get(key, 0) + counter['value']
+            for entry in snapshot['timers']:
+                key = (entry['name'], tuple(sorted(entry['labels'].items())))
+                timer = self._timers.get(key)
+                if timer is None:
+                    timer = self._timers[key] = [0, 0.0, [0] * (len(BUCKETS) + 1)]
+                timer[0] += entry['count']
+                timer[1] += entry['sum']
+                timer[2] = [a + b for a, b in zip(timer[2], entry['buckets'])]
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timers = {}
+
+
+class _NullTimer(object):
+    """What timer() hands out while disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _Timer(object):
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _registry.observe(self.name, perf_counter() - self.start, self.labels)
+        return False
+
+
+_enabled = False
+_registry = MetricRegistry()
+_NULL_TIMER = _NullTimer()
+
+
+def enable():
+    """Start recording"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop recording, values recorded so far are kept"""
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def get_registry():
+    """The MetricRegistry values are currently recorded in"""
+    return _registry
+
+
+def incr(name, amount=1, **labels):
+    """
+    Add to a counter
+
+    :param name: counter name, ending in _total (see DESCRIPTIONS)
+    :param amount: how much to add
+    :param labels: label name -> value, ex endpoint='viewColaDetails.do'
+    """
+    if _enabled:
+        _registry.incr(name, amount, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration
+
+    :param name: timer name, ending in _seconds (see DESCRIPTIONS)
+    :param seconds: the duration
+    :param labels: label name -> value
+    """
+    if _enabled:
+        _registry.observe(name, seconds, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def timer(name, **labels):
+    """Time the body of a with statement, see observe"""
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+@contextmanager
+def collect():
+    """
+    Record into a fresh registry for the body of a with statement, regardless of enable()
+
+    Used by worker processes (which may have inherited the values of their parent) to send back only what they
+    recorded themselves: take its snapshot() and merge it into the parent's registry.
+
+    :return: the fresh MetricRegistry
+    """
+    global _enabled, _registry
+    old_enabled, old_registry = _enabled, _registry
+    _enabled, _registry = True, MetricRegistry()
+    try:
+        yield _registry
+    finally:
+        _enabled, _registry = old_enabled, old_registry
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels.items()) + list(extra)
+    if not items:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for key, value in items)
+    return '{' + ','.join(escaped) + '}'
+
+
+def prometheus_text(snapshot=None):
+    """
+    Render a snapshot in the Prometheus text exposition format
+
+    :param snapshot: from MetricRegistry.snapshot, defaults to the current registry
+    :return: str
+    """
+    snapshot = snapshot if snapshot is not None else _registry.snapshot()
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in DESCRIPTIONS:
+                lines.append('# HELP {name} {help}'.format(name=name, help=DESCRIPTIONS[name]))
+            lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+
+    for counter in snapshot['counters']:
+        header(counter['name'], 'counter')
+        lines.append('{name}{labels} {value}'.format(name=counter['name'], labels=_format_labels(counter['labels']),
+                                                     value=counter['value']))
+
+    for entry in snapshot['timers']:
+        name = entry['name']
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), entry['buckets']):
+            cumulative += count
+            lines.append('{name}_bucket{labels} {count}'.format(
+                name=name, labels=_format_labels(entry['labels'], [('le', bound)]), count=cumulative))
+        labels = _format_labels(entry['labels'])
+        lines.append('{name}_sum{labels} {total}'.format(name=name, labels=labels, total=entry['sum']))
+        lines.append('{name}_count{labels} {count}'.format(name=name, labels=labels, count=entry['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body, content_type = prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(_registry.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(object):
+
+    def __init__(self, port=9108, host=''):
+        """
+        Serves the registry at /metrics (Prometheus text format) and /metrics.json from a background thread
+
+        :param port: port to listen on
+        :param host: interface to listen on, all of them by default
+        """
+        self.httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class SnapshotWriter(object):
+
+    def __init__(self, path, interval=60.0):
+        """
+        Appends a JSON snapshot of the registry to a file every interval seconds (one json document per line)
+
+        :param path: file to append to
+        :param interval: seconds between snapshots, a last one is written on stop
+        """
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        """Append a snapshot now"""
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'time': time(), 'metrics': _registry.snapshot()}) + '\n')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    """ Main entry point of the app """
+
+    # print the Prometheus text of a saved snapshot (the last line of a SnapshotWriter file)
+    with open(sys.argv[1]) as f:
+        lines = [line for line in f if line.strip()]
+    print(prometheus_text(json.loads(lines[-1])['metrics']), end='')
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
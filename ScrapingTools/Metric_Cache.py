@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+TTB image metric cache (skips the metrics of label images we have already seen)
+"""
+
+
+import hashlib
+import json
+import sqlite3
+import threading
+from time import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from Instrumentation import incr
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# the perceptual hash is stored as four 16 bit bands, two hashes within 3 bits of each other share at least one band
+_BANDS = 4
+_BAND_BITS = 16
+
+
+def content_hash(img):
+    """
+    SHA-1 of the downloaded bytes of an image
+
+    TTB_Scraper.decode_image records it in img.info['sha1'], for images from elsewhere the decoded pixels are hashed.
+
+    :param img: PIL image
+    :return: hex digest
+    """
+    digest = img.info.get('sha1')
+    if digest is None:
+        digest = hashlib.sha1(img.mode.encode() + repr(img.size).encode() + img.tobytes()).hexdigest()
+    return digest
+
+
+def perceptual_hash(img, hash_size=8):
+    """
+    Difference hash (dHash) of an image, robust to re-encoding and resizing
+
+    The image is shrunk to (hash_size + 1) x hash_size grey pixels and each bit records whether a pixel is brighter
+    than its right neighbour.
+
+    :param img: PIL image
+    :return: 64 bit int for the default hash_size
+    """
+    grey = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (grey[:, 1:] > grey[:, :-1]).ravel()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def _bands(phash):
+    """Split a 64 bit perceptual hash into its 16 bit bands"""
+    mask = (1 << _BAND_BITS) - 1
+    return [(phash >> (i * _BAND_BITS)) & mask for i in range(_BANDS)]
+
+
+class MetricCache(object):
+
+    def __init__(self, path='metric_cache.sqlite', max_entries=1000000, near_duplicates=False, max_distance=3):
+        """
+        Stores the metrics calculated for each label image, keyed by a hash of its bytes
+
+        A label that appears on many COLAs (revisions, variants) is measured once. With near_duplicates the
+        perceptual hash of the thumbnail is also looked up, so re-encoded or rescaled copies of the same artwork hit
+        as well. Entries are stored in SQLite and the least recently used are evicted past max_entries.
+
+        :param path: SQLite file (created if missing)
+        :param max_entries: number of images kept
+        :param near_duplicates: also match images by perceptual hash
+        :param max_distance: bits the perceptual hashes of near duplicates may differ by (at most 3)
+        """
+        if max_distance >= _BANDS:
+            raise ValueError('max_distance must be below {}'.format(_BANDS))
+
+        self.path = path
+        self.max_entries = max_entries
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._stores = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)  # autocommit
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                           'sha1 TEXT, engine TEXT, phash INTEGER, band0 INTEGER, band1 INTEGER, band2 INTEGER, '
+                           'band3 INTEGER, colors TEXT, entropy REAL, img_format TEXT, last_used REAL, '
+                           'PRIMARY KEY (sha1, engine))')
+        for i in range(_BANDS):
+            self._conn.execute('CREATE INDEX IF NOT EXISTS metrics_band{i} ON metrics (band{i})'.format(i=i))
+        self._conn.execute('CREATE INDEX IF NOT EXISTS metrics_last_used ON metrics (last_used)')
+
+    @staticmethod
+    def _load(row):
+        """Row (colors, entropy, img_format) -> (df_color, sum_entropy, img_format)"""
+        df_color = pd.DataFrame(json.loads(row[0]), columns=['percentage', 'r', 'g', 'b'])
+        return df_color, row[1], row[2]
+
+    def _near(self, phash, engine):
+        """Row of the closest near duplicate, None if there is none"""
+        where = ' OR '.join('band{i} = ?'.format(i=i) for i in range(_BANDS))
+        rows = self._conn.execute('SELECT sha1, phash, colors, entropy, img_format FROM metrics '
+                                  'WHERE engine = ? AND ({})'.format(where), [engine] + _bands(phash)).fetchall()
+        best = None
+        for row in rows:
+            distance = bin((row[1] & (2 ** 64 - 1)) ^ phash).count('1')
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, row)
+        return best[1] if best is not None else None
+
+    @staticmethod
+    def key(img):
+        """
+        Hashes an image is looked up and stored under
+
+        Take the key before handing the image to CalcImgMetrics, which shrinks it in place.
+
+        :param img: PIL image
+        :return: (content hash, perceptual hash)
+        """
+        return content_hash(img), perceptual_hash(img)
+
+    def lookup(self, key, dom_color='kmeans'):
+        """
+        Metrics of an image seen before
+
+        :param key: from MetricCache.key
+        :param dom_color: dominant color engine the metrics were calculated with
+        :return: (df_color, sum_entropy, img_format), or None on a miss
+        """
+        sha1, phash = key
+        with self._lock:
+            row = self._conn.execute('SELECT colors, entropy, img_format FROM metrics WHERE sha1 = ? AND engine = ?',
+                                     (sha1, dom_color)).fetchone()
+            if row is not None:
+                self.hits += 1
+                incr('ttb_cache_requests_total', cache='metrics', result='hit')
+                self._conn.execute('UPDATE metrics SET last_used = ? WHERE sha1 = ? AND engine = ?',
+                                   (time(), sha1, dom_color))
+                return self._load(row)
+
+            if self.near_duplicates:
+                near = self._near(phash, dom_color)
+                if near is not None:
+                    self.near_hits += 1
+                    incr('ttb_cache_requests_total', cache='metrics', result='near_hit')
+                    self._conn.execute('UPDATE metrics SET last_used = ? WHERE sha1 = ? AND engine = ?',
+                                       (time(), near[0], dom_color))
+                    return self._load(near[2:])
+
+            self.misses += 1
+            incr('ttb_cache_requests_total', cache='metrics', result='miss')
+        return None
+
+    def store(self, key, df_color, sum_entropy, img_format, dom_color='kmeans'):
+        """
+        Remember the metrics of an image
+
+        :param key: from MetricCache.key
+        :param df_color: dominant color frame from CalcImgMetrics.calc_all_metrics
+        :param sum_entropy: total entropy
+        :param img_format: image format from CalcImgMetrics
+        :param dom_color: dominant color engine used
+        """
+        sha1, phash = key
+        colors = json.dumps(df_color[['percentage', 'r', 'g', 'b']].values.tolist())
+        signed = phash - 2 ** 64 if phash >= 2 ** 63 else phash  # SQLite integers are signed 64 bit
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [sha1, dom_color, signed] + _bands(phash) +
+                               [colors, float(sum_entropy), img_format, time()])
+            self._stores += 1
+            if self._stores % 1000 == 0:
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries past max_entries"""
+        count = self._conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute('DELETE FROM metrics WHERE rowid IN '
+                               '(SELECT rowid FROM metrics ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+
+    def hit_rate(self):
+        """Fraction of lookups that were answered from the cache (exact or near duplicate)"""
+        lookups = self.hits + self.near_hits + self.misses
+        return (self.hits + self.near_hits) / lookups if lookups else 0.0
+
+    def summary(self):
+        return 'metric cache: {hits} hits, {near} near duplicate hits, {misses} misses ({rate:.1%} hit rate)'.format(
+            hits=self.hits, near=self.near_hits, misses=self.misses, rate=self.hit_rate())
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.close()
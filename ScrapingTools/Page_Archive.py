@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+TTB raw page archive
+
+Keeps the html of every form, label and search page we download, so the dataset can be re-derived with a better
+parser without crawling the site again (see reparse_archive).
+"""
+
+
+import json
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+try:
+    import fcntl  # POSIX only, archives are not locked elsewhere
+except ImportError:
+    fcntl = None
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# kind of page -> code stored in the record header
+KINDS = {'form': 1, 'images': 2, 'search': 3}
+_KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+# record header: magic, kind, key length, compressed length, page length, crc32 of the compressed bytes
+_HEADER = struct.Struct('<4sBHIII')
+_MAGIC = b'TTBP'
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _segment_name(number):
+    return 'segment-{:06d}.pages'.format(number)
+
+
+def read_record(f, offset):
+    """
+    Read the record stored at offset of an open segment file
+
+    :return: (kind, key, html), None past the last complete record
+    """
+    f.seek(offset)
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    magic, kind, key_length, length, raw_length, crc = _HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ArchiveError('No record at offset {}'.format(offset))
+
+    key = f.read(key_length)
+    body = f.read(length)
+    if len(key) < key_length or len(body) < length:
+        return None  # cut off (the process died while appending)
+    if zlib.crc32(body) != crc:
+        raise ArchiveError('Corrupt record at offset {}'.format(offset))
+    return _KIND_NAMES[kind], key.decode('utf-8'), zlib.decompress(body).decode('utf-8')
+
+
+class PageArchive(object):
+
+    def __init__(self, directory, segment_bytes=2 ** 28, compress_level=6, commit_every=1000):
+        """
+        Append-only store of raw pages, compressed and split over numbered segment files
+
+        Every page is a self describing record (header, key, zlib compressed html) appended to the current segment,
+        a new segment is started once it reaches segment_bytes. An SQLite index maps (kind, key) to the segment and
+        offset of the latest copy of each page. Index updates are committed in batches; records appended after the
+        last commit are indexed again from the segments when the archive is next opened, so a crash loses nothing
+        but the record that was being written.
+
+        Only one process may have an archive open at a time (an exclusive lock is held on <directory>/archive.lock
+        until close), since each would append to the same segment and truncate the other's records on recovery.
+
+        :param directory: folder of the archive (created if missing)
+        :param segment_bytes: size a segment grows to before the next one is started
+        :param compress_level: zlib compression level
+        :param commit_every: index updates between commits
+        :raises ArchiveError: if another process has the archive open
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compress_level = compress_level
+        self.commit_every = commit_every
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock_file = open(os.path.join(directory, 'archive.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise ArchiveError('{} is open in another process'.format(directory))
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages (kind TEXT, key TEXT, segment INTEGER, '
+                           'offset INTEGER, stored REAL, PRIMARY KEY (kind, key)) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state (segment INTEGER, offset INTEGER)')  # indexed up to
+        self._conn.commit()
+        self._uncommitted = 0
+
+        self._segment, self._file = None, None
+        self._recover()
+
+    def _segments(self):
+        """Numbers of the segment files on disk, in order"""
+        return sorted(int(name[8:14]) for name in os.listdir(self.directory)
+                      if name.startswith('segment-') and name.endswith('.pages'))
+
+    def _recover(self):
+        """Index the records appended after the last commit and drop a record cut off by a crash"""
+        row = self._conn.execute('SELECT segment, offset FROM state').fetchone()
+        segment, offset = row if row is not None else (0, 0)
+
+        for number in [n for n in self._segments() if n >= segment]:
+            path = os.path.join(self.directory, _segment_name(number))
+            position = offset if number == segment else 0
+            with open(path, 'rb') as f:
+                while True:
+                    try:
+                        record = read_record(f, position)
+                    except ArchiveError:
+                        record = None
+                    if record is None:
+                        break
+                    kind, key, _ = record
+                    self._index(kind, key, number, position)
+                    position = f.tell()
+            if position < os.path.getsize(path):
+                logging.getLogger(__name__).warning('Truncating {path} at {position}'.format(path=path,
+                                                                                              position=position))
+                with open(path, 'r+b') as f:
+                    f.truncate(position)
+            segment, offset = number, position
+
+        self._open_segment(segment)
+        self.commit()
+
+    def _open_segment(self, number):
+        if self._file is not None:
+            self._file.close()
+        self._segment = number
+        self._file = open(os.path.join(self.directory, _segment_name(number)), 'ab')
+
+    def _index(self, kind, key, segment, offset):
+        self._conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)', (kind, key, segment, offset, time()))
+        self._uncommitted += 1
+
+    def put(self, kind, key, html):
+        """
+        Append a page, replacing any earlier copy with the same kind and key
+
+        :param kind: 'form', 'images' or 'search'
+        :param key: TTBID for form and images pages, see search_key for search pages
+        :param html: the page as str
+        """
+        data = html.encode('utf-8')
+        body = zlib.compress(data, self.compress_level)
+        key_bytes = str(key).encode('utf-8')
+        record = _HEADER.pack(_MAGIC, KINDS[kind], len(key_bytes), len(body), len(data), zlib.crc32(body))
+
+        with self._lock:
+            if self._file.tell() >= self.segment_bytes:
+                self._file.flush()
+                self._open_segment(self._segment + 1)
+            offset = self._file.tell()
+            self._file.write(record + key_bytes + body)
+            self._index(kind, str(key), self._segment, offset)
+            if self._uncommitted >= self.commit_every:
+                self.commit()
+
+    def commit(self):
+        """Flush the current segment and commit the index"""
+        with self._lock:
+            self._file.flush()
+            self._conn.execute('DELETE FROM state')
+            self._conn.execute('INSERT INTO state VALUES (?, ?)', (self._segment, self._file.tell()))
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def contains(self, kind, key):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM pages WHERE kind = ? AND key = ?', (kind, str(key))).fetchone()
+        return row is not None
+
+    def get(self, kind, key):
+        """The latest copy of a page, None if it was never archived"""
+        with self._lock:
+            row = self._conn.execute('SELECT segment, offset FROM pages WHERE kind = ? AND key = ?',
+                                     (kind, str(key))).fetchone()
+            if row is None:
+                return None
+            if row[0] == self._segment:
+                self._file.flush()
+        with open(os.path.join(self.directory, _segment_name(row[0])), 'rb') as f:
+            return read_record(f, row[1])[2]
+
+    def locations(self, kind):
+        """
+        Where the latest copy of every page of a kind is stored
+
+        :return: dict of segment path -> sorted list of (offset, key)
+        """
+        with self._lock:
+            self.commit()
+            rows = self._conn.execute('SELECT segment, offset, key FROM pages WHERE kind = ? ORDER BY segment, offset',
+                                      (kind,)).fetchall()
+        found = {}
+        for segment, offset, key in rows:
+            found.setdefault(os.path.join(self.directory, _segment_name(segment)), []).append((offset, key))
+        return found
+
+    def count(self, kind=None):
+        with self._lock:
+            if kind is None:
+                return self._conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            return self._conn.execute('SELECT COUNT(*) FROM pages WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._file.close()
+            self._conn.close()
+            self._lock_file.close()  # releases the lock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def search_key(payload, page):
+    """Archive key of a page of search results: the search criteria and how many pages in it is"""
+    return json.dumps([payload, page], sort_keys=True)
+
+
+_default_archive = None
+
+
+def get_page_archive():
+    """The archive the scrapers write to by default, None if pages are not archived"""
+    return _default_archive
+
+
+def set_page_archive(archive):
+    """Archive every page the scrapers download to archive (a PageArchive, or None to stop)"""
+    global _default_archive
+    _default_archive = archive
+
+
+def _reparse_chunk(kind, path, entries, backend):
+    """Worker side of reparse_archive: read and parse some records of one segment"""
+    from Form_Parser import FORM_PARSER
+    from Html_Parsing import parse_page
+    from TTB_crawler import TTB_query
+
+    results = []
+    with open(path, 'rb') as f:
+        for offset, key in entries:
+            html = read_record(f, offset)[2]
+            if kind == 'form':
+                results.append((key, FORM_PARSER.parse(html, backend)))
+            else:
+                results.append((key, TTB_query.from_soup(parse_page(html, 'search', backend)).get_table_data()))
+    return results
+
+
+def _reparse_chunks(executor, archive, kind, chunk_size, backend, max_pending):
+    """Results of _reparse_chunk for every page of a kind, in order, with at most max_pending chunks queued"""
+    pending = []
+    for path, entries in archive.locations(kind).items():
+        for i in range(0, len(entries), chunk_size):
+            pending.append(executor.submit(_reparse_chunk, kind, path, entries[i:i + chunk_size], backend))
+            if len(pending) > max_pending:
+                yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def reparse_archive(archive, writer, kinds=('form',), workers=None, chunk_size=512, backend=None, logger=None):
+    """
+    Run the current parsers over every archived page and write the records to a sink
+
+    Forms go to the TTB collection (as form records, see Sequential_Crawl.form_record) and the rows of search pages
+    to the SEARCH collection. Segments are read sequentially, in chunks spread over a process pool, with a couple of
+    chunks per worker in flight at a time.
+
+    :param archive: PageArchive
+    :param writer: sink with the BulkWriter interface (see Sequential_Crawl.open_writer)
+    :param kinds: which kinds of pages to parse, 'form' and/or 'search'
+    :param workers: number of processes, defaults to the number of cores
+    :param chunk_size: records parsed per task
+    :param backend: Html_Parsing backend
+    :param logger: logger, defaults to this module's logger
+    :return: dict of kind -> records written
+    """
+    from tqdm import tqdm
+    from Sequential_Crawl import form_record
+
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    workers = workers or os.cpu_count()
+    written = {}
+
+    with ProcessPoolExecutor(workers) as executor:
+        for kind in kinds:
+            if kind not in ('form', 'search'):
+                raise ValueError('Can not reparse {} pages'.format(kind))
+
+            written[kind] = 0
+            progress = tqdm(total=archive.count(kind), desc=kind)
+            for chunk in _reparse_chunks(executor, archive, kind, chunk_size, backend, 2 * workers):
+                for key, parsed in chunk:
+                    if kind == 'form':
+                        if parsed:
+                            writer.add('TTB', form_record(key, parsed))
+                            written[kind] += 1
+                        else:
+                            logger.info('No form in archived page:  {}'.format(key))
+                    else:
+                        for row in parsed:
+                            writer.add('SEARCH', row)
+                            written[kind] += 1
+                progress.update(len(chunk))
+            progress.close()
+            writer.flush()
+
+    return written
+
+
+def main():
+    """ Main entry point of the app """
+
+    # print what an archive holds, ex python Page_Archive.py page_archive
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'page_archive'
+    with PageArchive(directory) as archive:
+        for kind in KINDS:
+            print('{kind}: {n} pages'.format(kind=kind, n=archive.count(kind)))
+        size = sum(os.path.getsize(os.path.join(directory, _segment_name(n))) for n in archive._segments())
+        print('{mb:.1f} MB in {n} segments'.format(mb=size / 2 ** 20, n=len(archive._segments())))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+TTB on-disk response cache
+"""
+
+
+import hashlib
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from time import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from Instrumentation import incr
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    """An offline cache has no entry for a request (a RequestException, so it fails like a request that was sent)"""
+    pass
+
+
+class ResponseCache(object):
+
+    def __init__(self, directory, ttl=None, max_bytes=2 ** 30, offline=False, compress_level=6):
+        """
+        Compressed, content addressed cache of HTTP responses
+
+        Entries are keyed by what was asked for (ex the action and ttbid, or a search payload and page number)
+        rather than the raw url, since some TTB urls (paging) return different pages depending on the session.
+
+        :param directory: folder the entries are stored in
+        :param ttl: seconds an entry stays fresh, None to keep entries forever. Stale entries with an ETag or
+                    Last-Modified header are revalidated with a conditional request
+        :param max_bytes: size limit of the cache on disk, the least recently used entries are evicted
+        :param offline: replay only, never touch the network. Misses raise CacheMiss
+        :param compress_level: zlib compression level for the stored bodies
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.compress_level = compress_level
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> size on disk, least recently used first
+        self._total_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        """Index the entries already on disk, oldest access first"""
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.z'):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, name[:-2], stat.st_size))
+
+        for _, digest, size in sorted(found):
+            self._entries[digest] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def make_digest(cache_key):
+        """Hash a cache key (any json serializable value) into the name of its entry"""
+        return hashlib.sha256(json.dumps(cache_key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.z')
+
+    def contains(self, cache_key):
+        """True if there is an entry (fresh or not) for cache_key"""
+        with self._lock:
+            return self.make_digest(cache_key) in self._entries
+
+    def _load(self, digest):
+        """Read an entry, returns (meta, body) or None"""
+        try:
+            with open(self._path(digest), 'rb') as f:
+                raw = zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            return None
+
+        header, body = raw.split(b'\n', 1)
+        return json.loads(header.decode('utf-8')), body
+
+    def _store(self, digest, meta, body):
+        """Write an entry atomically and evict old entries if we are over the size limit"""
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = zlib.compress(json.dumps(meta).encode('utf-8') + b'\n' + body, self.compress_level)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(digest, 0)
+            self._entries[digest] = len(data)
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until we fit in max_bytes (lock must be held)"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            digest, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+    def _touch(self, digest):
+        """Mark an entry as recently used"""
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+        try:
+            os.utime(self._path(digest))
+        except OSError:
+            pass
+
+    def _is_fresh(self, meta):
+        return self.ttl is None or time() - meta['stored'] < self.ttl
+
+    @staticmethod
+    def _to_response(meta, body):
+        """Rebuild a requests Response from a cache entry"""
+        response = requests.models.Response()
+        response.status_code = meta['status_code']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = meta['encoding']
+        response.url = meta['url']
+        response._content = body
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def request(self, send, method, url, cache_key, refresh=False, **kwargs):
+        """
+        Serve a request from the cache, falling back on send
+
+        :param send: function with the signature of requests.Session.request that hits the network
+        :param cache_key: json serializable description of the request, see __init__
+        :param refresh: ignore any stored entry and fetch (and store) a new copy
+        :return: requests Response, with from_cache set to True if no request was sent
+        :raises CacheMiss: offline and there is no entry for cache_key
+        """
+        digest = self.make_digest(cache_key)
+        entry = None if refresh else self._load(digest)
+
+        if entry is not None and (self.offline or self._is_fresh(entry[0])):
+            self.hits += 1
+            incr('ttb_cache_requests_total', cache='http', result='hit')
+            self._touch(digest)
+            return self._to_response(*entry)
+
+        self.misses += 1
+        incr('ttb_cache_requests_total', cache='http', result='miss')
+        if self.offline:
+            raise CacheMiss('Not in cache: {} {}'.format(method, url))
+
+        # revalidate stale entries when the server gave us something to validate with
+        if entry is not None:
+            validators = CaseInsensitiveDict(entry[0]['headers'])
+            headers = dict(kwargs.pop('headers', None) or {})
+            if validators.get('ETag'):
+                headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified'):
+                headers['If-Modified-Since'] = validators['Last-Modified']
+            kwargs['headers'] = headers
+
+        response = send(method, url, **kwargs)
+        response.from_cache = False
+
+        if response.status_code == 304 and entry is not None:
+            meta, body = entry
+            meta['stored'] = time()
+            self._store(digest, meta, body)
+            return self._to_response(meta, body)
+
+        if response.status_code == 200:
+            meta = {'status_code': response.status_code,
+                    'headers': dict(response.headers),
+                    'encoding': response.encoding,
+                    'url': response.url,
+                    'stored': time()}
+            self._store(digest, meta, response.content)
+
+        return response
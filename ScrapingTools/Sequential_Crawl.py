@@ -3,32 +3,140 @@
 TTB Webscraping
 """
 
+import asyncio
 import datetime
 import warnings
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 import re
 import pymongo
-import pandas as pd
+import requests
 
 from tqdm import tqdm
 
 from TTB_scraping import TTB_Scraper
-from Image_Processing import CalcImgMetrics
+from TTB_crawler import TTB_crawler, all_origin_codes
+from Image_Pipeline import ImagePipeline
+from Bulk_Writer import BulkWriter
+from Columnar_Sink import ColumnarSink, TeeSink
 
 __author__ = "Jonathan Hirokawa"
 __version__ = "0.1.0"
 __license__ = "MIT"
 
 
-def sequential(start_date, stop_date, skip_tol=3):
+def make_ttbid(curr_date, curr_reccode, curr_seqnum):
+    """
+    Build a TTBID from its parts
+
+    :param curr_date: datetime of the date the application was received
+    :param curr_reccode: receive code as an int (ex 1 for e-filed)
+    :param curr_seqnum: sequence number as an int
+    :return: 14 digit TTBID string
+    """
+    jdate = '{year}{day}'.format(year=curr_date.strftime('%y'), day=curr_date.strftime('%j'))
+    reccode = '{:03d}'.format(curr_reccode)
+    seqnum = '{:06d}'.format(curr_seqnum)
+
+    return '{jdate}{reccode}{seqnum}'.format(jdate=jdate, reccode=reccode, seqnum=seqnum)
+
+
+def form_record(ttbid, parsed_data):
+    """
+    Combine the parsed form with the query information encoded in its TTBID
+
+    :param ttbid: 14 digit TTBID string
+    :param parsed_data: dict returned by TTB_Scraper.get_basic_form_data
+    :return: dict ready to be inserted into the TTB collection
+    """
+    curr_date = datetime.datetime.strptime(ttbid[:5], '%y%j')
+    query_data = {'_id': ttbid,
+                  'recieve_date': curr_date.strftime('%m/%d/%Y'),
+                  'recieve_code': ttbid[5:8],
+                  'seq_num': ttbid[8:]}
+
+    # concatenated data we will add to our database
+    return {**query_data, **parsed_data}
+
+
+def fetch_form(ttbid, frontier=None):
+    """
+    Download and parse a form, without touching the network for TTBIDs the frontier knows to be empty
+
+    :return: the parsed form, None if the TTBID has no form
+    :raises requests.RequestException: the page could not be fetched, so whether the TTBID has a form is unknown
+    """
+    if frontier is not None and frontier.is_known_empty(ttbid):
+        return None
+    return TTB_Scraper(ttbid).get_basic_form_data()
+
+
+def sequence_start(curr_date, curr_reccode, frontier=None):
+    """
+    Where to start probing a sequence
+
+    :return: (first seqnum to probe, retry_count, complete)
+    """
+    if frontier is None:
+        return 1, 0, False
+    last_seqnum, retry_count, complete = frontier.sequence_state(make_ttbid(curr_date, curr_reccode, 0))
+    return last_seqnum + 1, retry_count, complete
+
+
+def open_writer(logger, parquet_dir=None, mongo=True):
+    """
+    Open the sink scraped records are written to
+
+    :param logger: logger for write errors
+    :param parquet_dir: append Parquet files partitioned by date under this directory (see Columnar_Sink.ColumnarSink,
+                        Columnar_Sink.read_collection reads them back)
+    :param mongo: write to the TTB database of the local MongoDB (buffered upserts, see Bulk_Writer.BulkWriter)
+    :return: a BulkWriter, ColumnarSink, or a TeeSink writing to both
+    """
+    sinks = []
+    if mongo:
+        # Set up connection to mongodb
+        client = pymongo.MongoClient()  # Connect to default client
+        db = client.TTB  # Get a database (note: lazy evaluation)
+        sinks.append(BulkWriter(db, logger=logger))
+    if parquet_dir is not None:
+        sinks.append(ColumnarSink(parquet_dir, logger=logger))
+    if not sinks:
+        raise ValueError('No output, set mongo or give a parquet_dir')
+
+    writer = sinks[0] if len(sinks) == 1 else TeeSink(*sinks)
+    writer.ensure_indexes()
+    return writer
+
+
+def store_form(writer, output, logger):
+    """
+    Queue a single form record for the TTB collection
+
+    MongoDB replaces a record already present, a Parquet sink appends another copy (see
+    Columnar_Sink.read_collection).
+    """
+    writer.add('TTB', output)
+    logger.info('Successfully added:  {ttbid}'.format(ttbid=output['_id']))
+
+
+def checkpoint_probe(writer, frontier, ttbid, found, retry_count, complete):
+    """Record a probe in the frontier once everything before it has reached the database"""
+    if frontier is not None:
+        writer.on_flush(lambda: frontier.record_probe(ttbid, found, retry_count, complete=complete))
+
+
+def sequential(start_date, stop_date, skip_tol=3, frontier=None, parquet_dir=None, mongo=True):
     """
     Gather data from TTB sequentially using start and stop dates
 
     :param start_date:  start date for sequential scraping in format '01/24/2016'
     :param stop_date:  end date for sequential scraping in format '02/25/2017'
     :param skip_tol:  how many skips to tolerate before moving to the next date
+    :param frontier:  optional CrawlFrontier, progress is checkpointed to it and a restarted crawl resumes from it
+    :param parquet_dir:  also write the records to Parquet files under this directory (see open_writer)
+    :param mongo:  write the records to MongoDB
     :return:
     """
     #f = open('logfile_{start}-{stop}.txt'.format(start=start_date, stop=stop_date), 'w')
@@ -38,15 +146,21 @@ def sequential(start_date, stop_date, skip_tol=3):
     logger.setLevel(logging.DEBUG)  # we now set the logging level to debug for our module
 
 
-    # Set up connection to mongodb
-    client = pymongo.MongoClient()  # Connect to default client
-    db = client.TTB  # Get a database (note: lazy evaluation)
-    TTB = db.TTB  # the actual collection
+    writer = open_writer(logger, parquet_dir, mongo)  # buffered writes to the TTB collection
 
     # convert dates to datetime format
     date_start = datetime.datetime.strptime(start_date, '%m/%d/%Y')
     date_stop = datetime.datetime.strptime(stop_date, '%m/%d/%Y')
 
+    with writer:
+        _sequential(date_start, date_stop, skip_tol, writer, logger, frontier)
+
+    #f.close()
+
+
+def _sequential(date_start, date_stop, skip_tol, writer, logger, frontier=None):
+    """Probe every sequence one TTBID at a time (see sequential)"""
+
     # iterate over each date
     curr_date = date_start
     while curr_date < date_stop:
@@ -54,125 +168,554 @@ def sequential(start_date, stop_date, skip_tol=3):
         # iterate over each recieve code
         curr_reccode = 0
         while curr_reccode <= skip_tol:
+            probe_sequence(curr_date, curr_reccode, skip_tol, writer, logger, frontier)
+            curr_reccode += 1
+        curr_date += datetime.timedelta(days=1)
+
+
+def probe_sequence(curr_date, curr_reccode, skip_tol, writer, logger, frontier=None):
+    """
+    Probe a single (date, receive code) sequence one TTBID at a time until skip_tol misses in a row
+
+    A TTBID whose page could not be fetched is neither a hit nor a miss, so the sequence is abandoned there, before its
+    checkpoint, and a run resuming from the frontier probes it again.
+
+    :return: True if the sequence was finished, False if it was abandoned
+    """
 
-            # increment each sequence
-            cont_seq = True
-            curr_seqnum = 1
+    # increment each sequence (picking up where an earlier run left off)
+    curr_seqnum, retry_count, complete = sequence_start(curr_date, curr_reccode, frontier)
+    cont_seq = not complete
+    while cont_seq:
+        # prep the query
+        ttbid = make_ttbid(curr_date, curr_reccode, curr_seqnum)
+
+        try:
+            parsed_data = fetch_form(ttbid, frontier)
+        except requests.RequestException as e:
+            logger.error('Could not fetch {ttbid}, leaving the rest of its sequence ({err})'.format(
+                ttbid=ttbid, err=e))
+            return False
+
+        # if we got a valid response
+        if parsed_data:
+            curr_seqnum += 1
             retry_count = 0
-            while cont_seq:
-                # prep the strings for the ttbid
-                jdate = '{year}{day}'.format(year=curr_date.strftime('%y'), day=curr_date.strftime('%j'))
-                reccode = '{:03d}'.format(curr_reccode)
-                seqnum = '{:06d}'.format(curr_seqnum)
-
-                # prep the query
-                ttbid = '{jdate}{reccode}{seqnum}'.format(jdate=jdate, reccode=reccode, seqnum=seqnum)
-
-                query = TTB_Scraper(ttbid)
-                parsed_data = query.get_basic_form_data()
-
-                # if we got a valid response
-                if parsed_data:
-                    query_data = {'_id': ttbid,
-                                  'recieve_date': curr_date.strftime('%m/%d/%Y'),
-                                  'recieve_code': reccode,
-                                  'seq_num': seqnum}
-
-                    # concatenated data we will add to our database
-                    output = {**query_data, **parsed_data}
-
-                    curr_seqnum += 1
-                    retry_count = 0
-                    # Insert result into database
-                    try:
-                        TTB.insert_one(output)
-                        # print('Successfully added: {}'.format(ttbid))
-                        #f.write('{},1\n'.format(ttbid))
-                        logger.info('Successfully added:  {ttbid}'.format(ttbid=ttbid))
-                    except pymongo.errors.DuplicateKeyError:
-                        #warnings.warn('_id: {ttbid} is already in database, skipping...'.format(ttbid=ttbid))
-                        logger.warning('TTBID already in database, skipping:  {ttbid}'.format(ttbid=ttbid))
+            # Insert result into database
+            store_form(writer, form_record(ttbid, parsed_data), logger)
+        else:
+            # stick with this sequence
+            if retry_count < skip_tol:
+                curr_seqnum += 1
+                retry_count += 1
+            else:
+                cont_seq = False
+            #f.write('{},0\n'.format(ttbid))
+            logger.info('No data found for:  {ttbid}'.format(ttbid=ttbid))
+
+        checkpoint_probe(writer, frontier, ttbid, bool(parsed_data), retry_count, not cont_seq)
+    return True
+
+
+async def _probe_sequence(curr_date, curr_reccode, skip_tol, window, fetch, write, writer, logger, frontier=None):
+    """
+    Walk a single (date, receive code) sequence, keeping up to window probes ahead of the current one
+
+    Results are consumed strictly in sequence order so the skip_tol rule behaves exactly as in sequential; any
+    speculative probes past the end of the sequence are cancelled (or their results discarded).
+
+    :param fetch: coroutine function taking a ttbid and returning the parsed form (or None)
+    :param write: coroutine function write(func, *args) running func off the event loop, so a flush of the writer
+                  doesn't hold up the other sequences
+    :param frontier: optional CrawlFrontier to resume from and checkpoint to
+    :return: True if the sequence was finished, False if it was abandoned at a page that could not be fetched (see
+             probe_sequence)
+    """
+    pending = {}  # seqnum -> future for every probe that has been launched but not consumed
+    curr_seqnum, retry_count, complete = sequence_start(curr_date, curr_reccode, frontier)
+    next_seqnum = curr_seqnum
+
+    try:
+        while not complete:
+            # keep the speculative window full
+            while len(pending) < window:
+                pending[next_seqnum] = asyncio.ensure_future(fetch(make_ttbid(curr_date, curr_reccode, next_seqnum)))
+                next_seqnum += 1
+
+            ttbid = make_ttbid(curr_date, curr_reccode, curr_seqnum)
+            try:
+                parsed_data = await pending.pop(curr_seqnum)
+            except requests.RequestException as e:
+                logger.error('Could not fetch {ttbid}, leaving the rest of its sequence ({err})'.format(
+                    ttbid=ttbid, err=e))
+                return False
+
+            if parsed_data:
+                retry_count = 0
+                await write(store_form, writer, form_record(ttbid, parsed_data), logger)
+            else:
+                logger.info('No data found for:  {ttbid}'.format(ttbid=ttbid))
+                if retry_count < skip_tol:
+                    retry_count += 1
                 else:
-                    # stick with this sequence
-                    if retry_count < skip_tol:
-                        curr_seqnum += 1
-                        retry_count += 1
-                    else:
-                        cont_seq = False
-                    #f.write('{},0\n'.format(ttbid))
-                    logger.info('No data found for:  {ttbid}'.format(ttbid=ttbid))
-
-                sleep(0.1)
-            curr_reccode += 1
+                    complete = True
+
+            await write(checkpoint_probe, writer, frontier, ttbid, bool(parsed_data), retry_count, complete)
+            curr_seqnum += 1
+        return True
+    finally:
+        for future in pending.values():
+            future.cancel()
+
+
+async def _sequential_async(date_start, date_stop, skip_tol, max_in_flight, window, writer, logger, frontier=None):
+    """Run every (date, receive code) sequence concurrently, sharing a bound on the requests in flight"""
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    write_executor = ThreadPoolExecutor(max_workers=1)  # one thread, so records and checkpoints stay in order
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def fetch(ttbid):
+        async with in_flight:
+            return await loop.run_in_executor(executor, fetch_form, ttbid, frontier)
+
+    async def write(func, *args):
+        return await loop.run_in_executor(write_executor, func, *args)
+
+    sequences = []
+    curr_date = date_start
+    while curr_date < date_stop:
+        for curr_reccode in range(skip_tol + 1):
+            sequences.append(_probe_sequence(curr_date, curr_reccode, skip_tol, window, fetch, write, writer, logger,
+                                             frontier))
         curr_date += datetime.timedelta(days=1)
 
-    #f.close()
+    try:
+        await asyncio.gather(*sequences)
+    finally:
+        executor.shutdown(wait=True)
+        write_executor.shutdown(wait=True)
 
 
-def image_scrape(ttbid_list):
+def sequential_async(start_date, stop_date, skip_tol=3, max_in_flight=16, window=4, frontier=None, parquet_dir=None,
+                     mongo=True):
+    """
+    Gather data from TTB sequentially using start and stop dates, with many requests in flight at once
+
+    Every date and receive code is probed concurrently, and within a sequence up to window sequence numbers are
+    requested ahead of the one being processed. The records stored are the same as for sequential.
+
+    :param start_date:  start date for sequential scraping in format '01/24/2016'
+    :param stop_date:  end date for sequential scraping in format '02/25/2017'
+    :param skip_tol:  how many skips to tolerate before moving to the next date
+    :param max_in_flight:  maximum number of requests outstanding across all sequences
+    :param window:  how many sequence numbers to probe speculatively within each sequence
+    :param frontier:  optional CrawlFrontier, progress is checkpointed to it and a restarted crawl resumes from it
+    :param parquet_dir:  also write the records to Parquet files under this directory (see open_writer)
+    :param mongo:  write the records to MongoDB
+    :return:
+    """
+    logging.basicConfig(filename='Form_Scrape {}.log'.format(datetime.datetime.now()), level=logging.ERROR)
+    logger = logging.getLogger(__name__)  # having set the logging level to error for all modules
+    logger.setLevel(logging.DEBUG)  # we now set the logging level to debug for our module
+
+    writer = open_writer(logger, parquet_dir, mongo)  # buffered writes to the TTB collection
+
+    # convert dates to datetime format
+    date_start = datetime.datetime.strptime(start_date, '%m/%d/%Y')
+    date_stop = datetime.datetime.strptime(stop_date, '%m/%d/%Y')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with writer:
+            loop.run_until_complete(_sequential_async(date_start, date_stop, skip_tol, max_in_flight, window,
+                                                      writer, logger, frontier))
+    finally:
+        loop.close()
+
+
+def discover_ttbids(start_date, stop_date, origin_codes=None, workers=4):
+    """
+    List every TTBID approved in a date range using the advanced search (instead of guessing sequence numbers)
+
+    Note that the search filters on the approval date, whereas sequential walks the date the application was received.
+
+    :param start_date:  first approval date in format '01/24/2016'
+    :param stop_date:  last approval date in format '02/25/2017'
+    :param origin_codes:  origin codes to search, defaults to every origin (pass US_ORIGIN_CODES for the US states)
+    :param workers:  number of searches run at the same time
+    :return: sorted list of TTBID strings
+    """
+    origin_codes = origin_codes if origin_codes is not None else all_origin_codes()
+    ttbids = TTB_crawler.crawl(start_date, stop_date, origin_codes, workers=workers, ids_only=True)
+    return sorted(set(ttbids))
+
+
+def scrape_forms(ttbid_list, max_in_flight=16, parquet_dir=None, mongo=True):
+    """
+    Download and store the form of every TTBID in a list
+
+    :param ttbid_list:  TTBIDs known to exist (ex from discover_ttbids)
+    :param max_in_flight:  number of forms downloaded at the same time
+    :param parquet_dir:  also write the records to Parquet files under this directory (see open_writer)
+    :param mongo:  write the records to MongoDB
+    :return: the TTBIDs whose pages could not be fetched (run them again later)
+    """
+    logging.basicConfig(filename='Form_Scrape {}.log'.format(datetime.datetime.now()), level=logging.ERROR)
+    logger = logging.getLogger(__name__)  # having set the logging level to error for all modules
+    logger.setLevel(logging.DEBUG)  # we now set the logging level to debug for our module
+
+    writer = open_writer(logger, parquet_dir, mongo)  # buffered writes to the TTB collection
+
+    with writer:
+        failed = _scrape_forms(ttbid_list, max_in_flight, writer, logger)
+    if failed:
+        print('Forms that could not be fetched:  {}'.format(len(failed)))
+    return failed
+
+
+def _scrape_forms(ttbid_list, max_in_flight, writer, logger):
+    """
+    Download the forms of a list of TTBIDs and queue them for the TTB collection (see scrape_forms)
+
+    :return: the TTBIDs whose pages could not be fetched
+    """
+    ttbid_list = [str(ttbid) for ttbid in ttbid_list]
+    failed = []
+
+    def fetch(ttbid):
+        try:
+            return fetch_form(ttbid), None
+        except requests.RequestException as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for ttbid, (parsed_data, error) in tqdm(zip(ttbid_list, executor.map(fetch, ttbid_list)),
+                                                total=len(ttbid_list)):
+            if error is not None:
+                failed.append(ttbid)
+                logger.error('Could not fetch {ttbid} ({err})'.format(ttbid=ttbid, err=error))
+            elif parsed_data:
+                store_form(writer, form_record(ttbid, parsed_data), logger)
+            else:
+                logger.warning('No data found for:  {ttbid}'.format(ttbid=ttbid))
+    return failed
+
+
+def search_driven(start_date, stop_date, origin_codes=None, workers=4, max_in_flight=16, images=True, frontier=None,
+                  parquet_dir=None, mongo=True):
+    """
+    Gather the forms (and optionally image metrics) of every COLA approved in a date range
+
+    Only TTBIDs that the search reports are requested, so no requests are wasted on ids that don't exist.
+
+    :param start_date:  first approval date in format '01/24/2016'
+    :param stop_date:  last approval date in format '02/25/2017'
+    :param origin_codes:  origin codes to search, defaults to every origin (see discover_ttbids)
+    :param workers:  number of searches run at the same time
+    :param max_in_flight:  number of forms downloaded at the same time
+    :param images:  also calculate the image metrics
+    :param frontier:  optional CrawlFrontier passed on to image_scrape
+    :param parquet_dir:  also write the records to Parquet files under this directory (see open_writer)
+    :param mongo:  write the records to MongoDB
+    :return: the TTBIDs found
+    """
+    ttbids = discover_ttbids(start_date, stop_date, origin_codes, workers)
+    print('TTBIDs found:  {}'.format(len(ttbids)))
+
+    scrape_forms(ttbids, max_in_flight, parquet_dir=parquet_dir, mongo=mongo)
+    if images:
+        image_scrape(ttbids, frontier, parquet_dir=parquet_dir, mongo=mongo)
+
+    return ttbids
+
+
+def stored_ttbids(ttbids, collection, field, parquet_dir=None, mongo=True, batch_size=1000):
+    """
+    Which TTBIDs already have records in a collection, looked up in bulk
+
+    :param ttbids: TTBID strings
+    :param collection: 'TTB' (TTBID in '_id') or an image collection such as 'IMG_SUP' (TTBID in 'TTBID')
+    :param field: field holding the TTBID
+    :param parquet_dir: look in this Parquet dataset (see Columnar_Sink.stored_values)
+    :param mongo: look in the TTB database of the local MongoDB
+    :param batch_size: TTBIDs per query
+    :return: set of TTBID strings
+    """
+    ttbids = [str(ttbid) for ttbid in ttbids]
+    found = set()
+    if mongo:
+        db = pymongo.MongoClient().TTB
+        for i in range(0, len(ttbids), batch_size):
+            batch = ttbids[i:i + batch_size]
+            found.update(doc[field] for doc in db[collection].find({field: {'$in': batch}}, {field: 1}))
+    if parquet_dir is not None:
+        from Columnar_Sink import stored_values
+        found.update(stored_values(parquet_dir, collection, field, ttbids))
+    return found
+
+
+def incremental(frontier, since=None, stop=None, overlap_days=1, origin_codes=None, workers=4, max_in_flight=16,
+                images=True, fetch_workers=4, metric_workers=None, dom_color='kmeans', metric_cache=None,
+                parquet_dir=None, mongo=True, max_form_attempts=3):
+    """
+    Bring the dataset up to date with the COLAs approved since the last run
+
+    The frontier keeps a watermark, the approval date everything up to is stored. Only the approvals after it are
+    searched for, the TTBIDs found are checked in bulk against the TTB and IMG_SUP collections, and only the missing
+    forms and images are downloaded, so a run costs time in proportion to the new approvals. The last overlap_days
+    before the watermark are searched again to pick up COLAs approved late in the day of the previous run.
+
+    The watermark then moves to stop, or to the day before the earliest approval still missing its form, so no form
+    that failed to download is skipped by the next run. A form missing after max_form_attempts runs is given up on
+    (reported, it can still be fetched with scrape_forms) so one broken page can't hold the watermark for good. Images
+    don't hold it back (COLAs without labels look the same as failed downloads), those still missing are reported and
+    can be fetched with image_scrape. It is also held before the earliest day the search could not list in full (more
+    than 500 approvals of one origin on one day, or a search the site answered with an error, see
+    TTB_crawler.crawl), and not moved at all when only some of the origin codes were searched.
+
+    :param frontier: CrawlFrontier holding the watermark (and the TTBIDs already imaged)
+    :param since: approval date to start from on the first run, '01/24/2016'
+    :param stop: last approval date, defaults to today
+    :param overlap_days: days before the watermark searched again
+    :param origin_codes: origin codes to search, defaults to every origin (the watermark only moves for a search of
+                         every origin)
+    :param workers: number of searches run at the same time
+    :param max_in_flight: number of forms downloaded at the same time
+    :param images: also calculate the image metrics of the new COLAs
+    :param fetch_workers: download threads of image_scrape
+    :param metric_workers: metric processes of image_scrape
+    :param dom_color: dominant color engine of image_scrape
+    :param metric_cache: optional Metric_Cache.MetricCache for image_scrape
+    :param parquet_dir: also write the records to Parquet files under this directory (see open_writer)
+    :param mongo: write the records to MongoDB
+    :param max_form_attempts: runs a missing form holds the watermark back for
+    :return: dict with the searched range, the number of TTBIDs found and fetched, the searches that were cut off at
+             500 hits or failed, the forms given up on, and the new watermark
+    """
+    watermark = frontier.watermark()
+    if watermark is not None:
+        date_start = datetime.datetime.strptime(watermark, '%m/%d/%Y') - datetime.timedelta(days=overlap_days)
+    elif since is not None:
+        date_start = datetime.datetime.strptime(since, '%m/%d/%Y')
+    else:
+        raise ValueError('No watermark stored yet, give the approval date to start from')
+    date_stop = datetime.datetime.strptime(stop, '%m/%d/%Y') if stop is not None else datetime.datetime.now()
+    start_date, stop_date = date_start.strftime('%m/%d/%Y'), date_stop.strftime('%m/%d/%Y')
+
+    every_origin = all_origin_codes()
+    partial = origin_codes is not None and not set(every_origin) <= set(origin_codes)
+    origin_codes = origin_codes if origin_codes is not None else every_origin
+
+    # the full rows cost the same requests as the ids alone, and give the approval date of each TTBID
+    incomplete = []
+    rows = TTB_crawler.crawl(start_date, stop_date, origin_codes, workers=workers, incomplete=incomplete)
+    approved = {row['TTB ID']: datetime.datetime.strptime(row['Completed Date'], '%m/%d/%Y') for row in rows}
+    ttbids = sorted(approved)
+    print('TTBIDs approved {start} - {stop}:  {n}'.format(start=start_date, stop=stop_date, n=len(ttbids)))
+
+    def missing():
+        need_form = set(ttbids) - stored_ttbids(ttbids, 'TTB', '_id', parquet_dir, mongo)
+        need_images = set()
+        if images:
+            need_images = (set(ttbids) - stored_ttbids(ttbids, 'IMG_SUP', 'TTBID', parquet_dir, mongo)
+                           - frontier.imaged_ids(ttbids))  # COLAs without labels have no IMG_SUP rows
+        return need_form, need_images
+
+    need_form, need_images = missing()
+    print('Forms to fetch:  {forms}, images to fetch:  {imgs}'.format(forms=len(need_form), imgs=len(need_images)))
+
+    if need_form:
+        scrape_forms(sorted(need_form), max_in_flight, parquet_dir=parquet_dir, mongo=mongo)
+    if need_images:
+        image_scrape(sorted(need_images), frontier, fetch_workers=fetch_workers, metric_workers=metric_workers,
+                     dom_color=dom_color, metric_cache=metric_cache, parquet_dir=parquet_dir, mongo=mongo)
+
+    still_missing, images_missing = missing()
+    if images_missing:
+        print('Still missing images:  {}'.format(len(images_missing)))
+    new_watermark = date_stop
+    attempts = frontier.record_missing_forms(still_missing, found=set(ttbids) - still_missing)
+    given_up = sorted(ttbid for ttbid in still_missing if attempts[ttbid] >= max_form_attempts)
+    if given_up:
+        print('Forms given up on after {n} attempts:  {ids}'.format(n=max_form_attempts, ids=', '.join(given_up)))
+    holding = still_missing - set(given_up)
+    if holding:
+        earliest = min(approved[ttbid] for ttbid in holding)
+        print('Still missing forms:  {n}, earliest approved {date}'.format(n=len(holding),
+                                                                          date=earliest.strftime('%m/%d/%Y')))
+        new_watermark = min(new_watermark, earliest - datetime.timedelta(days=1))
+    if incomplete:
+        earliest = min(datetime.datetime.strptime(node[0], '%m/%d/%Y') for node in incomplete)
+        print('Searches cut off at 500 hits or failed:  {n}, earliest {date}'.format(
+            n=len(incomplete), date=earliest.strftime('%m/%d/%Y')))
+        new_watermark = min(new_watermark, earliest - datetime.timedelta(days=1))
+    if partial:
+        print('Not all origin codes were searched, leaving the watermark where it was')
+    elif watermark is None or new_watermark > datetime.datetime.strptime(watermark, '%m/%d/%Y'):
+        frontier.set_watermark(new_watermark.strftime('%m/%d/%Y'))
+
+    return {'start': start_date, 'stop': stop_date, 'found': len(ttbids), 'forms_fetched': len(need_form),
+            'images_fetched': len(need_images), 'forms_missing': len(still_missing),
+            'images_missing': len(images_missing), 'incomplete_searches': len(incomplete),
+            'forms_given_up': given_up, 'watermark': frontier.watermark()}
+
+
+def image_scrape(ttbid_list, frontier=None, fetch_workers=4, metric_workers=None, dom_color='kmeans',
+                 metric_cache=None, parquet_dir=None, mongo=True):
+    """
+    Calculate and store the image metrics for each TTBID
+
+    Downloading, the metric calculations (on a process pool) and writing run as overlapping stages, see
+    Image_Pipeline.ImagePipeline.
+
+    :param ttbid_list: list of TTBIDs to process
+    :param frontier: optional CrawlFrontier, TTBIDs it has already imaged are skipped
+    :param fetch_workers: number of download threads
+    :param metric_workers: number of metric processes (defaults to the number of cores, 0 for no pool)
+    :param dom_color: dominant color engine, 'kmeans' or 'histogram' (much cheaper, for bulk re-runs)
+    :param metric_cache: optional Metric_Cache.MetricCache, duplicate labels reuse the metrics stored there
+    :param parquet_dir: also write the records to Parquet files under this directory (see open_writer)
+    :param mongo: write the records to MongoDB
+    :return:
+    """
     logging.basicConfig(filename='Img_Scrape {}.log'.format(datetime.datetime.now()), level=logging.ERROR)
     logger = logging.getLogger(__name__)  # having set the logging level to error for all modules
     logger.setLevel(logging.DEBUG)  # we now set the logging level to debug for our module
 
-    # Set up connection to mongodb
-    client = pymongo.MongoClient()  # Connect to default client
-    db = client.TTB  # Get a database (note: lazy evaluation)
-
-    COLORS = db.COLORS  # the actual collection
-    IMG_META = db.IMG_META
-    IMG_SUP = db.IMG_SUP
-
-    for curr_id in tqdm(ttbid_list):
-        query = TTB_Scraper(curr_id)
-        [meta, imgs] = query.get_images()
-
-        if imgs:
-
-            for im_num, (metadata, img) in enumerate(zip(meta, imgs)):
-
-                # calculate our image metrics
-                metrics = CalcImgMetrics(img)
-                df_color, sum_entropy = metrics.calc_all_metrics()
-
-                # convert things into pandas tables since its easier than futzing with dicts
-                # add the ttbid id and some additional meta information so we can join tables better in the future
-                n_rows = df_color.shape[0]
-                df_color['TTBID'] = [str(curr_id)] * n_rows # add column with ttbid
-                df_color['img_num'] = [str(im_num)] * n_rows
-
-                df_img_meta = pd.DataFrame()
-                df_img_meta['LabelName'] = [re.sub('Label Image: ', '', metadata[0])]
-                df_img_meta['URL'] = [metadata[1]]
-                df_img_meta['TTBID'] = [str(curr_id)] * df_img_meta.shape[0]
-                df_img_meta['ImgType'] = [metrics.img_format]
-
-                df_sup = pd.DataFrame()
-                df_sup['TTBID'] = [str(curr_id)]
-                df_sup['EntropySum'] = [sum_entropy]
-
-                # COLOR collection
-                try:
-                    COLORS.insert_many(df_color.to_dict('records'))
-                    logger.info('Successfully added data to COLORS. TTBID: {ttbid} IMG: {im_num}'.format(ttbid=curr_id, im_num=im_num))
-                except pymongo.errors.DuplicateKeyError:
-                    logger.warning('Failed to add data to COLORS. TTBID: {ttbid} IMG: {im_num} already present'.format(ttbid=curr_id, im_num=im_num))
-
-                # IMG_META collection
-                try:
-                    IMG_META.insert_many(df_img_meta.to_dict('records'))
-                    logger.info('Successfully added data to IMG_META. TTBID: {ttbid} IMG: {im_num}'.format(ttbid=curr_id, im_num=im_num))
-                except pymongo.errors.DuplicateKeyError:
-                    logger.warning('Failed to add data to IMG_META. TTBID: {ttbid} IMG: {im_num} already present'.format(ttbid=curr_id, im_num=im_num))
-
-                # IMG_SUP collection
-                try:
-                    IMG_SUP.insert_many(df_sup.to_dict('records'))
-                    logger.info('Successfully added data to IMG_SUP. TTBID: {ttbid} IMG: {im_num}'.format(ttbid=curr_id, im_num=im_num))
-                except pymongo.errors.DuplicateKeyError:
-                    logger.warning('Failed to add data to IMG_SUP. TTBID: {ttbid} IMG: {im_num} already present'.format(ttbid=curr_id, im_num=im_num))
+    writer = open_writer(logger, parquet_dir, mongo)  # buffered writes to COLORS, IMG_META and IMG_SUP
 
-        else:
-            logger.warning('Skipping {ttbid}, unable to access images'.format(ttbid=curr_id))
+    pipeline = ImagePipeline(fetch_workers=fetch_workers, metric_workers=metric_workers, dom_color=dom_color,
+                             cache=metric_cache, logger=logger)
+    with writer:
+        _image_scrape(ttbid_list, pipeline, writer, logger, frontier)
+
+
+def _image_scrape(ttbid_list, pipeline, writer, logger, frontier=None):
+    """Run a list of TTBIDs through an ImagePipeline and queue their metrics (see image_scrape)"""
+    if frontier is not None:
+        done = frontier.imaged_ids(ttbid_list)
+        ttbid_list = [curr_id for curr_id in ttbid_list if str(curr_id) not in done]
+
+    def handle_result(curr_id, im_num, metadata, df_color, sum_entropy, img_format):
+        store_image_metrics(writer, curr_id, im_num, metadata, df_color, sum_entropy, img_format, logger)
+
+    def handle_done(curr_id):
+        if frontier is not None:
+            writer.on_flush(lambda: frontier.mark_imaged(curr_id))
+
+    pipeline.run(ttbid_list, handle_result, handle_done)
+
+
+def store_image_metrics(writer, curr_id, im_num, metadata, df_color, sum_entropy, img_format, logger):
+    """Queue the COLORS, IMG_META and IMG_SUP documents of one image"""
+
+    # add the ttbid id and some additional meta information so we can join tables better in the future
+    ttbid, img_num = str(curr_id), str(im_num)
+
+    for color_num, (percentage, r, g, b) in enumerate(df_color[['percentage', 'r', 'g', 'b']].values.tolist()):
+        writer.add('COLORS', {'percentage': percentage, 'r': r, 'g': g, 'b': b,
+                              'TTBID': ttbid, 'img_num': img_num,
+                              'color_num': color_num})  # identifies each color so re-runs replace it
+
+    writer.add('IMG_META', {'LabelName': re.sub('Label Image: ', '', metadata[0]),
+                            'URL': metadata[1],
+                            'TTBID': ttbid,
+                            'img_num': img_num,
+                            'ImgType': img_format})
+
+    writer.add('IMG_SUP', {'TTBID': ttbid, 'img_num': img_num, 'EntropySum': float(sum_entropy)})
+
+    logger.info('Successfully added image data. TTBID: {ttbid} IMG: {im_num}'.format(ttbid=curr_id, im_num=im_num))
+
+
+def queue_handlers(writer, logger, frontier=None, max_in_flight=16, pipeline=None):
+    """
+    Handlers running each kind of Work_Queue unit, for Work_Queue.QueueWorker
+
+    Every handler flushes the writer before returning, so a unit is only marked complete once its records are stored.
+    A handler raises if some of its pages could not be fetched, so the queue retries the unit.
+
+    :param writer: sink with the BulkWriter interface (see open_writer)
+    :param logger: logger
+    :param frontier: optional CrawlFrontier of this node, sequences and images it has finished are skipped
+    :param max_in_flight: forms downloaded at the same time by forms units
+    :param pipeline: ImagePipeline for images units, images units are not handled without one
+    :return: dict of kind -> function(payload)
+    """
+
+    def run_sequence(payload):
+        date_start = datetime.datetime.strptime(payload['start'], '%m/%d/%Y')
+        date_stop = datetime.datetime.strptime(payload['stop'], '%m/%d/%Y')
+        curr_date = date_start
+        abandoned = 0
+        while curr_date < date_stop:
+            if not probe_sequence(curr_date, payload['reccode'], payload['skip_tol'], writer, logger, frontier):
+                abandoned += 1
+            curr_date += datetime.timedelta(days=1)
+        writer.flush()
+        if abandoned:
+            # fail the unit, so it is retried (with a frontier, from where each sequence was left)
+            raise IOError('{} sequences were left at a page that could not be fetched'.format(abandoned))
+
+    def run_forms(payload):
+        failed = _scrape_forms(payload['ttbids'], max_in_flight, writer, logger)
+        writer.flush()
+        if failed:
+            raise IOError('{} forms could not be fetched'.format(len(failed)))
+
+    def run_images(payload):
+        _image_scrape(payload['ttbids'], pipeline, writer, logger, frontier)
+        writer.flush()
+
+    handlers = {'sequence': run_sequence, 'forms': run_forms}
+    if pipeline is not None:
+        handlers['images'] = run_images
+    return handlers
+
+
+def work_queue(queue, kinds=None, worker_id=None, exit_when_empty=True, frontier=None, max_in_flight=16,
+               fetch_workers=4, metric_workers=None, dom_color='kmeans', metric_cache=None, parquet_dir=None,
+               mongo=True):
+    """
+    Work through the units of a shared queue (see Work_Queue), start one of these on every node
+
+    :param queue: Work_Queue.SQLiteWorkQueue or Work_Queue.MongoWorkQueue
+    :param kinds: kinds of units to take on, defaults to all of them
+    :param worker_id: id of this worker in the queue, see Work_Queue.default_worker_id
+    :param exit_when_empty: return once no unit is ready instead of waiting for more
+    :param frontier: optional CrawlFrontier of this node
+    :param max_in_flight: forms downloaded at the same time by forms units
+    :param fetch_workers: download threads of images units
+    :param metric_workers: metric processes of images units (defaults to the number of cores, 0 for no pool)
+    :param dom_color: dominant color engine of images units
+    :param metric_cache: optional Metric_Cache.MetricCache for images units
+    :param parquet_dir: also write the records to Parquet files under this directory (see open_writer)
+    :param mongo: write the records to MongoDB
+    :return: number of units processed
+    """
+    from Work_Queue import KINDS, QueueWorker
+
+    logging.basicConfig(filename='Form_Scrape {}.log'.format(datetime.datetime.now()), level=logging.ERROR)
+    logger = logging.getLogger(__name__)  # having set the logging level to error for all modules
+    logger.setLevel(logging.DEBUG)  # we now set the logging level to debug for our module
+
+    kinds = kinds or KINDS
+    pipeline = None
+    if 'images' in kinds:
+        pipeline = ImagePipeline(fetch_workers=fetch_workers, metric_workers=metric_workers, dom_color=dom_color,
+                                 cache=metric_cache, logger=logger)
+
+    writer = open_writer(logger, parquet_dir, mongo)
+    with writer:
+        handlers = queue_handlers(writer, logger, frontier, max_in_flight, pipeline)
+        worker = QueueWorker(queue, {kind: handlers[kind] for kind in kinds}, worker_id=worker_id, logger=logger)
+        processed = worker.run(exit_when_empty=exit_when_empty)
+
+    print('Units completed:  {done}, failed:  {failed}, lease lost:  {lost}'.format(
+        done=worker.completed, failed=worker.failed, lost=worker.lost))
+    return processed
 
 
 def main():
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+TTB HTTP session management
+"""
+
+
+import os
+import threading
+from time import sleep, monotonic, perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from Instrumentation import incr, observe
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# responses that mean the server wants us to slow down
+BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+# methods that are safe to send again after the connection dropped part way through a request
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+# root of the COLA registry, point it at a stand-in server to work offline (see Benchmarks)
+_base_url = os.environ.get('TTB_BASE_URL', 'https://www.ttbonline.gov')
+
+
+class AdaptiveRateLimiter(object):
+
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=50.0, burst=10, increase=0.05, backoff=0.5):
+        """
+        Thread safe token bucket whose refill rate adapts to the health of the server
+
+        The rate grows additively with every healthy response and is cut multiplicatively on a 429 or 5xx (AIMD),
+        so over time we settle just under the highest rate the server accepts.
+
+        :param rate: starting rate in requests per second
+        :param min_rate: floor for the rate when backing off
+        :param max_rate: ceiling for the rate when ramping up
+        :param burst: maximum number of tokens that can build up while idle
+        :param increase: requests per second added after each healthy response
+        :param backoff: factor the rate is multiplied by after an unhealthy response
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.backoff = backoff
+
+        self._tokens = 1.0
+        self._last = monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """Add the tokens accumulated since the last refill"""
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._refill(now)
+
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            sleep(wait)
+
+    def record(self, status_code, retry_after=None):
+        """
+        Adapt the rate to the outcome of a request
+
+        :param status_code: HTTP status of the response (None if the connection failed)
+        :param retry_after: seconds the server asked us to wait, if any
+        """
+        with self._lock:
+            if status_code is None or status_code in BACKOFF_STATUSES:
+                self.rate = max(self.min_rate, self.rate * self.backoff)
+                self._tokens = min(self._tokens, 0.0)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, monotonic() + retry_after)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class PooledSession(requests.Session):
+
+    def __init__(self, limiter, max_retries=3, cache=None):
+        """
+        requests Session that is rate limited and retries requests the server pushed back on
+
+        Sessions made by a SessionManager share its connection pool but keep their own cookies (ie. JSESSIONID).
+
+        :param limiter: AdaptiveRateLimiter shared by every session of the manager
+        :param max_retries: how many times to retry a 429/5xx or a dropped connection (only for idempotent requests,
+                            or a dropped connection when the request was never sent)
+        :param cache: ResponseCache consulted for requests made with a cache_key
+        """
+        super(PooledSession, self).__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.cache = cache
+
+    @staticmethod
+    def _retry_after(response):
+        """Seconds requested by a Retry-After header (only the delta-seconds form is supported)"""
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _not_sent(error):
+        """Whether a ConnectionError happened before any of the request reached the server (refused, timed out
+        connecting, name lookup failed)"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def request(self, method, url, cache_key=None, refresh_cache=False, idempotent=None, **kwargs):
+        """
+        Send a request (see requests.Session.request)
+
+        :param cache_key: json serializable description of the request, responses are cached under it if the
+                          session has a cache
+        :param refresh_cache: bypass any cached copy and store a fresh one
+        :param idempotent: whether the request may be sent again after a 429/5xx or a dropped connection, by default
+                           only for the methods in IDEMPOTENT_METHODS (a POST that only reads, like the search, can
+                           opt in)
+        """
+        if cache_key is not None and self.cache is not None:
+            return self.cache.request(self._send, method, url, cache_key, refresh=refresh_cache,
+                                      idempotent=idempotent, **kwargs)
+        return self._send(method, url, idempotent=idempotent, **kwargs)
+
+    def _send(self, method, url, idempotent=None, **kwargs):
+        """Send a request over the network, waiting on the rate limiter and retrying when pushed back"""
+        endpoint = url.split('?', 1)[0].rsplit('/', 1)[-1]
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            t0 = perf_counter()
+            self.limiter.acquire()
+            t1 = perf_counter()
+            observe('ttb_rate_limit_wait_seconds', t1 - t0)
+            try:
+                response = super(PooledSession, self).request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                observe('ttb_http_request_seconds', perf_counter() - t1, endpoint=endpoint, status='error')
+                self.limiter.record(None)
+                # a POST that may have reached the server is not sent twice
+                if attempt >= self.max_retries or (not idempotent and not self._not_sent(e)):
+                    raise
+                incr('ttb_http_retries_total', endpoint=endpoint, reason='connection')
+            else:
+                observe('ttb_http_request_seconds', perf_counter() - t1, endpoint=endpoint,
+                        status=response.status_code)
+                self.limiter.record(response.status_code, self._retry_after(response))
+                if response.status_code not in BACKOFF_STATUSES or attempt >= self.max_retries or not idempotent:
+                    return response
+                incr('ttb_http_retries_total', endpoint=endpoint, reason=response.status_code)
+                response.close()
+            attempt += 1
+
+    def close(self):
+        """The connection pool belongs to the SessionManager, so there is nothing to release here"""
+        pass
+
+
+class SessionManager(object):
+
+    def __init__(self, pool_size=32, limiter=None, max_retries=3, cache=None):
+        """
+        Hands out sessions that share one keep-alive connection pool and one rate limiter
+
+        :param pool_size: number of connections kept alive to each host
+        :param limiter: AdaptiveRateLimiter to use, one with the default settings is created if None
+        :param max_retries: retries for each request, see PooledSession
+        :param cache: optional ResponseCache shared by every session
+        """
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.limiter = limiter if limiter is not None else AdaptiveRateLimiter()
+        self.max_retries = max_retries
+        self.cache = cache
+
+        self._local = threading.local()  # each thread's shared session
+
+    def session(self):
+        """
+        Create a session with its own cookie jar
+
+        Use this where the site keeps state in the JSESSIONID (pagination of a search, downloading the label images
+        of the form that was just viewed).
+        """
+        session = PooledSession(self.limiter, self.max_retries, self.cache)
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    @property
+    def shared(self):
+        """The session this thread uses for stateless requests (one per thread, so no cookie jar is shared between
+        threads, they all use the same connection pool)"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.session()
+        return session
+
+    def close(self):
+        """Close every pooled connection"""
+        self.adapter.close()
+
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+def get_session_manager():
+    """Return the process wide SessionManager, creating it on first use"""
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = SessionManager()
+        return _default_manager
+
+
+def get_base_url():
+    """Scheme and host every TTB request is sent to (ex 'https://www.ttbonline.gov')"""
+    return _base_url
+
+
+def set_base_url(url):
+    """Send every TTB request to another host, ex a local stand-in server (also settable with TTB_BASE_URL)"""
+    global _base_url
+    _base_url = url.rstrip('/')
+
+
+def set_session_manager(manager):
+    """Replace the process wide SessionManager (ex to change the pool size or rate limits)"""
+    global _default_manager
+    with _default_lock:
+        _default_manager = manager
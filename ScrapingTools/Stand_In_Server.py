@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+TTB stand-in server
+
+Replays recorded (or generated, see Benchmarks) COLA registry pages over HTTP, so the scrapers can be run without
+touching ttbonline.gov. A fixture directory holds:
+
+    index.json          search result rows, one dict per COLA (the columns of the advanced search table)
+    forms/<ttbid>.html  publicDisplaySearchBasic pages
+    images/<ttbid>.html publicFormDisplay pages
+    labels/<filename>   label images, served as publicViewAttachment.do?filename=<filename>
+
+The advanced search form (publicSearchColasAdvanced.do) offers the US origin codes plus any other origin in index.json.
+
+Point the scrapers at it with Session_Manager.set_base_url(server.url).
+"""
+
+
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# rows per page of the advanced search, and how many of the matches the site lets you page through
+PAGE_SIZE = 20
+MAX_RESULTS = 500
+
+# columns of the advanced search table
+SEARCH_COLUMNS = ('TTB ID', 'Permit No.', 'Serial Number', 'Completed Date', 'Fanciful Name', 'Brand Name',
+                  'Origin', 'Origin Desc', 'Class/Type', 'Class/Type Desc')
+
+# what the site returns for a TTBID it has no form for
+EMPTY_PAGE = (b'<html><head><title>COLAs Online</title></head><body><div id="main">'
+              b'<p>No COLA found.</p></div></body></html>')
+
+
+def read_fixtures(directory):
+    """
+    Load a fixture directory into memory
+
+    :param directory: folder laid out as described in the module docstring
+    :return: (index rows, {ttbid: form page}, {ttbid: images page}, {filename: label bytes})
+    """
+
+    def read_dir(name):
+        path = os.path.join(directory, name)
+        pages = {}
+        if os.path.isdir(path):
+            for file_name in os.listdir(path):
+                with open(os.path.join(path, file_name), 'rb') as f:
+                    pages[file_name] = f.read()
+        return pages
+
+    index_path = os.path.join(directory, 'index.json')
+    rows = []
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            rows = json.load(f)
+
+    forms = {os.path.splitext(name)[0]: page for name, page in read_dir('forms').items()}
+    images = {os.path.splitext(name)[0]: page for name, page in read_dir('images').items()}
+    return rows, forms, images, read_dir('labels')
+
+
+def completed_key(date):
+    """mm/dd/yyyy -> yyyymmdd, so dates compare as strings"""
+    return date[6:] + date[:2] + date[3:5]
+
+
+def render_search_page(rows, first, total):
+    """
+    Build a page of the advanced search results
+
+    :param rows: the rows shown on this page
+    :param first: position (from 0) of the first row in the results
+    :param total: number of matching records
+    :return: html as bytes
+    """
+    available = min(total, MAX_RESULTS)
+    lines = ['<html><head><title>COLAs Online</title></head><body><div id="main">', '<div class="box"><table>',
+             '<tr>' + ''.join('<th>{}</th>'.format(column) for column in SEARCH_COLUMNS) + '</tr>']
+
+    for i, row in enumerate(rows):
+        cells = ['<td><a href="viewColaDetails.do?action=publicDisplaySearchAdvanced&amp;ttbid={id}">{id}</a></td>'
+                 .format(id=row['TTB ID'])]
+        cells += ['<td>{}</td>'.format(row.get(column, '')) for column in SEARCH_COLUMNS[1:]]
+        lines.append('<tr class="{}">{}</tr>'.format('dk' if i % 2 == 0 else 'lt', ''.join(cells)))
+    lines.append('</table></div>')
+
+    if total:
+        counter = '{first} to {last} of {available} (Total Matching Records: {total})'.format(
+            first=first + 1, last=first + len(rows), available=available, total=total)
+        if first > 0:
+            counter = '&lt; Previous | ' + counter
+        if first + len(rows) < available:
+            counter += ' | <a href="publicPageAdvancedCola.do?action=page&amp;pgfcn=nextset">Next &gt;</a>'
+        lines.append('<div class="pagination">{}</div>'.format(counter))
+    else:
+        lines.append('<p>Your search returned no results.</p>')
+
+    lines.append('</div></body></html>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real site
+    disable_nagle_algorithm = True  # headers and body are sent separately, don't hold the body for the ACK
+
+    def log_message(self, format, *args):
+        """Keep quiet, the server counts requests instead"""
+        pass
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        self.handle_request(parse_qs(body, keep_blank_values=True))
+
+    def handle_request(self, form):
+        """Route a request to the matching endpoint of the stand-in"""
+        stand_in = self.server.stand_in
+        parts = urlsplit(self.path)
+        endpoint = parts.path.rsplit('/', 1)[-1]
+        params = parse_qs(parts.query)
+
+        cookie = self.headers.get('Cookie') or ''
+        session_id = None
+        for item in cookie.split(';'):
+            name, _, value = item.strip().partition('=')
+            if name == 'JSESSIONID':
+                session_id = value
+
+        stand_in.delay()
+        if stand_in.inject_error():
+            stand_in.count(endpoint, error=True)
+            return self.respond(503, b'Service Unavailable', 'text/plain')
+        stand_in.count(endpoint)
+
+        new_session = session_id is None
+        if new_session:
+            session_id = uuid.uuid4().hex
+
+        if endpoint == 'viewColaDetails.do':
+            action = params.get('action', [''])[0]
+            ttbid = params.get('ttbid', [''])[0]
+            pages = stand_in.forms if action == 'publicDisplaySearchBasic' else stand_in.images
+            status, body, content_type = 200, pages.get(ttbid, EMPTY_PAGE), 'text/html;charset=UTF-8'
+        elif endpoint == 'publicViewAttachment.do':
+            filename = os.path.basename(params.get('filename', [''])[0])
+            if new_session or filename not in stand_in.labels:
+                status, body, content_type = 404, b'Not Found', 'text/plain'  # labels need the form's JSESSIONID
+            else:
+                status, body, content_type = 200, stand_in.labels[filename], 'image/jpeg'
+        elif endpoint == 'publicSearchColasAdvanced.do':
+            status, body, content_type = 200, stand_in.search_form(), 'text/html;charset=UTF-8'
+        elif endpoint == 'publicSearchColasAdvancedProcess.do':
+            status, body, content_type = 200, stand_in.search(session_id, form), 'text/html;charset=UTF-8'
+        elif endpoint == 'publicPageAdvancedCola.do':
+            status, body, content_type = 200, stand_in.next_page(session_id), 'text/html;charset=UTF-8'
+        else:
+            status, body, content_type = 404, b'Not Found', 'text/plain'
+
+        self.respond(status, body, content_type, session_id if new_session else None)
+
+    def respond(self, status, body, content_type, session_id=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if session_id is not None:
+            self.send_header('Set-Cookie', 'JSESSIONID={}; Path=/'.format(session_id))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(object):
+
+    def __init__(self, directory, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        """
+        Local HTTP server answering the TTB endpoints the scrapers use from a fixture directory
+
+        The search keeps its paging state per JSESSIONID, so 'next page' requests behave like on the real site.
+
+        :param directory: fixture directory (see the module docstring)
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds added to every response
+        :param jitter: up to this many seconds are added at random on top of latency
+        :param error_rate: fraction of requests answered with a 503
+        :param seed: seed for the jitter and errors, for repeatable runs
+        """
+        self.rows, self.forms, self.images, self.labels = read_fixtures(directory)
+        self.rows.sort(key=lambda row: row['TTB ID'])
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+        self.requests = {}  # endpoint -> requests answered
+        self.errors = {}  # endpoint -> 503s injected
+
+        self._random = random.Random(seed)
+        self._searches = {}  # JSESSIONID -> [matching rows, position of the current page]
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base url to hand to Session_Manager.set_base_url"""
+        host, port = self.httpd.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def delay(self):
+        """Wait out the simulated network and server time"""
+        with self._lock:
+            wait = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if wait > 0:
+            sleep(wait)
+
+    def inject_error(self):
+        """Whether this request should fail"""
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def count(self, endpoint, error=False):
+        with self._lock:
+            counts = self.errors if error else self.requests
+            counts[endpoint] = counts.get(endpoint, 0) + 1
+
+    def search_form(self):
+        """The advanced search form, only its origin code list is filled in"""
+        from TTB_crawler import US_ORIGIN_CODES
+
+        codes = list(US_ORIGIN_CODES)
+        codes += sorted({row['Origin'] for row in self.rows if row.get('Origin')} - set(codes))
+        options = ''.join('<option value="{code}">{code}</option>'.format(code=code) for code in codes)
+        return ('<html><head><title>COLAs Online</title></head><body><form name="searchCriteria">'
+                '<select name="searchCriteria.originCodeArray" multiple>{}</select>'
+                '</form></body></html>').format(options).encode('utf-8')
+
+    def search(self, session_id, form):
+        """Run an advanced search (only the completed date range and origin codes are supported)"""
+
+        def value(name):
+            return (form.get('searchCriteria.' + name) or [''])[0]
+
+        date_from, date_to = value('dateCompletedFrom'), value('dateCompletedTo')
+        origin_codes = set(form.get('searchCriteria.originCodeArray') or [])
+
+        matches = []
+        for row in self.rows:
+            completed = completed_key(row.get('Completed Date', ''))
+            if date_from and completed < completed_key(date_from):
+                continue
+            if date_to and completed > completed_key(date_to):
+                continue
+            if origin_codes and row.get('Origin') not in origin_codes:
+                continue
+            matches.append(row)
+
+        with self._lock:
+            self._searches[session_id] = [matches, 0]
+        return render_search_page(matches[:PAGE_SIZE], 0, len(matches))
+
+    def next_page(self, session_id):
+        """Move the session's search on by a page, the last page is returned again once we run out"""
+        with self._lock:
+            state = self._searches.get(session_id)
+            if state is None:
+                return render_search_page([], 0, 0)
+            matches, first = state
+            if first + PAGE_SIZE < min(len(matches), MAX_RESULTS):
+                first += PAGE_SIZE
+                state[1] = first
+        last = min(first + PAGE_SIZE, MAX_RESULTS)
+        return render_search_page(matches[first:last], first, len(matches))
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    """ Main entry point of the app """
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'fixtures'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    server = StandInServer(directory, port=port)
+    print('Serving {n} COLAs from {directory} at {url}'.format(n=len(server.rows), directory=directory,
+                                                               url=server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+TTB command line
+
+Every subcommand imports only what it needs, so a form crawl never loads the image (numpy/sklearn/skimage) or
+plotting (matplotlib/bokeh) stacks. Examples:
+
+    python TTB_cli.py search 09/01/2017 12/31/2017 --parquet search_results
+    python TTB_cli.py forms 01/01/2016 01/31/2016 --frontier crawl.sqlite --images
+    python TTB_cli.py incremental --frontier crawl.sqlite --since 01/01/2018
+    python TTB_cli.py sequential 01/01/2016 01/02/2016 --async
+    python TTB_cli.py images 16306001000152 --dom-color histogram --metric-cache metrics.sqlite
+    python TTB_cli.py export COLORS IMG_SUP --parquet ttb_parquet
+    python TTB_cli.py enqueue work.sqlite sequence --start 01/01/2016 --stop 03/01/2016
+    python TTB_cli.py work work.sqlite --kinds sequence
+    python TTB_cli.py visualize 16001001000052 --img-num 1
+"""
+
+
+import argparse
+import sys
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+def configure_http(args):
+    """Point the scrapers at --base-url and replace the process wide SessionManager if the rate or response cache
+    were set on the command line"""
+    from Session_Manager import AdaptiveRateLimiter, SessionManager, set_session_manager, set_base_url
+
+    if args.base_url is not None:
+        set_base_url(args.base_url)
+    if args.http_cache is None and args.rate is None:
+        return
+
+    cache = None
+    if args.http_cache is not None:
+        from Response_Cache import ResponseCache
+        cache = ResponseCache(args.http_cache, offline=args.offline)
+    limiter = AdaptiveRateLimiter(rate=args.rate) if args.rate is not None else None
+    set_session_manager(SessionManager(limiter=limiter, cache=cache))
+
+
+def start_instrumentation(args):
+    """
+    Record per stage timings and counters if --metrics-port or --metrics-json was given
+
+    :return: list of exporters to stop on exit
+    """
+    if args.metrics_port is None and args.metrics_json is None:
+        return []
+
+    import Instrumentation
+
+    Instrumentation.enable()
+    exporters = []
+    if args.metrics_port is not None:
+        exporters.append(Instrumentation.MetricsServer(args.metrics_port).start())
+    if args.metrics_json is not None:
+        exporters.append(Instrumentation.SnapshotWriter(args.metrics_json, args.metrics_interval).start())
+    return exporters
+
+
+def open_archive(args):
+    """Archive the raw pages to --archive, if it was given"""
+    if args.archive is None:
+        return None
+    from Page_Archive import PageArchive, set_page_archive
+    archive = PageArchive(args.archive)
+    set_page_archive(archive)
+    return archive
+
+
+def open_frontier(args):
+    """CrawlFrontier for --frontier, None if it wasn't given (close it with close_frontier)"""
+    if args.frontier is None:
+        return None
+    from Crawl_Frontier import CrawlFrontier
+    return CrawlFrontier(args.frontier)
+
+
+def close_frontier(frontier):
+    """Close what open_frontier returned"""
+    if frontier is not None:
+        frontier.close()
+
+
+def add_origin_args(parser):
+    """--origin-codes / --us-only, the search covers every origin without them"""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--origin-codes', nargs='+', help='origin codes to search (default: every origin)')
+    group.add_argument('--us-only', action='store_true', help='only search the US state origin codes')
+
+
+def selected_origin_codes(args):
+    """Origin codes chosen with add_origin_args, None for every origin"""
+    if args.us_only:
+        from TTB_crawler import US_ORIGIN_CODES
+        return US_ORIGIN_CODES
+    return args.origin_codes or None
+
+
+def read_ttbids(args):
+    """TTBIDs given as arguments and/or one per line in --ttbid-file"""
+    ttbids = list(args.ttbids)
+    if args.ttbid_file is not None:
+        with open(args.ttbid_file) as f:
+            ttbids.extend(line.strip() for line in f if line.strip())
+    return ttbids
+
+
+def cmd_search(args):
+    """Crawl the advanced search"""
+    from TTB_crawler import TTB_crawler, all_origin_codes
+
+    origin_codes = selected_origin_codes(args) or all_origin_codes()
+    res = TTB_crawler.crawl(args.start, args.stop, origin_codes, workers=args.workers, ids_only=args.ids_only)
+    print('Number of results: {}'.format(len(res)))
+
+    if args.ids_only:
+        res = [{'TTB ID': ttbid} for ttbid in res]
+    if args.parquet is not None:
+        from Columnar_Sink import ColumnarSink
+        with ColumnarSink(args.parquet) as sink:
+            for row in res:
+                sink.add('SEARCH', row)
+    if args.pickle is not None:
+        import pandas as pd
+        pd.DataFrame(res).to_pickle(args.pickle)
+
+
+def cmd_forms(args):
+    """Find TTBIDs with the search, then scrape their forms (and images)"""
+    from Sequential_Crawl import search_driven
+
+    frontier = open_frontier(args)
+    try:
+        search_driven(args.start, args.stop, selected_origin_codes(args), workers=args.workers,
+                      max_in_flight=args.max_in_flight, images=args.images, frontier=frontier,
+                      parquet_dir=args.parquet, mongo=not args.no_mongo)
+    finally:
+        close_frontier(frontier)
+
+
+def cmd_incremental(args):
+    """Fetch what was approved since the last run"""
+    from Crawl_Frontier import CrawlFrontier
+    from Sequential_Crawl import incremental
+
+    metric_cache = None
+    if args.metric_cache is not None:
+        from Metric_Cache import MetricCache
+        metric_cache = MetricCache(args.metric_cache)
+
+    frontier = CrawlFrontier(args.frontier)
+    try:
+        res = incremental(frontier, since=args.since, stop=args.stop, overlap_days=args.overlap_days,
+                          origin_codes=selected_origin_codes(args), workers=args.workers,
+                          max_in_flight=args.max_in_flight, images=not args.no_images,
+                          fetch_workers=args.fetch_workers, metric_workers=args.metric_workers,
+                          dom_color=args.dom_color, metric_cache=metric_cache, parquet_dir=args.parquet,
+                          mongo=not args.no_mongo, max_form_attempts=args.max_form_attempts)
+    finally:
+        frontier.close()
+        if metric_cache is not None:
+            metric_cache.close()
+    print('Watermark:  {}'.format(res['watermark']))
+
+
+def cmd_sequential(args):
+    """Probe TTBIDs sequence by sequence"""
+    from Sequential_Crawl import sequential, sequential_async
+
+    frontier = open_frontier(args)
+    try:
+        if args.use_async:
+            sequential_async(args.start, args.stop, skip_tol=args.skip_tol, max_in_flight=args.max_in_flight,
+                             window=args.window, frontier=frontier, parquet_dir=args.parquet,
+                             mongo=not args.no_mongo)
+        else:
+            sequential(args.start, args.stop, skip_tol=args.skip_tol, frontier=frontier, parquet_dir=args.parquet,
+                       mongo=not args.no_mongo)
+    finally:
+        close_frontier(frontier)
+
+
+def cmd_images(args):
+    """Calculate and store the image metrics of TTBIDs"""
+    from Sequential_Crawl import image_scrape
+
+    metric_cache = None
+    if args.metric_cache is not None:
+        from Metric_Cache import MetricCache
+        metric_cache = MetricCache(args.metric_cache, near_duplicates=args.near_duplicates)
+
+    frontier = open_frontier(args)
+    try:
+        image_scrape(read_ttbids(args), frontier=frontier, fetch_workers=args.fetch_workers,
+                     metric_workers=args.metric_workers, dom_color=args.dom_color, metric_cache=metric_cache,
+                     parquet_dir=args.parquet, mongo=not args.no_mongo)
+    finally:
+        close_frontier(frontier)
+        if metric_cache is not None:
+            metric_cache.close()
+
+
+def cmd_export(args):
+    """Copy MongoDB collections to a Parquet dataset"""
+    import pymongo
+    from tqdm import tqdm
+    from Columnar_Sink import ColumnarSink
+
+    db = pymongo.MongoClient().TTB
+    with ColumnarSink(args.parquet, row_group_size=args.row_group_size) as sink:
+        for name in args.collections:
+            projection = None if name == 'TTB' else {'_id': 0}  # only TTB's _id is meaningful (the TTBID)
+            cursor = db[name].find({}, projection, batch_size=args.batch_size)
+            for doc in tqdm(cursor, desc=name, total=db[name].estimated_document_count()):
+                sink.add(name, doc)
+
+
+def cmd_reparse(args):
+    """Parse the pages of an archive again and write the records out"""
+    import logging
+    from Page_Archive import PageArchive, reparse_archive
+    from Sequential_Crawl import open_writer
+
+    logger = logging.getLogger('reparse')
+    with PageArchive(args.archive_dir) as archive, open_writer(logger, args.parquet, not args.no_mongo) as writer:
+        written = reparse_archive(archive, writer, kinds=args.kinds, workers=args.workers, logger=logger)
+    for kind, n in written.items():
+        print('{kind}: {n} records'.format(kind=kind, n=n))
+
+
+def cmd_enqueue(args):
+    """Split work into units on a shared queue"""
+    from Work_Queue import open_queue, sequence_units, batch_units
+
+    queue = open_queue(args.queue, max_attempts=args.max_attempts)
+    if args.kind == 'sequence':
+        if args.start is None or args.stop is None:
+            print('sequence units need --start and --stop')
+            return 2
+        units = sequence_units(args.start, args.stop, skip_tol=args.skip_tol, days_per_unit=args.days_per_unit)
+    else:
+        units = batch_units(args.kind, read_ttbids(args), batch_size=args.batch_size)
+    added = queue.add_many(units)
+    print('Queued {added} of {n} units'.format(added=added, n=len(units)))
+    queue.close()
+
+
+def cmd_work(args):
+    """Work through the units of a shared queue"""
+    from Work_Queue import open_queue
+    from Sequential_Crawl import work_queue
+
+    queue = open_queue(args.queue, lease_seconds=args.lease)
+    metric_cache = None
+    if args.metric_cache is not None:
+        from Metric_Cache import MetricCache
+        metric_cache = MetricCache(args.metric_cache, near_duplicates=args.near_duplicates)
+
+    frontier = open_frontier(args)
+    try:
+        work_queue(queue, kinds=args.kinds, worker_id=args.worker_id, exit_when_empty=not args.wait,
+                   frontier=frontier, max_in_flight=args.max_in_flight, fetch_workers=args.fetch_workers,
+                   metric_workers=args.metric_workers, dom_color=args.dom_color, metric_cache=metric_cache,
+                   parquet_dir=args.parquet, mongo=not args.no_mongo)
+    finally:
+        close_frontier(frontier)
+        if metric_cache is not None:
+            metric_cache.close()
+        queue.close()
+
+
+def cmd_queue_status(args):
+    """Count the units of a shared queue by state"""
+    from Work_Queue import open_queue
+
+    queue = open_queue(args.queue)
+    if args.retry_failed:
+        print('Requeued {} failed units'.format(queue.retry_failed()))
+    for state, n in queue.counts().items():
+        print('{state}: {n}'.format(state=state, n=n))
+    for unit_id, attempts, error in queue.failures():
+        print('  {id} ({attempts} attempts): {error}'.format(id=unit_id, attempts=attempts, error=error))
+    queue.close()
+
+
+def cmd_visualize(args):
+    """Plot the dominant colors of one label image"""
+    from TTB_scraping import TTB_Scraper
+    from Image_Processing import CalcImgMetrics
+
+    meta, imgs = TTB_Scraper(args.ttbid).get_images(draft_size=None)
+    if not imgs:
+        print('No images found for {}'.format(args.ttbid))
+        return 1
+
+    img = imgs[args.img_num]
+    metrics = CalcImgMetrics(img, keep_raw=True)
+    df_color, ent = metrics.calc_all_metrics(args.dom_color)
+    print(meta[args.img_num])
+    print(df_color)
+    print('Entropy: {}'.format(ent))
+    metrics.visualize_dom_colors(df_color[['percentage']].values, df_color[['r', 'g', 'b']].values, metrics.raw)
+
+
+def add_output_args(parser):
+    parser.add_argument('--parquet', metavar='DIR', help='also write the records to a Parquet dataset in DIR')
+    parser.add_argument('--no-mongo', action='store_true', help='do not write to MongoDB (use with --parquet)')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Scrape the TTB public COLA registry')
+    parser.add_argument('--http-cache', metavar='DIR', help='cache HTTP responses in DIR (see Response_Cache)')
+    parser.add_argument('--offline', action='store_true',
+                        help='only answer requests from the --http-cache (requires it)')
+    parser.add_argument('--rate', type=float, help='starting request rate, requests per second')
+    parser.add_argument('--base-url', help='scrape this host instead of ttbonline.gov (ex a Stand_In_Server)')
+    parser.add_argument('--archive', metavar='DIR', help='keep the raw html of every page in a Page_Archive in DIR')
+    parser.add_argument('--metrics-port', type=int, help='serve stage timings at /metrics (Prometheus) on PORT')
+    parser.add_argument('--metrics-json', metavar='FILE', help='append JSON snapshots of the stage timings to FILE')
+    parser.add_argument('--metrics-interval', type=float, default=60.0, help='seconds between --metrics-json snapshots')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    search = subparsers.add_parser('search', help='crawl the advanced search')
+    search.add_argument('start', help='first approval date, mm/dd/yyyy')
+    search.add_argument('stop', help='last approval date, mm/dd/yyyy')
+    add_origin_args(search)
+    search.add_argument('--workers', type=int, default=8, help='searches run at the same time')
+    search.add_argument('--ids-only', action='store_true', help='only collect the TTBIDs')
+    search.add_argument('--parquet', metavar='DIR', help='write the results to a Parquet dataset in DIR')
+    search.add_argument('--pickle', metavar='FILE', help='write the results to a pickled DataFrame')
+    search.set_defaults(func=cmd_search)
+
+    forms = subparsers.add_parser('forms', help='scrape the forms of every TTBID the search finds')
+    forms.add_argument('start', help='first approval date, mm/dd/yyyy')
+    forms.add_argument('stop', help='last approval date, mm/dd/yyyy')
+    add_origin_args(forms)
+    forms.add_argument('--workers', type=int, default=4, help='searches run at the same time')
+    forms.add_argument('--max-in-flight', type=int, default=16, help='forms downloaded at the same time')
+    forms.add_argument('--images', action='store_true', help='also calculate the image metrics')
+    forms.add_argument('--frontier', metavar='FILE', help='checkpoint progress to this SQLite file')
+    add_output_args(forms)
+    forms.set_defaults(func=cmd_forms)
+
+    inc = subparsers.add_parser('incremental', help='fetch the COLAs approved since the last run')
+    inc.add_argument('--frontier', metavar='FILE', required=True, help='SQLite file keeping the watermark')
+    inc.add_argument('--since', help='approval date to start from on the first run, mm/dd/yyyy')
+    inc.add_argument('--stop', help='last approval date, mm/dd/yyyy (default: today)')
+    inc.add_argument('--overlap-days', type=int, default=1, help='days before the watermark searched again')
+    inc.add_argument('--max-form-attempts', type=int, default=3,
+                     help='runs a missing form holds the watermark back for')
+    add_origin_args(inc)  # the watermark only moves when every origin is searched
+    inc.add_argument('--workers', type=int, default=4, help='searches run at the same time')
+    inc.add_argument('--max-in-flight', type=int, default=16, help='forms downloaded at the same time')
+    inc.add_argument('--no-images', action='store_true', help='do not calculate the image metrics')
+    inc.add_argument('--dom-color', choices=('kmeans', 'histogram'), default='kmeans', help='dominant color engine')
+    inc.add_argument('--metric-cache', metavar='FILE', help='reuse the metrics of labels seen before')
+    inc.add_argument('--fetch-workers', type=int, default=4, help='download threads')
+    inc.add_argument('--metric-workers', type=int, help='metric processes (default: one per core)')
+    add_output_args(inc)
+    inc.set_defaults(func=cmd_incremental)
+
+    seq = subparsers.add_parser('sequential', help='probe TTBIDs sequence by sequence')
+    seq.add_argument('start', help='first receive date, mm/dd/yyyy')
+    seq.add_argument('stop', help='last receive date, mm/dd/yyyy')
+    seq.add_argument('--skip-tol', type=int, default=3, help='misses tolerated before moving to the next sequence')
+    seq.add_argument('--async', dest='use_async', action='store_true', help='probe many sequences at once')
+    seq.add_argument('--max-in-flight', type=int, default=16, help='requests outstanding (with --async)')
+    seq.add_argument('--window', type=int, default=4, help='sequence numbers probed ahead (with --async)')
+    seq.add_argument('--frontier', metavar='FILE', help='checkpoint progress to this SQLite file')
+    add_output_args(seq)
+    seq.set_defaults(func=cmd_sequential)
+
+    images = subparsers.add_parser('images', help='calculate the image metrics of TTBIDs')
+    images.add_argument('ttbids', nargs='*', help='TTBIDs to process')
+    images.add_argument('--ttbid-file', metavar='FILE', help='file with one TTBID per line')
+    images.add_argument('--dom-color', choices=('kmeans', 'histogram'), default='kmeans',
+                        help='dominant color engine')
+    images.add_argument('--metric-cache', metavar='FILE', help='reuse the metrics of labels seen before')
+    images.add_argument('--near-duplicates', action='store_true', help='match the metric cache by perceptual hash')
+    images.add_argument('--fetch-workers', type=int, default=4, help='download threads')
+    images.add_argument('--metric-workers', type=int, help='metric processes (default: one per core)')
+    images.add_argument('--frontier', metavar='FILE', help='skip TTBIDs this SQLite file has marked as done')
+    add_output_args(images)
+    images.set_defaults(func=cmd_images)
+
+    export = subparsers.add_parser('export', help='copy MongoDB collections to Parquet')
+    export.add_argument('collections', nargs='*', default=['TTB', 'COLORS', 'IMG_META', 'IMG_SUP'],
+                        help='collections to export (default: all)')
+    export.add_argument('--parquet', metavar='DIR', required=True, help='Parquet dataset to write')
+    export.add_argument('--batch-size', type=int, default=10000, help='documents per MongoDB cursor batch')
+    export.add_argument('--row-group-size', type=int, default=100000, help='rows per Parquet row group')
+    export.set_defaults(func=cmd_export)
+
+    reparse = subparsers.add_parser('reparse', help='parse the pages of an --archive again')
+    reparse.add_argument('archive_dir', help='Page_Archive directory')
+    reparse.add_argument('--kinds', nargs='+', choices=('form', 'search'), default=['form'],
+                         help='pages to parse (forms go to TTB, search rows to SEARCH)')
+    reparse.add_argument('--workers', type=int, help='parser processes (default: one per core)')
+    add_output_args(reparse)
+    reparse.set_defaults(func=cmd_reparse)
+
+    enqueue = subparsers.add_parser('enqueue', help='split work into units on a shared queue')
+    enqueue.add_argument('queue', help='queue: mongodb://host/db or an SQLite file')
+    enqueue.add_argument('kind', choices=('sequence', 'forms', 'images'), help='kind of units')
+    enqueue.add_argument('ttbids', nargs='*', help='TTBIDs (forms and images units)')
+    enqueue.add_argument('--ttbid-file', metavar='FILE', help='file with one TTBID per line')
+    enqueue.add_argument('--batch-size', type=int, default=100, help='TTBIDs per unit')
+    enqueue.add_argument('--start', help='first receive date, mm/dd/yyyy (sequence units)')
+    enqueue.add_argument('--stop', help='last receive date, mm/dd/yyyy (sequence units)')
+    enqueue.add_argument('--skip-tol', type=int, default=3, help='misses tolerated before moving to the next sequence')
+    enqueue.add_argument('--days-per-unit', type=int, default=7, help='receive dates per sequence unit')
+    enqueue.add_argument('--max-attempts', type=int, default=5,
+                         help='claims each unit gets before it is failed (stored with the unit)')
+    enqueue.set_defaults(func=cmd_enqueue)
+
+    work = subparsers.add_parser('work', help='work through the units of a shared queue')
+    work.add_argument('queue', help='queue: mongodb://host/db or an SQLite file')
+    work.add_argument('--kinds', nargs='+', choices=('sequence', 'forms', 'images'),
+                      help='kinds of units to take on (default: all)')
+    work.add_argument('--worker-id', help='id of this worker in the queue (default: host:pid:random)')
+    work.add_argument('--lease', type=float, default=300.0, help='seconds a claim lasts without a heartbeat')
+    work.add_argument('--wait', action='store_true', help='keep polling for new units instead of exiting')
+    work.add_argument('--max-in-flight', type=int, default=16, help='forms downloaded at the same time')
+    work.add_argument('--dom-color', choices=('kmeans', 'histogram'), default='kmeans', help='dominant color engine')
+    work.add_argument('--metric-cache', metavar='FILE', help='reuse the metrics of labels seen before')
+    work.add_argument('--near-duplicates', action='store_true', help='match the metric cache by perceptual hash')
+    work.add_argument('--fetch-workers', type=int, default=4, help='download threads')
+    work.add_argument('--metric-workers', type=int, help='metric processes (default: one per core)')
+    work.add_argument('--frontier', metavar='FILE', help='checkpoint progress to this SQLite file')
+    add_output_args(work)
+    work.set_defaults(func=cmd_work)
+
+    status = subparsers.add_parser('queue-status', help='count the units of a shared queue by state')
+    status.add_argument('queue', help='queue: mongodb://host/db or an SQLite file')
+    status.add_argument('--retry-failed', action='store_true', help='queue the failed units again')
+    status.set_defaults(func=cmd_queue_status)
+
+    visualize = subparsers.add_parser('visualize', help='plot the dominant colors of a label image')
+    visualize.add_argument('ttbid', help='TTBID of the COLA')
+    visualize.add_argument('--img-num', type=int, default=0, help='which of its label images')
+    visualize.add_argument('--dom-color', choices=('kmeans', 'histogram'), default='kmeans',
+                           help='dominant color engine')
+    visualize.set_defaults(func=cmd_visualize)
+
+    return parser
+
+
+def main(argv=None):
+    """ Main entry point of the app """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.offline and args.http_cache is None:
+        parser.error('--offline answers requests from the response cache, so it needs --http-cache')
+    configure_http(args)
+    archive = open_archive(args)
+    exporters = start_instrumentation(args)
+    try:
+        return args.func(args)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+        if archive is not None:
+            archive.close()
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    sys.exit(main())
@@ -4,22 +4,62 @@ TTB Webscraping
 """
 
 
-import requests
-from bs4 import BeautifulSoup
 import re
 import datetime
 import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from Session_Manager import get_session_manager, get_base_url
+from Html_Parsing import parse_page
+from Page_Archive import get_page_archive, search_key
 
 __author__ = "Jonathan Hirokawa"
 __version__ = "0.1.0"
 __license__ = "MIT"
 
 
+# only US state origin codes (4E is alaska)
+US_ORIGIN_CODES = [str(i).zfill(2) for i in list(range(0, 50))] + ['4E']
+
+_all_origin_codes = None
+_origin_codes_lock = threading.Lock()
+
+
+def all_origin_codes(manager=None):
+    """
+    Every origin code (US states and foreign countries) the advanced search offers
+
+    The codes are read from the search form's origin list the first time this is called (through the response
+    cache, if the manager has one, so an offline run can use them too).
+
+    :param manager: SessionManager to fetch the search form with (defaults to the process wide one)
+    :return: list of origin codes, in the order the site lists them
+    """
+    global _all_origin_codes
+    with _origin_codes_lock:
+        if _all_origin_codes is None:
+            manager = manager if manager is not None else get_session_manager()
+            url = get_base_url() + r'/colasonline/publicSearchColasAdvanced.do'
+            response = manager.shared.get(url, cache_key=('search_form',))
+            response.raise_for_status()
+
+            select = parse_page(response.text).find('select', attrs={'name': 'searchCriteria.originCodeArray'})
+            codes = [option.get('value') for option in select.find_all('option')] if select else []
+            codes = [code for code in codes if code]
+            if not codes:
+                raise ValueError('No origin codes found on the advanced search form')
+            _all_origin_codes = codes
+        return list(_all_origin_codes)
+
+
 class TTB_query(object):
 
     def __init__(self, date_start=None, date_end=None, fancy_name=None, prod_name_type=None, class_desired=None,
                  class_code=None, origin_code=None, ttb_id_start=None, ttb_id_end=None, serial_start=None,
-                 serial_end=None, permit_id=None, vendor_code=None):
+                 serial_end=None, permit_id=None, vendor_code=None, manager=None, archive=None):
         """
         Performs a new 'advanced' query on the TTB database
 
@@ -36,14 +76,17 @@ class TTB_query(object):
         :param serial_end:
         :param permit_id:
         :param vendor_code:
+        :param manager: SessionManager supplying pooled sessions (defaults to the process wide one)
+        :param archive: Page_Archive.PageArchive the raw result pages are kept in (defaults to the process wide one)
         :return:
         """
 
-        self.session = requests.Session()
+        # paging relies on the JSESSIONID, so every query gets its own cookie jar (but shares the connection pool)
+        manager = manager if manager is not None else get_session_manager()
+        self.session = manager.session()
+        self.archive = archive if archive is not None else get_page_archive()
         self.soup = None
 
-        url = r'https://www.ttbonline.gov/colasonline/publicSearchColasAdvancedProcess.do'
-
         payload = {'searchCriteria.dateCompletedFrom': date_start,
                    'searchCriteria.dateCompletedTo': date_end,
                    'searchCriteria.productOrFancifulName': fancy_name,
@@ -59,10 +102,71 @@ class TTB_query(object):
                    'searchCriteria.vendorCode': vendor_code
                    }
 
+        self.payload = payload
+        self.page = 0  # number of 'next page' links followed
+        self.live = False  # whether the server side paging state matches self.page
+
+        self.soup = parse_page(self._search().text, 'search')
+
+    def _search(self, refresh=False):
+        """Submit the search, this also (re)starts the server side paging"""
+
+        url = get_base_url() + r'/colasonline/publicSearchColasAdvancedProcess.do'
+
         params = {'action': 'search'}
 
-        response = self.session.post(url, params=params, data=payload)
-        self.soup = BeautifulSoup(response.text, 'html5lib')
+        # the search only reads, so it is safe to resend when the server pushes back
+        response = self.session.post(url, params=params, data=self.payload, cache_key=('search', self.payload),
+                                     refresh_cache=refresh, idempotent=True)
+        self.live = not getattr(response, 'from_cache', False)
+        self._archive(response, 0)
+        response.raise_for_status()  # an error page would read as a search without results
+        return response
+
+    def _page(self, page, refresh=False):
+        """Request the 'next page' of results, page being the number of pages we will have moved forward"""
+
+        url = get_base_url() + r'/colasonline/publicPageAdvancedCola.do'
+
+        params = {'action': 'page',
+                  'pgfcn': 'nextset'}
+
+        response = self.session.get(url, params=params, cache_key=('search', self.payload, page),
+                                    refresh_cache=refresh)
+        self._archive(response, page)
+        response.raise_for_status()
+        return response
+
+    def _archive(self, response, page):
+        """Keep the raw page in the archive (see Page_Archive.search_key for its key)"""
+        if self.archive is None or response.status_code != 200:
+            return
+        key = search_key(self.payload, page)
+        if not getattr(response, 'from_cache', False) or not self.archive.contains('search', key):
+            self.archive.put('search', key, response.text)
+
+    def _go_live(self):
+        """Replay the search and paging against the server so the next page can be fetched from it"""
+        self._search(refresh=True)
+        for page in range(1, self.page + 1):
+            self._page(page, refresh=True)
+        self.live = True
+
+    @classmethod
+    def from_soup(cls, soup):
+        """
+        Wrap an already parsed search page (ex a saved page) without running a search
+
+        Only the extraction methods (get_table_data, get_ids, get_num_results) are usable on the result.
+        """
+        query = cls.__new__(cls)
+        query.session = None
+        query.archive = None
+        query.soup = soup
+        query.payload = None
+        query.page = 0
+        query.live = False
+        return query
 
     def next_page(self):
         """
@@ -72,32 +176,74 @@ class TTB_query(object):
         By keeping a session active across queries, we can avoid a lot of the headache involved in passing the needed
         data around.
 
+        The last page is recognised from the record counter ('21 to 40 of 500') without another request. When there
+        is no counter we fall back on fetching the next page and comparing the TTB IDs listed on both pages.
+
         NOTE: if there are no more 'Next' pages, soup becomes None
         """
 
-        old_soup = self.soup
+        if self.is_last_page():
+            self.soup = None
+            return
 
-        url = r'https://www.ttbonline.gov/colasonline/publicPageAdvancedCola.do'
+        old_fingerprint = self.page_fingerprint(self.soup)
 
-        params = {'action': 'page',
-                  'pgfcn': 'nextset'}
+        # cached pages do not move the server along, catch it up before asking it for a page we don't have
+        cache = self.session.cache
+        if not self.live and cache is not None and not cache.offline:
+            if not cache.contains(('search', self.payload, self.page + 1)):
+                self._go_live()
 
-        response = self.session.get(url, params=params)
-        new_soup = BeautifulSoup(response.text, 'html5lib')
+        self.page += 1
+        response = self._page(self.page)
+        if not getattr(response, 'from_cache', False):
+            self.live = True
+        new_soup = parse_page(response.text, 'search')
 
-        if old_soup == new_soup:
+        if old_fingerprint == self.page_fingerprint(new_soup):
             # no new data (no next page)
             self.soup = None
         else:
             self.soup = new_soup
 
-    def get_table_data(self):
-        """Extract the table data from a page of the search"""
+    @staticmethod
+    def page_position(soup):
+        """
+        Read the record counter of a page
+
+        :return: (first, last, available) ex (21, 40, 500) for '21 to 40 of 500', None if there is no counter
+        """
+        pagination_div = soup.select('div.pagination')
+        if not pagination_div:
+            return None
+
+        found = re.search(r'([0-9]+) to ([0-9]+) of ([0-9]+)', pagination_div[0].get_text())
+        if found is None:
+            return None
+        return tuple(int(value) for value in found.groups())
+
+    def is_last_page(self):
+        """True if the record counter shows the current page ends the results"""
+        position = self.page_position(self.soup)
+        return position is not None and position[1] >= position[2]
+
+    def page_fingerprint(self, soup):
+        """Cheap identity of a page of results: the TTB IDs it lists (or its text if it lists none)"""
+        ids = self.get_ids(soup)
+        return tuple(ids) if ids else hash(soup.get_text())
+
+    def get_table_data(self, soup=None):
+        """
+        Extract the table data from a page of the search
+
+        :param soup: page to extract from, defaults to the current page
+        """
 
         def process_row(row):
             return [col.get_text().strip() for col in row.select('td')]
 
-        rows = self.soup.select('.box table tr')
+        soup = soup if soup is not None else self.soup
+        rows = soup.select('.box table tr')
 
         if rows:
             keys = [header.get_text() for header in rows[0].select('th')]
@@ -108,10 +254,15 @@ class TTB_query(object):
         else:
             return []
 
-    def get_ids(self):
-        """Extract the TTB IDs listed on the current page"""
-        dk = [link.get_text() for link in self.soup.select('tr.dk a')]  # extract dark highlighted rows
-        lt = [link.get_text() for link in self.soup.select('tr.lt a')]  # extract light highlighted rows
+    def get_ids(self, soup=None):
+        """
+        Extract the TTB IDs listed on the current page
+
+        :param soup: page to extract from, defaults to the current page
+        """
+        soup = soup if soup is not None else self.soup
+        dk = [link.get_text() for link in soup.select('tr.dk a')]  # extract dark highlighted rows
+        lt = [link.get_text() for link in soup.select('tr.lt a')]  # extract light highlighted rows
 
         return dk + lt
 
@@ -123,21 +274,52 @@ class TTB_query(object):
         except IndexError:
             return pagination_div
 
-    def get_all_results(self):
-        """Iterate through each page aggregating results"""
+    def iter_pages(self, prefetch=True):
+        """
+        Yield each page of results in turn
 
-        res = []
-        while self.soup:
-            res += self.get_table_data()
-            self.next_page()
+        :param prefetch: request page N+1 in the background while the caller handles page N
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            while self.soup:
+                soup = self.soup
+                future = executor.submit(self.next_page) if executor else None
 
-        return res
+                yield soup
 
+                if future is not None:
+                    future.result()
+                else:
+                    self.next_page()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def iter_ids(self, prefetch=True):
+        """Yield the TTB IDs of the search page by page"""
+        for soup in self.iter_pages(prefetch):
+            for ttbid in self.get_ids(soup):
+                yield ttbid
+
+    def iter_results(self, prefetch=True):
+        """Yield the table rows of the search page by page"""
+        for soup in self.iter_pages(prefetch):
+            for row in self.get_table_data(soup):
+                yield row
+
+    def get_all_ids(self):
+        """Iterate through each page aggregating the TTB IDs"""
+        return list(self.iter_ids())
+
+    def get_all_results(self):
+        """Iterate through each page aggregating results"""
+        return list(self.iter_results())
 
 
 class TTB_crawler(object):
 
-    def __init__(self, date_start, date_end, origin_code):
+    def __init__(self, date_start, date_end, origin_code, workers=1):
 
         start = datetime.datetime.strptime(date_start, '%m/%d/%Y')  # convert to datetime obj
         stop = datetime.datetime.strptime(date_end, '%m/%d/%Y')
@@ -147,9 +329,10 @@ class TTB_crawler(object):
         self.date_start = date_start
         self.date_end = date_end
         self.origin_code = origin_code
+        self.workers = workers
 
-    def run(self):
-        return self.crawl(self.date_start, self.date_end, self.origin_code)
+    def run(self, ids_only=False):
+        return self.crawl(self.date_start, self.date_end, self.origin_code, workers=self.workers, ids_only=ids_only)
 
     @staticmethod
     def date_range(start, end, intv):
@@ -169,55 +352,128 @@ class TTB_crawler(object):
         return zip(a, b)
 
     @staticmethod
-    def crawl(date_start, date_end, origin_code=['00']):
-        """Find every TTBID in given range"""
+    def split_query(date_start, date_end, origin_code):
+        """
+        Break a query that returned too many hits into smaller subqueries
+
+        :return: list of (date_start, date_end, origin_code) tuples, empty if the query can not be decomposed further
+        """
+
+        # calculate how many days we are currently searching for
+        date_window = datetime.datetime.strptime(date_end, "%m/%d/%Y") - datetime.datetime.strptime(date_start, "%m/%d/%Y")
+
+        # see if we are looking at a single day
+        if date_window == datetime.timedelta(0):
+
+            # ideally, we'd just use ttb_id ranges, but this search term unfortunately does not behave
+            # as expected instead we just subdivide by origin codes
+            if len(origin_code) > 1:
+                return [(date_start, date_end, origin_code[0:int(len(origin_code) / 2)]),
+                        (date_start, date_end, origin_code[int(len(origin_code) / 2):])]
+            else:
+                # if necessary we could also subdivide by type, but that will make only small differences
+                return []
+
+        # down to two day window
+        elif date_window == datetime.timedelta(1):
+            # search for each day individually
+            return [(date_start, date_start, origin_code),
+                    (date_end, date_end, origin_code)]
+
+        # range of days left
+        else:
+            # break the date range in half and try again
+            date_spans = list(TTB_crawler.pairwise(TTB_crawler.date_range(date_start, date_end, 2)))
+
+            return [(date_spans[0][0], date_spans[0][1], origin_code),
+                    (date_spans[1][0], date_spans[1][1], origin_code)]
+
+    @staticmethod
+    def crawl_node(date_start, date_end, origin_code, ids_only=False):
+        """
+        Run a single query of the crawl
+
+        :param ids_only: collect only the TTB IDs rather than the full table rows
+
+        :return: (results, subqueries, complete) where results are only gathered when the query did not need to be
+                 split, and complete is False for a query with more than 500 hits that can't be split any further
+                 (its results are then the first 500 hits)
+        """
 
         query = TTB_query(date_start=date_start, date_end=date_end,
                           origin_code=origin_code)
 
         total_hits = query.get_num_results()
         print('Subquery hits: {}'.format(total_hits))
-        res = []
 
         # did our query return any values
-        if total_hits:
+        if not total_hits:
+            return [], [], True
+
+        # only 500 results at a time are returned, check to see if we hit that limit
+        if total_hits > 500:
+            subqueries = TTB_crawler.split_query(date_start, date_end, origin_code)
+            if subqueries:
+                return [], subqueries, True
+            print('Unable to further decompose query: {dstart}-{dstop}, {orig}'.format(dstart=date_start,
+                                                                                       dstop=date_end,
+                                                                                       orig=origin_code))
+            # keep the hits the site lets us page through
+            return (query.get_all_ids() if ids_only else query.get_all_results()), [], False
+
+        return (query.get_all_ids() if ids_only else query.get_all_results()), [], True
 
-            # only 500 results at a time are returned, check to see if we hit that limit
-            if total_hits > 500:
+    @staticmethod
+    def crawl(date_start, date_end, origin_code=['00'], workers=1, ids_only=False, incomplete=None):
+        """
+        Find every TTBID in given range
 
-                # calculate how many days we are currently searching for
-                date_window = datetime.datetime.strptime(date_end, "%m/%d/%Y") - datetime.datetime.strptime(date_start, "%m/%d/%Y")
+        Queries with more than 500 hits are split recursively. The whole recursion tree is run on a pool of workers,
+        so sibling subqueries (and their paging) run at the same time. Each query has its own session since paging
+        relies on server side state. Results come back in the same order as a depth first serial crawl.
 
-                # see if we are looking at a single day
-                if date_window == datetime.timedelta(0):
+        A single day of a single origin code with more than 500 hits can't be split, only its first 500 hits are
+        returned. A query the site answers with an error (or, offline, one missing from the cache) stops the crawl
+        with the requests exception. Pass a list as incomplete to find out which queries those were instead: the
+        crawl then carries on without the failed queries' rows.
 
-                    # ideally, we'd just use ttb_id ranges, but this search term unfortunately does not behave
-                    # as expected instead we just subdivide by origin codes
-                    if len(origin_code) > 1:
-                        res = TTB_crawler.crawl(date_start, date_end, origin_code=origin_code[0:int(len(origin_code) / 2)])
-                        res += TTB_crawler.crawl(date_start, date_end, origin_code=origin_code[int(len(origin_code) / 2):])
-                    else:
-                        # if necessary we could also subdivide by type, but that will make only small differences
-                        print('Unable to further decompose query: {dstart}-{dstop}, {orig}'.format(dstart=date_start,
-                                                                                                   dstop=date_end,
-                                                                                                   orig=origin_code))
+        :param workers: number of subqueries run at the same time
+        :param ids_only: return only the TTB IDs rather than the full table rows
+        :param incomplete: list the (date_start, date_end, origin_code) of every query that could not be split below
+                           500 hits, or that failed, is appended to
+        """
 
-                else:
-                    # down to two day window
-                    if date_window == datetime.timedelta(1):
-                        # search for each day individually
-                        res = TTB_crawler.crawl(date_start=date_start, date_end=date_start, origin_code=origin_code)
-                        res += TTB_crawler.crawl(date_start=date_end, date_end=date_end, origin_code=origin_code)
-
-                    # range of days left
-                    else:
-                        # break the date range in half and try again
-                        date_spans = list(TTB_crawler.pairwise(TTB_crawler.date_range(date_start, date_end, 2)))
-
-                        res = TTB_crawler.crawl(date_start=date_spans[0][0], date_end=date_spans[0][1], origin_code=origin_code)
-                        res += TTB_crawler.crawl(date_start=date_spans[1][0], date_end=date_spans[1][1], origin_code=origin_code)
-            else:
-                res = query.get_all_results()
+        results = {}  # position in the recursion tree -> rows found there
+        # pending maps future -> (position in the recursion tree, query)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            root = (date_start, date_end, origin_code)
+            pending = {executor.submit(TTB_crawler.crawl_node, *root, ids_only): ((), root)}
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    path, node = pending.pop(future)
+                    try:
+                        rows, subqueries, complete = future.result()
+                    except requests.RequestException as e:
+                        if incomplete is None:
+                            raise
+                        print('Query failed: {dstart}-{dstop}, {orig}: {err}'.format(dstart=node[0], dstop=node[1],
+                                                                                   orig=node[2], err=e))
+                        rows, subqueries, complete = [], [], False
+                    results[path] = rows
+                    if not complete and incomplete is not None and node not in incomplete:
+                        incomplete.append(node)  # split ranges share their middle day, so a node can come up twice
+
+                    for i, subquery in enumerate(subqueries):
+                        future = executor.submit(TTB_crawler.crawl_node, *subquery, ids_only)
+                        pending[future] = (path + (i,), subquery)
+
+        res = []
+        for path in sorted(results):
+            res += results[path]
         return res
 
 def main():
@@ -230,16 +486,23 @@ def main():
     #origin_codes.columns = ['code', 'location']
     #origin_codes = list(origin_codes['code']
 
-    # generate a list of only US state origin codes (4E is alaska)
-    origin_codes = [str(i).zfill(2) for i in list(range(0, 50))] + ['4E']
+    origin_codes = US_ORIGIN_CODES
 
     start_date = datetime.datetime(2017, 9, 1)
     stop_date = datetime.datetime(2017, 12, 31)
-    crawler = TTB_crawler(start_date.strftime('%m/%d/%Y'), stop_date.strftime('%m/%d/%Y'), origin_codes)
+    crawler = TTB_crawler(start_date.strftime('%m/%d/%Y'), stop_date.strftime('%m/%d/%Y'), origin_codes, workers=8)
     res = crawler.run()
     print('Number of results: {}'.format(len(res)))
-    df = pd.DataFrame(res)
-    df.to_pickle('{}-{}.pkl'.format(start_date.strftime('%Y%m%d'), start_date.strftime('%Y%m%d')))
+
+    parquet = True  # partitioned Parquet dataset, set to False for the old single pickle
+    if parquet:
+        from Columnar_Sink import ColumnarSink
+        with ColumnarSink('search_results') as sink:  # rows land in search_results/SEARCH/date=.../
+            for row in res:
+                sink.add('SEARCH', row)
+    else:
+        df = pd.DataFrame(res)
+        df.to_pickle('{}-{}.pkl'.format(start_date.strftime('%Y%m%d'), start_date.strftime('%Y%m%d')))
 
 
 if __name__ == "__main__":
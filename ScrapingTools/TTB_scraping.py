@@ -4,41 +4,82 @@ TTB Webscraping
 """
 
 
-import requests
-from bs4 import BeautifulSoup
 import re
+import hashlib
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
+import requests
 
-from collections import deque
+from Session_Manager import get_session_manager, get_base_url
+from Html_Parsing import parse_page
+from Form_Parser import FORM_PARSER
+from Page_Archive import get_page_archive
+from Instrumentation import timer
 
 __author__ = "Jonathan Hirokawa"
 __version__ = "0.1.0"
 __license__ = "MIT"
 
 
+# size the image metrics are computed at, labels are decoded straight down to (about) this size
+THUMBNAIL_SIZE = (128, 128)
+
+
+class ImageDecodeError(Exception):
+    """A downloaded label is not an image PIL can decode (unknown format, truncated or corrupt data)"""
+    pass
+
+# which nodes of each viewColaDetails page we need (see Html_Parsing.PAGE_NODES)
+ACTION_PAGE_TYPES = {'publicDisplaySearchBasic': 'form',
+                     'publicFormDisplay': 'images'}
+
+
 class TTB_Scraper(object):
 
-    def __init__(self, ttb_id):
+    def __init__(self, ttb_id, manager=None, archive=None):
         """
         Initialize a TTB_Scraper object
 
         :param ttb_id: a valid id number for the web scraper ex 17115001000140
+        :param manager: SessionManager supplying pooled sessions (defaults to the process wide one)
+        :param archive: Page_Archive.PageArchive the raw pages are kept in (defaults to the process wide one, if any)
         """
         self.ttb_id = ttb_id
-        self.session = requests.Session()
+        self.manager = manager if manager is not None else get_session_manager()
+        self.archive = archive if archive is not None else get_page_archive()
+        self.from_cache = False  # whether the last page came out of the response cache
+
+    def get_soup(self, action, session=None, refresh=False):
+        """
+        Get soup of query
 
-    def get_soup(self, action):
-        """Get soup of query"""
+        :param action: viewColaDetails action (ex publicDisplaySearchBasic)
+        :param session: session to use instead of the shared one (needed when later requests rely on the JSESSIONID)
+        :param refresh: skip the response cache and fetch the page again
+        :raises requests.RequestException: the page could not be fetched (an error status, or Response_Cache.CacheMiss
+                                           offline), so it is not mistaken for a page without a form
+        """
 
-        url = r'https://www.ttbonline.gov/colasonline/viewColaDetails.do'
+        url = get_base_url() + r'/colasonline/viewColaDetails.do'
         params = {'action': action,
                   'ttbid': self.ttb_id}
 
-        response = self.session.get(url, params=params)
+        session = session if session is not None else self.manager.shared  # the calling thread's session
+        response = session.get(url, params=params, cache_key=('viewColaDetails', action, str(self.ttb_id)),
+                               refresh_cache=refresh)
+        self.from_cache = getattr(response, 'from_cache', False)
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError('{status} for {action} of {ttbid}'.format(
+                status=response.status_code, action=action, ttbid=self.ttb_id), response=response)
 
-        soup = BeautifulSoup(response.text, 'html5lib')
+        page_type = ACTION_PAGE_TYPES.get(action)
+        if self.archive is not None and page_type is not None:
+            # pages served from the response cache are only archived if the archive doesn't have them yet
+            if not self.from_cache or not self.archive.contains(page_type, self.ttb_id):
+                self.archive.put(page_type, self.ttb_id, response.text)
+
+        soup = parse_page(response.text, page_type)
 
         return soup
 
@@ -52,76 +93,35 @@ class TTB_Scraper(object):
 
         soup = self.get_soup('publicDisplaySearchBasic')
 
-        trs = soup.select('form[name=colaApplicationForm] div.box tr')  # extract each table row
-
-        if trs:
-            # extract field names
-            field_names = soup.select('form[name=colaApplicationForm] div.box tr strong')
-            field_names = [field.get_text().strip() for field in field_names]  # convert to list
+        return self.extract_basic_form(soup)
 
-            # get cleaned version of form, removing blanks and unnecessary chars
-            cleaned_form = [re.sub(r'\n|\s{2,}', '', line.get_text().replace(u'\xa0', u' ')) for line in trs]
-            cleaned_form[0] = re.sub(r'Printable Version', '', cleaned_form[0])
-            cleaned_form = list(filter(None, cleaned_form))  # filter out empty entries
+    @staticmethod
+    def extract_basic_form(soup):
+        """
+        Pull the field names and rows out of a parsed basic form page
 
-            return [field_names, cleaned_form]
-        else:
-            return None
+        :param soup: soup of a publicDisplaySearchBasic page
+        :return: [field_names, cleaned_form] or None if the page has no form
+        """
+        return FORM_PARSER.extract(soup)
 
     @staticmethod
     def assign_basic_results(field_names, cleaned_form):
         """
+        Match the rows of a form to its fields (see Form_Parser.FormParser.assign)
 
         :param field_names: list of field names
         :param cleaned_form: list of table rows
-        :return:
+        :return: dict of field name -> value
         """
-        # put things in a queue flipped so that pop now starts us at the top of the table
-        remaining_fields = deque(field_names)
-        remaining_fields.reverse()
-        form = deque(cleaned_form)
-        form.reverse()
-
-        curr_field = remaining_fields.pop()
-        curr_field_cleaned = re.sub(r'\s|:', '', curr_field)
-        last_field = ''
-
-        prog = re.compile(re.escape('{field}'.format(field=curr_field)))
-
-        data = {}
-
-        while form:
-
-            curr_line = form.pop()
-            found = prog.match(curr_line)
-
-            if found:
-                inline = prog.split(curr_line, maxsplit=1)
-
-                if inline[1]:
-                    # there is text on the same line as the label, start by grabbing that
-                    data[curr_field_cleaned] = inline[1]
-                else:
-                    data[curr_field_cleaned] = ''
-
-                try:
-                    last_field = curr_field_cleaned
-                    curr_field = remaining_fields.pop()
-                    curr_field_cleaned = re.sub(r'\s|:', '', curr_field)
-
-                    prog = re.compile(re.escape('{field}'.format(field=curr_field)))
-
-                except IndexError:
-                    # no more fields
-                    fields_remain = False
-
-            else:
-                data[last_field] += curr_line + '\n'
-
-        return data
+        return FORM_PARSER.assign(field_names, cleaned_form)
 
     def get_basic_form_data(self):
-        """Downloads and parses basic form data (publicDisplaySearchBasic)"""
+        """
+        Downloads and parses basic form data (publicDisplaySearchBasic)
+
+        :return: dict of the form's fields, None if the page was fetched but has no form (see get_soup for failures)
+        """
         res = self.publicDisplaySearchBasic_scraping()
         if res:
             form_data = self.assign_basic_results(*res)
@@ -129,21 +129,54 @@ class TTB_Scraper(object):
             form_data = None
         return form_data
 
-    def publicFormBasic_scraping(self):
+    def publicFormBasic_scraping(self, session=None, refresh=False):
         """
         Scrapes the publicFormBasic results (the pictures)
 
+        :param session: session that will be used to download the images (it receives the JSESSIONID)
+        :param refresh: skip the response cache and fetch the page again
         :return:
         """
 
-        soup = self.get_soup('publicFormDisplay')
+        soup = self.get_soup('publicFormDisplay', session=session, refresh=refresh)
+
+        return self.extract_img_meta(soup)
+
+    @staticmethod
+    def extract_img_meta(soup):
+        """
+        Pull the label image names and urls out of a parsed publicFormDisplay page
+
+        :param soup: soup of a publicFormDisplay page
+        :return: list of (alt text, url) tuples
+        """
 
         imgs = soup.select('img[alt*=Label]')  # extract all images with the word labels (ie. exclude signature)
 
-        img_meta = [(img['alt'], r'https://www.ttbonline.gov' + img['src']) for img in imgs]
+        img_meta = [(img['alt'], get_base_url() + img['src']) for img in imgs]
 
         return img_meta
 
+    def open_image_session(self):
+        """
+        Prepare a session for downloading this record's label images
+
+        The images can only be downloaded with the JSESSIONID handed out with the form page, so the form page is
+        requested again (skipping the response cache) whenever it was cached but some of its images are not.
+
+        :return: (session, img_meta)
+        """
+
+        session = self.manager.session()  # images need the JSESSIONID of the form page, so use a private cookie jar
+        img_meta = self.publicFormBasic_scraping(session)  # also updates cookie JSESSIONID (needed for downloading imgs)
+
+        cache = self.manager.cache
+        if self.from_cache and not cache.offline:
+            if not all(cache.contains(('image', url)) for _, url in img_meta):
+                img_meta = self.publicFormBasic_scraping(session, refresh=True)
+
+        return session, img_meta
+
     def download_images(self, verbose=True):
         """
         Attempts to download
@@ -152,14 +185,14 @@ class TTB_Scraper(object):
         :return:
         """
 
-        img_meta = self.publicFormBasic_scraping()  # also updates cookie JSESSIONID (needed for downloading imgs)
+        session, img_meta = self.open_image_session()
 
         if verbose:
             print('Images Found:  {}'.format(len(img_meta)))
 
         # attempt to download each image
         for name, url in img_meta:
-            r = self.session.get(url, stream=True)
+            r = session.get(url, cache_key=('image', url))  # the response cache keeps the whole body anyway
 
             # check status of request
             if r.status_code == 200:
@@ -172,25 +205,70 @@ class TTB_Scraper(object):
                 label_type = re.sub(r' ', '-', label_type)  # replace spaces with '-'
 
                 with open('{id}_{label_type}.jpg'.format(id=self.ttb_id, label_type=label_type), 'wb') as f:
-                    for chunk in r:
-                        f.write(chunk)
+                    f.write(r.content)
 
-    def get_images(self):
-        """Returns a list of PIL array images"""
+    @staticmethod
+    def decode_image(data, draft_size=THUMBNAIL_SIZE):
+        """
+        Decode a downloaded image
 
-        img_meta = self.publicFormBasic_scraping()  # also updates cookie JSESSIONID (needed for downloading imgs)
-        imgs = []
+        :param data: the raw bytes of the image
+        :param draft_size: have the JPEG decoder scale down by a power of two (DCT scaling) to no less than this
+                           size, None to decode at full resolution
+        :return: PIL image, with the SHA-1 of data in img.info['sha1'] (see Metric_Cache)
+        :raises ImageDecodeError: if data can't be decoded
+        """
+        with timer('ttb_image_decode_seconds'):
+            try:
+                img = Image.open(io.BytesIO(data))
+                if draft_size is not None:
+                    img.draft(img.mode, draft_size)  # no-op for anything but JPEG
+                img.load()
+            except (UnidentifiedImageError, Image.DecompressionBombError, SyntaxError, ValueError, OSError) as e:
+                # PIL reports truncated or corrupt data as OSError (data is already in memory, so no I/O is involved)
+                raise ImageDecodeError(str(e)) from e
+        img.info['sha1'] = hashlib.sha1(data).hexdigest()
+        return img
+
+    def iter_images(self, draft_size=THUMBNAIL_SIZE):
+        """
+        Download and decode the label images one at a time
+
+        Only one compressed image is held in memory at once. Labels that fail to download are skipped,
+        ImageDecodeError is raised for images that can't be decoded.
+
+        :param draft_size: see decode_image
+        :return: generator of ((alt text, url), PIL image)
+        """
+
+        session, img_meta = self.open_image_session()
 
         # attempt to download each image
         for name, url in img_meta:
-            r = self.session.get(url)
+            r = session.get(url, cache_key=('image', url))
 
             # check status of request
             if r.status_code == 200:
-                try:
-                    imgs.append(Image.open(io.BytesIO(r.content)))
-                except OSError:
-                    return img_meta, []
+                yield (name, url), self.decode_image(r.content, draft_size)
+
+    def get_images(self, draft_size=THUMBNAIL_SIZE):
+        """
+        Returns a list of PIL array images
+
+        No images are returned if one of them can't be decoded, download errors are raised.
+
+        :param draft_size: see decode_image, None for full resolution images
+        """
+
+        img_meta = []
+        imgs = []
+
+        try:
+            for meta, img in self.iter_images(draft_size):
+                img_meta.append(meta)
+                imgs.append(img)
+        except ImageDecodeError:
+            return img_meta, []
 
         return img_meta, imgs
 
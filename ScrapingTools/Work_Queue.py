@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+"""
+TTB work queue
+
+Splits a crawl into units of work that any number of worker processes, on any number of machines, can share. A
+worker claims a unit together with a lease, keeps renewing the lease while it works (heartbeats) and marks the unit
+complete once its records are written. Units whose lease runs out (the worker died or lost its connection) are handed
+to the next worker that asks, and failed units are retried after a growing delay until they reach the max_attempts
+they were queued with.
+
+The queue is kept in a MongoDB collection (MongoWorkQueue) so every node can reach it, or in an SQLite file
+(SQLiteWorkQueue) for the workers of a single machine and for local tests. Units are
+
+    sequence    {'start': '01/01/2016', 'stop': '01/08/2016', 'reccode': 1, 'skip_tol': 3}
+                every sequence of one receive code over a range of receive dates (see Sequential_Crawl.probe_sequence)
+    forms       {'ttbids': [...]} a batch of TTBIDs whose forms to scrape
+    images      {'ttbids': [...]} a batch of TTBIDs whose image metrics to calculate
+"""
+
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import uuid
+from time import sleep, time
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+KINDS = ('sequence', 'forms', 'images')
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+class WorkUnit(object):
+
+    def __init__(self, unit_id, kind, payload, attempts=0, owner=None, lease_expires=None, max_attempts=None):
+        """
+        A unit of work as handed out by claim
+
+        :param unit_id: id of the unit in the queue
+        :param kind: one of KINDS
+        :param payload: dict describing the work (see the module docstring)
+        :param attempts: how many times the unit has been claimed, this claim included
+        :param owner: worker holding the lease
+        :param lease_expires: epoch seconds the lease runs out at
+        :param max_attempts: claims the unit gets before it is marked failed
+        """
+        self.id = unit_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.owner = owner
+        self.lease_expires = lease_expires
+
+    def __repr__(self):
+        return 'WorkUnit({id!r}, attempt {attempts})'.format(id=self.id, attempts=self.attempts)
+
+
+def default_worker_id():
+    """host:pid:random, unique across the nodes sharing a queue"""
+    return '{host}:{pid}:{tag}'.format(host=socket.gethostname(), pid=os.getpid(), tag=uuid.uuid4().hex[:6])
+
+
+def retry_delay(attempts, base=30.0, cap=3600.0):
+    """Seconds before a unit that failed attempts times is handed out again (doubling, up to cap)"""
+    return min(cap, base * 2 ** max(attempts - 1, 0))
+
+
+class SQLiteWorkQueue(object):
+
+    def __init__(self, path='work_queue.sqlite', lease_seconds=300.0, max_attempts=5, retry_base=30.0):
+        """
+        Work queue stored in an SQLite file, shared by the processes of one machine
+
+        Claims run in an immediate (write locked) transaction, so two processes never get the same unit.
+
+        :param path: SQLite file (created if missing)
+        :param lease_seconds: how long a claim lasts without a heartbeat
+        :param max_attempts: claims a unit gets before it is marked failed, for units added without their own
+        :param retry_base: seconds before the first retry of a failed unit, doubled on every further failure
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)  # autocommit
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS units ('
+                           'id TEXT PRIMARY KEY, kind TEXT, payload TEXT, state TEXT, attempts INTEGER, owner TEXT, '
+                           'lease_expires REAL, available_at REAL, error TEXT, updated REAL, max_attempts INTEGER)')
+        if 'max_attempts' not in [row[1] for row in self._conn.execute('PRAGMA table_info(units)')]:
+            self._conn.execute('ALTER TABLE units ADD COLUMN max_attempts INTEGER')  # queues from before it was kept
+        self._conn.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, available_at)')
+
+    def add(self, kind, payload, unit_id=None, max_attempts=None):
+        """
+        Queue a unit, units already queued under the same id are left as they are
+
+        :param max_attempts: claims the unit gets before it is marked failed, defaults to the queue's
+        :return: True if the unit was added
+        """
+        return self.add_many([(kind, payload, unit_id)], max_attempts) == 1
+
+    def add_many(self, units, max_attempts=None):
+        """
+        Queue many units at once
+
+        :param units: iterable of (kind, payload, unit_id or None), see sequence_units and batch_units
+        :param max_attempts: claims each unit gets before it is marked failed, defaults to the queue's
+        :return: number of units added
+        """
+        now = time()
+        max_attempts = max_attempts or self.max_attempts
+        rows = [(unit_id or uuid.uuid4().hex, kind, json.dumps(payload), 'pending', 0, None, None, now, None, now,
+                 max_attempts)
+                for kind, payload, unit_id in units]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('INSERT OR IGNORE INTO units (id, kind, payload, state, attempts, owner, '
+                                       'lease_expires, available_at, error, updated, max_attempts) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return self._conn.total_changes - before
+
+    def claim(self, owner, kinds=None):
+        """
+        Lease the next unit that is ready: a pending unit past its retry delay or one whose lease ran out (those
+        go first, 'leased' sorts before 'pending')
+
+        :param owner: id of the claiming worker (see default_worker_id)
+        :param kinds: only hand out units of these kinds
+        :return: WorkUnit, None if nothing is ready
+        """
+        now = time()
+        kind_filter, params = '', []
+        if kinds:
+            kind_filter = ' AND kind IN ({})'.format(','.join('?' * len(kinds)))
+            params = list(kinds)
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # leases that ran out on the last allowed attempt are not handed out again
+                self._conn.execute("UPDATE units SET state = 'failed', owner = NULL, error = 'lease expired', "
+                                   "updated = ? WHERE state = 'leased' AND lease_expires <= ? "
+                                   "AND attempts >= COALESCE(max_attempts, ?)",
+                                   (now, now, self.max_attempts))
+                row = self._conn.execute(
+                    "SELECT id, kind, payload, attempts, COALESCE(max_attempts, ?) FROM units "
+                    "WHERE ((state = 'pending' AND available_at <= ?) "
+                    "OR (state = 'leased' AND lease_expires <= ?)){} ORDER BY state, available_at LIMIT 1"
+                    .format(kind_filter),
+                    [self.max_attempts, now, now] + params).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE units SET state = 'leased', owner = ?, attempts = attempts + 1, "
+                                       "lease_expires = ?, updated = ? WHERE id = ?",
+                                       (owner, now + self.lease_seconds, now, row[0]))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+        if row is None:
+            return None
+        return WorkUnit(row[0], row[1], json.loads(row[2]), row[3] + 1, owner, now + self.lease_seconds, row[4])
+
+    def _update_leased(self, unit, assignments, params):
+        """Update a unit only while unit.owner still holds its lease, return whether it did"""
+        with self._lock:
+            cursor = self._conn.execute("UPDATE units SET {}, updated = ? WHERE id = ? AND owner = ? "
+                                        "AND state = 'leased'".format(assignments),
+                                        list(params) + [time(), unit.id, unit.owner])
+        return cursor.rowcount == 1
+
+    def renew(self, unit):
+        """
+        Extend the lease of a unit (heartbeat)
+
+        :return: False if the lease was lost (it ran out and another worker claimed the unit)
+        """
+        lease_expires = time() + self.lease_seconds
+        if not self._update_leased(unit, 'lease_expires = ?', [lease_expires]):
+            return False
+        unit.lease_expires = lease_expires
+        return True
+
+    def complete(self, unit):
+        """Mark a unit done, False if the lease was lost in the meantime"""
+        return self._update_leased(unit, "state = 'done', owner = NULL, lease_expires = NULL, error = NULL", [])
+
+    def fail(self, unit, error):
+        """
+        Give a unit back after an error, it is retried later unless it has used up its attempts
+
+        :param error: what went wrong (kept with the unit)
+        :return: False if the lease was lost in the meantime
+        """
+        if unit.attempts >= (unit.max_attempts or self.max_attempts):
+            return self._update_leased(unit, "state = 'failed', owner = NULL, lease_expires = NULL, error = ?",
+                                       [str(error)])
+        available_at = time() + retry_delay(unit.attempts, self.retry_base)
+        return self._update_leased(unit, "state = 'pending', owner = NULL, lease_expires = NULL, error = ?, "
+                                         "available_at = ?", [str(error), available_at])
+
+    def release(self, unit):
+        """Give a unit back without counting the attempt (ex the worker is shutting down)"""
+        return self._update_leased(unit, "state = 'pending', owner = NULL, lease_expires = NULL, "
+                                         "attempts = attempts - 1", [])
+
+    def retry_failed(self):
+        """Queue every failed unit again with a fresh set of attempts, return how many"""
+        with self._lock:
+            cursor = self._conn.execute("UPDATE units SET state = 'pending', attempts = 0, available_at = ?, "
+                                        "updated = ? WHERE state = 'failed'", (time(), time()))
+        return cursor.rowcount
+
+    def counts(self):
+        """dict of state -> number of units"""
+        with self._lock:
+            rows = self._conn.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall()
+        found = dict.fromkeys(STATES, 0)
+        found.update(rows)
+        return found
+
+    def failures(self, limit=20):
+        """(id, attempts, error) of failed units"""
+        with self._lock:
+            return self._conn.execute("SELECT id, attempts, error FROM units WHERE state = 'failed' ORDER BY id "
+                                      "LIMIT ?", (limit,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MongoWorkQueue(object):
+
+    def __init__(self, collection, lease_seconds=300.0, max_attempts=5, retry_base=30.0):
+        """
+        Work queue stored in a MongoDB collection, shared by workers on any number of machines
+
+        Claims are a single find_one_and_update, so two workers never get the same unit. Times are epoch seconds
+        taken from the workers' clocks, keep the nodes in sync (ntp) and the lease well above the clock skew.
+
+        :param collection: pymongo collection holding the units (ex client.TTB.WORK_QUEUE)
+        :param lease_seconds: how long a claim lasts without a heartbeat
+        :param max_attempts: claims a unit gets before it is marked failed, for units added without their own
+        :param retry_base: seconds before the first retry of a failed unit, doubled on every further failure
+        """
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        collection.create_index([('state', 1), ('available_at', 1)])
+        collection.create_index([('state', 1), ('lease_expires', 1)])
+
+    def add(self, kind, payload, unit_id=None, max_attempts=None):
+        """
+        Queue a unit, units already queued under the same id are left as they are
+
+        :param max_attempts: claims the unit gets before it is marked failed, defaults to the queue's
+        :return: True if the unit was added
+        """
+        return self.add_many([(kind, payload, unit_id)], max_attempts) == 1
+
+    def add_many(self, units, max_attempts=None):
+        """
+        Queue many units at once
+
+        :param units: iterable of (kind, payload, unit_id or None), see sequence_units and batch_units
+        :param max_attempts: claims each unit gets before it is marked failed, defaults to the queue's
+        :return: number of units added
+        """
+        from pymongo import UpdateOne
+
+        now = time()
+        max_attempts = max_attempts or self.max_attempts
+        requests = [UpdateOne({'_id': unit_id or uuid.uuid4().hex},
+                              {'$setOnInsert': {'kind': kind, 'payload': payload, 'state': 'pending', 'attempts': 0,
+                                                'owner': None, 'lease_expires': None, 'available_at': now,
+                                                'error': None, 'updated': now, 'max_attempts': max_attempts}},
+                              upsert=True)
+                    for kind, payload, unit_id in units]
+        if not requests:
+            return 0
+        return self.collection.bulk_write(requests, ordered=False).upserted_count
+
+    def claim(self, owner, kinds=None):
+        """
+        Lease the next unit that is ready: a pending unit past its retry delay or one whose lease ran out (those
+        go first, 'leased' sorts before 'pending')
+
+        :param owner: id of the claiming worker (see default_worker_id)
+        :param kinds: only hand out units of these kinds
+        :return: WorkUnit, None if nothing is ready
+        """
+        from pymongo import ReturnDocument
+
+        now = time()
+        max_attempts = {'$ifNull': ['$max_attempts', self.max_attempts]}  # units queued before it was kept
+        # leases that ran out on the last allowed attempt are not handed out again
+        self.collection.update_many({'state': 'leased', 'lease_expires': {'$lte': now},
+                                     '$expr': {'$gte': ['$attempts', max_attempts]}},
+                                    {'$set': {'state': 'failed', 'owner': None, 'error': 'lease expired',
+                                              'updated': now}})
+
+        query = {'$or': [{'state': 'pending', 'available_at': {'$lte': now}},
+                         {'state': 'leased', 'lease_expires': {'$lte': now},
+                          '$expr': {'$lt': ['$attempts', max_attempts]}}]}
+        if kinds:
+            query['kind'] = {'$in': list(kinds)}
+        doc = self.collection.find_one_and_update(
+            query,
+            {'$set': {'state': 'leased', 'owner': owner, 'lease_expires': now + self.lease_seconds, 'updated': now},
+             '$inc': {'attempts': 1}},
+            sort=[('state', 1), ('available_at', 1)], return_document=ReturnDocument.AFTER)
+
+        if doc is None:
+            return None
+        return WorkUnit(doc['_id'], doc['kind'], doc['payload'], doc['attempts'], owner, doc['lease_expires'],
+                        doc.get('max_attempts'))
+
+    def _update_leased(self, unit, update):
+        """Update a unit only while unit.owner still holds its lease, return whether it did"""
+        update.setdefault('$set', {})['updated'] = time()
+        result = self.collection.update_one({'_id': unit.id, 'owner': unit.owner, 'state': 'leased'}, update)
+        return result.matched_count == 1
+
+    def renew(self, unit):
+        """
+        Extend the lease of a unit (heartbeat)
+
+        :return: False if the lease was lost (it ran out and another worker claimed the unit)
+        """
+        lease_expires = time() + self.lease_seconds
+        if not self._update_leased(unit, {'$set': {'lease_expires': lease_expires}}):
+            return False
+        unit.lease_expires = lease_expires
+        return True
+
+    def complete(self, unit):
+        """Mark a unit done, False if the lease was lost in the meantime"""
+        return self._update_leased(unit, {'$set': {'state': 'done', 'owner': None, 'lease_expires': None,
+                                                   'error': None}})
+
+    def fail(self, unit, error):
+        """
+        Give a unit back after an error, it is retried later unless it has used up its attempts
+
+        :param error: what went wrong (kept with the unit)
+        :return: False if the lease was lost in the meantime
+        """
+        update = {'owner': None, 'lease_expires': None, 'error': str(error)}
+        if unit.attempts >= (unit.max_attempts or self.max_attempts):
+            update['state'] = 'failed'
+        else:
+            update['state'] = 'pending'
+            update['available_at'] = time() + retry_delay(unit.attempts, self.retry_base)
+        return self._update_leased(unit, {'$set': update})
+
+    def release(self, unit):
+        """Give a unit back without counting the attempt (ex the worker is shutting down)"""
+        return self._update_leased(unit, {'$set': {'state': 'pending', 'owner': None, 'lease_expires': None},
+                                          '$inc': {'attempts': -1}})
+
+    def retry_failed(self):
+        """Queue every failed unit again with a fresh set of attempts, return how many"""
+        result = self.collection.update_many({'state': 'failed'},
+                                             {'$set': {'state': 'pending', 'attempts': 0, 'available_at': time(),
+                                                       'updated': time()}})
+        return result.modified_count
+
+    def counts(self):
+        """dict of state -> number of units"""
+        found = dict.fromkeys(STATES, 0)
+        for row in self.collection.aggregate([{'$group': {'_id': '$state', 'n': {'$sum': 1}}}]):
+            found[row['_id']] = row['n']
+        return found
+
+    def failures(self, limit=20):
+        """(id, attempts, error) of failed units"""
+        cursor = self.collection.find({'state': 'failed'}, {'attempts': 1, 'error': 1}).sort('_id', 1).limit(limit)
+        return [(doc['_id'], doc['attempts'], doc.get('error')) for doc in cursor]
+
+    def close(self):
+        pass
+
+
+def open_queue(spec, lease_seconds=300.0, max_attempts=5):
+    """
+    Open the queue a spec points to
+
+    :param spec: mongodb://host[:port][/database] (the units go to its WORK_QUEUE collection, database TTB by
+                 default), anything else is taken as the path of an SQLite file
+    :param lease_seconds: how long a claim lasts without a heartbeat
+    :param max_attempts: claims each unit added through this queue gets (units keep the value they were added with)
+    :return: MongoWorkQueue or SQLiteWorkQueue
+    """
+    if spec.startswith('mongodb://') or spec.startswith('mongodb+srv://'):
+        import pymongo
+        client = pymongo.MongoClient(spec)
+        db = client.get_default_database(default='TTB')
+        return MongoWorkQueue(db.WORK_QUEUE, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return SQLiteWorkQueue(spec, lease_seconds=lease_seconds, max_attempts=max_attempts)
+
+
+def sequence_units(start_date, stop_date, skip_tol=3, days_per_unit=7):
+    """
+    Split a sequential crawl into units: every receive code (0 to skip_tol, like Sequential_Crawl.sequential) of
+    every days_per_unit receive dates
+
+    :param start_date: first receive date, '01/24/2016'
+    :param stop_date: receive date to stop before, '02/25/2017'
+    :return: list of (kind, payload, unit_id), ids are derived from the range so queueing it again adds nothing
+    """
+    date_start = datetime.datetime.strptime(start_date, '%m/%d/%Y')
+    date_stop = datetime.datetime.strptime(stop_date, '%m/%d/%Y')
+    units = []
+    curr_date = date_start
+    while curr_date < date_stop:
+        next_date = min(curr_date + datetime.timedelta(days=days_per_unit), date_stop)
+        for curr_reccode in range(skip_tol + 1):
+            payload = {'start': curr_date.strftime('%m/%d/%Y'), 'stop': next_date.strftime('%m/%d/%Y'),
+                       'reccode': curr_reccode, 'skip_tol': skip_tol}
+            unit_id = 'sequence:{start}-{stop}:{reccode:03d}'.format(start=curr_date.strftime('%y%j'),
+                                                                     stop=next_date.strftime('%y%j'),
+                                                                     reccode=curr_reccode)
+            units.append(('sequence', payload, unit_id))
+        curr_date = next_date
+    return units
+
+
+def batch_units(kind, ttbids, batch_size=100):
+    """
+    Split TTBIDs into units of batch_size
+
+    :param kind: 'forms' or 'images'
+    :param ttbids: iterable of TTBIDs
+    :return: list of (kind, payload, unit_id), ids are derived from the TTBIDs so queueing them again adds nothing
+    """
+    if kind not in ('forms', 'images'):
+        raise ValueError('No TTBID batches for {} units'.format(kind))
+    ttbids = sorted(set(str(ttbid) for ttbid in ttbids))
+    units = []
+    for i in range(0, len(ttbids), batch_size):
+        batch = ttbids[i:i + batch_size]
+        digest = hashlib.sha1(','.join(batch).encode('ascii')).hexdigest()[:12]
+        units.append((kind, {'ttbids': batch}, '{kind}:{first}:{digest}'.format(kind=kind, first=batch[0],
+                                                                               digest=digest)))
+    return units
+
+
+class _Heartbeat(object):
+
+    def __init__(self, queue, unit, interval, logger):
+        """Renews the lease of a unit from a background thread until stopped"""
+        self.queue = queue
+        self.unit = unit
+        self.interval = interval
+        self.logger = logger
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.queue.renew(self.unit):
+                    self.lost = True
+                    self.logger.warning('Lost the lease of {}'.format(self.unit.id))
+                    return
+            except Exception:
+                # a missed heartbeat is not fatal, the lease is long enough for the next one
+                self.logger.exception('Heartbeat failed for {}'.format(self.unit.id))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+class QueueWorker(object):
+
+    def __init__(self, queue, handlers, worker_id=None, heartbeat=None, poll_interval=10.0, logger=None):
+        """
+        Claims units from a queue and runs the handler of their kind, renewing the lease while it works
+
+        A handler gets the payload of the unit and must only return once the unit's records are written (so a
+        completed unit is never lost). A unit can run twice (its lease ran out while the first worker was still
+        busy): MongoDB writes are upserts, so it stores the same records again, while a Parquet sink appends a second
+        copy that Columnar_Sink.read_collection leaves out.
+
+        :param queue: SQLiteWorkQueue or MongoWorkQueue
+        :param handlers: dict of kind -> function(payload), only units of these kinds are claimed
+        :param worker_id: id of this worker, see default_worker_id
+        :param heartbeat: seconds between lease renewals, defaults to a third of the lease
+        :param poll_interval: seconds to wait before asking again when nothing is ready
+        :param logger: logger, defaults to this module's logger
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat = heartbeat if heartbeat is not None else queue.lease_seconds / 3.0
+        self.poll_interval = poll_interval
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0  # finished after the lease ran out, the unit was left to whoever holds it now
+
+    def process(self, unit):
+        """Run one claimed unit and report the outcome to the queue, return whether it succeeded"""
+        try:
+            with _Heartbeat(self.queue, unit, self.heartbeat, self.logger) as heartbeat:
+                self.handlers[unit.kind](unit.payload)
+        except (KeyboardInterrupt, SystemExit):
+            self.queue.release(unit)
+            raise
+        except Exception as e:
+            self.logger.exception('Unit {id} failed (attempt {attempts})'.format(id=unit.id, attempts=unit.attempts))
+            self.failed += 1
+            self.queue.fail(unit, '{}: {}'.format(type(e).__name__, e))
+            return False
+
+        if heartbeat.lost or not self.queue.complete(unit):
+            self.logger.warning('Finished {} after losing its lease, another worker has it'.format(unit.id))
+            self.lost += 1
+        else:
+            self.logger.info('Completed {}'.format(unit.id))
+            self.completed += 1
+        return True
+
+    def run(self, exit_when_empty=True, max_units=None):
+        """
+        Work until the queue runs dry (or forever, polling every poll_interval)
+
+        :param exit_when_empty: return once no unit is ready instead of waiting for more
+        :param max_units: return after this many units
+        :return: number of units processed
+        """
+        processed = 0
+        while max_units is None or processed < max_units:
+            unit = self.queue.claim(self.worker_id, kinds=list(self.handlers))
+            if unit is None:
+                if exit_when_empty:
+                    break
+                sleep(self.poll_interval)
+                continue
+            self.logger.info('Now on:  {id} (attempt {attempts})'.format(id=unit.id, attempts=unit.attempts))
+            self.process(unit)
+            processed += 1
+        return processed
+
+
+def main():
+    """ Main entry point of the app """
+
+    # print the state of a queue, ex python Work_Queue.py work_queue.sqlite
+    queue = open_queue(sys.argv[1] if len(sys.argv) > 1 else 'work_queue.sqlite')
+    for state, n in queue.counts().items():
+        print('{state}: {n}'.format(state=state, n=n))
+    for unit_id, attempts, error in queue.failures():
+        print('  {id} ({attempts} attempts): {error}'.format(id=unit_id, attempts=attempts, error=error))
+    queue.close()
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
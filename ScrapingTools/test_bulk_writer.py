@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Tests for the buffered MongoDB writer, run with pytest from ScrapingTools
+"""
+
+
+import mongomock
+import pymongo
+import pytest
+
+from Bulk_Writer import BulkWriter, WriteError
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().TTB
+
+
+def fail_writes(monkeypatch, error, times=1):
+    """Make the next times bulk writes raise error"""
+    bulk_write = mongomock.collection.Collection.bulk_write
+    remaining = [times]
+
+    def failing(collection, requests, *args, **kwargs):
+        if remaining[0]:
+            remaining[0] -= 1
+            raise error
+        return bulk_write(collection, requests, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', failing)
+
+
+def test_upserts_replace_duplicates(db):
+    writer = BulkWriter(db, batch_size=2, flush_interval=60)
+    writer.ensure_indexes()
+    writer.add('COLORS', {'TTBID': '1', 'img_num': 0, 'color_num': 0, 'r': 1})
+    writer.add('COLORS', {'TTBID': '1', 'img_num': 0, 'color_num': 0, 'r': 2})  # replaces the buffered copy
+    writer.add('COLORS', {'TTBID': '1', 'img_num': 0, 'color_num': 1, 'r': 3})  # fills the batch
+    writer.add('COLORS', {'TTBID': '1', 'img_num': 0, 'color_num': 0, 'r': 4})  # replaces the stored copy
+    writer.close()
+
+    docs = sorted(db.COLORS.find({}, {'_id': 0}), key=lambda doc: doc['color_num'])
+    assert [(doc['color_num'], doc['r']) for doc in docs] == [(0, 4), (1, 3)]
+
+
+def colors(writer, ttbid, img_num, n, value):
+    for color_num in range(n):
+        writer.add('COLORS', {'TTBID': ttbid, 'img_num': img_num, 'color_num': color_num, 'r': value})
+
+
+def stored_colors(db):
+    return sorted((doc['TTBID'], doc['img_num'], doc['color_num'], doc['r']) for doc in db.COLORS.find())
+
+
+def test_colors_replaced_per_image(db):
+    with BulkWriter(db, batch_size=10, flush_interval=60) as writer:
+        colors(writer, '1', '0', 5, 1)
+        colors(writer, '1', '1', 5, 1)
+
+    with BulkWriter(db, batch_size=2, flush_interval=60) as writer:
+        colors(writer, '1', '0', 3, 2)  # measured again with fewer colors, written over two batches
+
+    assert stored_colors(db) == [('1', '0', n, 2) for n in range(3)] + [('1', '1', n, 1) for n in range(5)]
+
+
+def test_colors_group_added_again_is_replaced(db):
+    with BulkWriter(db, batch_size=1, flush_interval=60) as writer:
+        colors(writer, '1', '0', 3, 1)
+        colors(writer, '1', '1', 1, 1)
+        colors(writer, '1', '0', 2, 2)
+
+    assert stored_colors(db) == [('1', '0', 0, 2), ('1', '0', 1, 2), ('1', '1', 0, 1)]
+
+
+def test_callbacks_wait_for_the_write(db):
+    done = []
+    writer = BulkWriter(db, batch_size=10, flush_interval=60)
+    writer.add('TTB', {'_id': '1'})
+    writer.on_flush(lambda: done.append(1))
+    writer.flush('TTB')
+    assert done == []  # only a full flush runs callbacks
+
+    writer.flush()
+    assert done == [1]
+
+
+def test_connection_error_keeps_buffer(db, monkeypatch):
+    done = []
+    writer = BulkWriter(db, batch_size=10, flush_interval=60)
+    writer.add('TTB', {'_id': '1'})
+    writer.on_flush(lambda: done.append(1))
+
+    fail_writes(monkeypatch, pymongo.errors.AutoReconnect('connection reset'))
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        writer.flush()
+    assert done == []
+    assert db.TTB.count_documents({}) == 0
+
+    writer.flush()
+    assert done == [1]
+    assert db.TTB.count_documents({}) == 1
+
+
+def test_connection_error_in_add_is_deferred(db, monkeypatch):
+    writer = BulkWriter(db, batch_size=1, flush_interval=60)
+    fail_writes(monkeypatch, pymongo.errors.NetworkTimeout('timed out'))
+    writer.add('TTB', {'_id': '1'})  # the write fails, but the document stays buffered
+    assert db.TTB.count_documents({}) == 0
+
+    writer.close()
+    assert db.TTB.count_documents({}) == 1
+
+
+def test_rejected_documents_skip_callbacks(db, monkeypatch):
+    done = []
+    writer = BulkWriter(db, batch_size=10, flush_interval=60)
+    writer.add('TTB', {'_id': '1'})
+    writer.on_flush(lambda: done.append(1))
+
+    fail_writes(monkeypatch, pymongo.errors.BulkWriteError({'writeErrors': [{'index': 0, 'errmsg': 'rejected'}]}))
+    with pytest.raises(WriteError):
+        writer.flush()
+    assert done == []
+
+    # the rejected batch is not retried, and later callbacks are unaffected
+    writer.add('TTB', {'_id': '2'})
+    writer.on_flush(lambda: done.append(2))
+    writer.flush()
+    assert done == [2]
+    assert [doc['_id'] for doc in db.TTB.find()] == ['2']
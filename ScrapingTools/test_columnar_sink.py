@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Tests for the Parquet sink, run with pytest from ScrapingTools
+"""
+
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from Columnar_Sink import ColumnarSink, read_collection, stored_values
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+def test_callback_waits_for_buffered_collections(tmp_path):
+    done = []
+    sink = ColumnarSink(str(tmp_path), flush_interval=3600)
+    sink.add('TTB', {'_id': '16004001000001'})
+    sink.add('IMG_SUP', {'TTBID': '16004001000001', 'img_num': 0, 'EntropySum': 1.0})
+    sink.on_flush(lambda: done.append(1))
+
+    sink.add('TTB', {'_id': '16004001000002'})  # added later, not waited on
+    sink.flush('TTB')
+    assert done == []
+
+    sink.flush('IMG_SUP')
+    assert done == [1]
+    assert stored_values(str(tmp_path), 'TTB', '_id', ['16004001000001', '16004001000002']) == {
+        '16004001000001', '16004001000002'}
+
+
+def test_callback_without_buffered_records_runs_now(tmp_path):
+    done = []
+    sink = ColumnarSink(str(tmp_path))
+    sink.on_flush(lambda: done.append(1))
+    assert done == [1]
+
+
+def test_interval_flush(tmp_path):
+    done = []
+    sink = ColumnarSink(str(tmp_path), flush_interval=0)
+    sink.add('TTB', {'_id': '16004001000001'})  # the interval has passed, so this is written right away
+    sink.on_flush(lambda: done.append(1))
+    assert done == [1]
+    assert stored_values(str(tmp_path), 'TTB', '_id', ['16004001000001']) == {'16004001000001'}
+
+
+def test_fields_added_later_are_read(tmp_path):
+    with ColumnarSink(str(tmp_path)) as sink:
+        sink.add('TTB', {'_id': '16004001000001', 'Status': 'APPROVED'})
+        sink.flush()
+        sink.add('TTB', {'_id': '16005001000001', 'Formula': 'F-1'})  # a later day, and a field the first lacked
+
+    assert stored_values(str(tmp_path), 'TTB', 'Formula', ['F-1']) == {'F-1'}
+    records = read_collection(str(tmp_path), 'TTB').fillna('').sort_values('_id').to_dict('records')
+    assert [(record['Status'], record['Formula'], record['date']) for record in records] == [
+        ('APPROVED', '', '2016-01-04'), ('', 'F-1', '2016-01-05')]
+
+
+def test_failed_write_keeps_records(tmp_path, monkeypatch):
+    done = []
+    sink = ColumnarSink(str(tmp_path))
+    sink.add('TTB', {'_id': '16004001000001'})
+    sink.add('TTB', {'_id': '16005001000001'})
+    sink.on_flush(lambda: done.append(1))
+
+    write_table = sink._pq.write_table
+    calls = []
+
+    def failing(table, where, **kwargs):
+        calls.append(where)
+        if len(calls) == 2:  # the second partition of the flush
+            raise OSError('disk full')
+        return write_table(table, where, **kwargs)
+
+    monkeypatch.setattr(sink._pq, 'write_table', failing)
+    with pytest.raises(OSError):
+        sink.flush()
+    assert done == []
+    assert stored_values(str(tmp_path), 'TTB', '_id', ['16004001000001', '16005001000001']) == set()
+
+    sink.flush()
+    assert done == [1]
+    assert len(read_collection(str(tmp_path), 'TTB')) == 2
+
+
+def test_read_collection_keeps_latest_copy(tmp_path):
+    for brand, n_colors in (('FIRST', 3), ('SECOND', 2)):  # a re-run, with fewer dominant colors
+        with ColumnarSink(str(tmp_path)) as sink:
+            sink.add('TTB', {'_id': '16004001000001', 'BrandName': brand})
+            sink.add('TTB', {'_id': '16004001000002', 'BrandName': brand})
+            for color_num in range(n_colors):
+                sink.add('COLORS', {'TTBID': '16004001000001', 'img_num': '0', 'color_num': color_num, 'r': 1.0})
+            if brand == 'FIRST':
+                sink.add('COLORS', {'TTBID': '16004001000002', 'img_num': '0', 'color_num': 0, 'r': 1.0})
+
+    forms = read_collection(str(tmp_path), 'TTB', columns=['BrandName'])
+    assert list(forms.columns) == ['BrandName'] and list(forms['BrandName']) == ['SECOND', 'SECOND']
+
+    colors = read_collection(str(tmp_path), 'COLORS')
+    assert sorted(zip(colors['TTBID'], colors['color_num'])) == [
+        ('16004001000001', 0), ('16004001000001', 1), ('16004001000002', 0)]
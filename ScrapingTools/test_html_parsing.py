@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for the parser backends, run with pytest from ScrapingTools
+"""
+
+
+import os
+
+import pytest
+
+import Html_Parsing
+import Session_Manager
+from Benchmarks import generate_fixtures
+from Html_Parsing import BACKENDS, PAGE_DIRS, ParserBackend, extract_records, parity_report, parse_page
+from Stand_In_Server import StandInServer
+from TTB_crawler import TTB_query
+from TTB_scraping import TTB_Scraper
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+# pages laid out like the live site's, with the doctype, scripts, entities and page chrome generated fixtures lack
+TEST_PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_pages')
+
+@pytest.fixture(scope='module')
+def fixtures(tmp_path_factory):
+    """A small generated fixture directory (forms/ and images/ pages)"""
+    directory = str(tmp_path_factory.mktemp('fixtures'))
+    generate_fixtures(directory, days=2, per_day=5, labels=3)
+    return directory
+
+
+def test_fixture_pages_extract(fixtures):
+    for page_type in ('form', 'images'):
+        page_dir = os.path.join(fixtures, PAGE_DIRS[page_type])
+        names = sorted(os.listdir(page_dir))
+        assert names
+
+        with open(os.path.join(page_dir, names[0]), encoding='utf-8') as f:
+            markup = f.read()
+        for backend in BACKENDS:
+            assert extract_records(markup, page_type, backend)
+
+
+def test_parity_report_agrees(fixtures):
+    assert parity_report(fixtures) == []
+
+
+class BlankBackend(ParserBackend):
+    """A backend that never finds anything"""
+
+    def parse(self, markup, page_type=None):
+        return super(BlankBackend, self).parse('', page_type)
+
+
+def test_parity_report_finds_mismatch(fixtures, monkeypatch):
+    monkeypatch.setitem(BACKENDS, 'blank', BlankBackend('html.parser'))
+    mismatches = parity_report(fixtures, backends=['lxml', 'blank'])
+
+    forms = sorted(os.listdir(os.path.join(fixtures, PAGE_DIRS['form'])))
+    assert [name for page_type, name, _ in mismatches if page_type == 'form'] == forms
+    assert all(records['blank'] is None for page_type, _, records in mismatches if page_type == 'form')
+
+
+def test_saved_pages_agree():
+    assert parity_report(TEST_PAGES) == []
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_saved_form_pages(backend, monkeypatch):
+    monkeypatch.setattr(Html_Parsing, '_default_backend', backend)
+    with StandInServer(TEST_PAGES) as server:
+        monkeypatch.setattr(Session_Manager, '_base_url', server.url)
+        domestic = TTB_Scraper('16004001000171').get_basic_form_data()
+        imported = TTB_Scraper('16057001000402').get_basic_form_data()
+        missing = TTB_Scraper('16365999000001').get_basic_form_data()
+
+    assert (domestic['TTBID'], domestic['Status'], domestic['BrandName'], domestic['FancifulName']) == (
+        '16004001000171', 'APPROVED', 'SIERRA NEVADA', 'PALE ALE')
+    assert domestic['OriginCode'] == '05CALIFORNIA'
+    assert domestic['ContactInformation'] == '1075 EAST 20TH STREET\nCHICO, CA 95928\nPhone Number: (530) 893-3520\n'
+
+    assert (imported['BrandName'], imported['FancifulName'], imported['ApprovalDate']) == (
+        'CH\xc2TEAU LA CROIX', '', '02/29/2016')
+    assert imported['Qualifications'] == ('TTB has not reviewed this label for the presence of allergens.\n'
+                                          'FOR EXPORT ONLY: the "Cr\xe8me" statement is not approved for sale in the '
+                                          'U.S.\n')
+    assert missing is None
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_saved_search_pages(backend):
+    def saved(name):
+        with open(os.path.join(TEST_PAGES, PAGE_DIRS['search'], name), encoding='utf-8') as f:
+            return TTB_query.from_soup(parse_page(f.read(), 'search', backend))
+
+    middle = saved('00_09012016_09242017_page1.html')
+    rows = middle.get_table_data()
+    assert (middle.get_num_results(), middle.page_position(middle.soup), len(rows)) == (2010, (21, 40, 500), 20)
+    assert sorted(row['TTB ID'] for row in rows) == sorted(middle.get_ids())
+    assert not middle.is_last_page()
+
+    single = saved('FR_02292016_02292016_page0.html')
+    assert single.is_last_page()
+    assert single.get_table_data()[2] == {
+        'TTB ID': '16056001000288', 'Permit No.': 'CA-I-20114', 'Serial Number': '16-0042',
+        'Completed Date': '02/29/2016', 'Fanciful Name': 'BRUT RES\xc9RVE', 'Brand Name': 'MAISON P\xc8RE & FILS',
+        'Origin': 'FR', 'Origin Desc': 'FRANCE', 'Class/Type': '89', 'Class/Type Desc': 'SPARKLING WINE/CHAMPAGNE'}
+
+    empty = saved('4E_01012016_01012016_page0.html')
+    assert (empty.get_table_data(), empty.get_ids()) == ([], [])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Tests for the staged image pipeline, run with pytest from ScrapingTools
+"""
+
+
+import threading
+
+from PIL import Image
+
+import Image_Pipeline
+from Image_Pipeline import ImagePipeline
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+class OneLabelScraper(object):
+    """Stands in for TTB_Scraper, every TTBID has one small label"""
+
+    def __init__(self, ttb_id):
+        self.ttb_id = ttb_id
+
+    def get_images(self, draft_size):
+        return [('Label Image: Brand (front)', 'label.jpg')], [Image.new('RGB', (8, 8), (200, 20, 20))]
+
+
+class BrokenCache(object):
+    """A metric cache that fails to hash anything"""
+
+    def key(self, img):
+        raise OSError('unreadable image')
+
+    def summary(self):
+        return 'metric cache: broken'
+
+
+def test_failed_hash_skips_the_ttbid(monkeypatch):
+    monkeypatch.setattr(Image_Pipeline, 'TTB_Scraper', OneLabelScraper)
+    pipeline = ImagePipeline(fetch_workers=2, metric_workers=0, cache=BrokenCache())
+    results, skipped = [], []
+
+    run = threading.Thread(target=pipeline.run, args=(['1', '2', '3'], lambda *args: results.append(args)),
+                           kwargs={'handle_skip': skipped.append}, daemon=True)
+    run.start()
+    run.join(timeout=30)
+
+    assert not run.is_alive()  # every fetcher reported it was done
+    assert (results, sorted(skipped)) == ([], ['1', '2', '3'])
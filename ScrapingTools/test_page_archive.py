@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Tests for the raw page archive, run with pytest from ScrapingTools
+"""
+
+
+import os
+
+import pytest
+
+from Benchmarks import CountingWriter, generate_fixtures
+from Page_Archive import ArchiveError, PageArchive, fcntl, reparse_archive
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+def test_put_get_and_recover(tmp_path):
+    with PageArchive(str(tmp_path), segment_bytes=64) as archive:
+        archive.put('form', '1', '<html>one</html>')
+        archive.put('form', '2', '<html>two</html>')
+        archive.put('form', '1', '<html>one again</html>')
+
+    with PageArchive(str(tmp_path)) as archive:
+        assert archive.get('form', '1') == '<html>one again</html>'
+        assert archive.get('form', '2') == '<html>two</html>'
+        assert archive.get('images', '1') is None
+        assert archive.count('form') == 2
+
+
+@pytest.mark.skipif(fcntl is None, reason='archives are only locked on POSIX')
+def test_open_twice_is_refused(tmp_path):
+    with PageArchive(str(tmp_path)):
+        with pytest.raises(ArchiveError):
+            PageArchive(str(tmp_path))
+
+    PageArchive(str(tmp_path)).close()  # released on close
+
+
+def test_reparse_archive(tmp_path):
+    fixtures = str(tmp_path / 'fixtures')
+    n_colas = generate_fixtures(fixtures, days=2, per_day=5, labels=3)
+
+    with PageArchive(str(tmp_path / 'archive')) as archive:
+        for name in os.listdir(os.path.join(fixtures, 'forms')):
+            with open(os.path.join(fixtures, 'forms', name), encoding='utf-8') as f:
+                archive.put('form', name[:-len('.html')], f.read())
+
+        writer = CountingWriter()
+        written = reparse_archive(archive, writer, workers=1, chunk_size=2)
+
+    assert written == {'form': n_colas}
+    assert writer.counts == {'TTB': n_colas}
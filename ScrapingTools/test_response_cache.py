@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Tests for the on-disk response cache, run with pytest from ScrapingTools
+"""
+
+
+import json
+
+import pytest
+
+import Session_Manager
+import TTB_crawler
+from Response_Cache import CacheMiss, ResponseCache
+from Session_Manager import SessionManager
+from Stand_In_Server import StandInServer
+from TTB_crawler import US_ORIGIN_CODES, all_origin_codes
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """Stand-in with a single French import"""
+    fixtures = tmp_path / 'fixtures'
+    fixtures.mkdir()
+    with open(str(fixtures / 'index.json'), 'w') as f:
+        json.dump([{'TTB ID': '16001001000001', 'Completed Date': '01/05/2016', 'Origin': 'FR'}], f)
+
+    monkeypatch.setattr(TTB_crawler, '_all_origin_codes', None)
+    with StandInServer(str(fixtures)) as server:
+        monkeypatch.setattr(Session_Manager, '_base_url', server.url)
+        yield server
+
+
+def test_offline_miss_raises(tmp_path, stand_in):
+    session = SessionManager(cache=ResponseCache(str(tmp_path / 'cache'), offline=True)).session()
+    with pytest.raises(CacheMiss):
+        session.get(stand_in.url + '/colasonline/publicSearchColasAdvanced.do', cache_key=('search_form',))
+    assert not stand_in.requests
+
+
+def test_origin_codes_replay_offline(tmp_path, stand_in, monkeypatch):
+    directory = str(tmp_path / 'cache')
+    assert all_origin_codes(SessionManager(cache=ResponseCache(directory))) == US_ORIGIN_CODES + ['FR']
+
+    monkeypatch.setattr(TTB_crawler, '_all_origin_codes', None)
+    stand_in.requests.clear()
+    assert all_origin_codes(SessionManager(cache=ResponseCache(directory, offline=True))) == US_ORIGIN_CODES + ['FR']
+    assert not stand_in.requests
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests for the form scrapers against the stand-in server, run with pytest from ScrapingTools
+"""
+
+
+import datetime
+import logging
+
+import pytest
+
+import Session_Manager
+import TTB_crawler
+from Benchmarks import CountingWriter, generate_fixtures, load_index
+from Crawl_Frontier import CrawlFrontier
+from Sequential_Crawl import _scrape_forms, incremental, probe_sequence
+from Session_Manager import AdaptiveRateLimiter, SessionManager
+from Stand_In_Server import StandInServer
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+DAY = datetime.datetime(2016, 1, 4)
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """Stand-in for one day of COLAs, answering every request with a 503 until its error_rate is lowered"""
+    directory = str(tmp_path / 'fixtures')
+    generate_fixtures(directory, days=1, per_day=6, labels=2, gap_rate=0.0)
+
+    limiter = AdaptiveRateLimiter(rate=1000.0, min_rate=1000.0, max_rate=1000.0)
+    monkeypatch.setattr(Session_Manager, '_default_manager', SessionManager(limiter=limiter, max_retries=0))
+    with StandInServer(directory, error_rate=1.0) as server:
+        monkeypatch.setattr(Session_Manager, '_base_url', server.url)
+        server.efiled = sorted(row['TTB ID'] for row in load_index(directory) if row['TTB ID'][5:8] == '001')
+        assert server.efiled
+        yield server
+
+
+def test_failed_probe_is_retried(stand_in, tmp_path):
+    frontier = CrawlFrontier(str(tmp_path / 'frontier.sqlite'))
+    writer = CountingWriter()
+
+    assert not probe_sequence(DAY, 1, 2, writer, logger, frontier)  # abandoned at the first TTBID
+    assert not frontier.is_known_empty(stand_in.efiled[0])
+    assert frontier.sequence_state(stand_in.efiled[0]) == (0, 0, False)
+    assert writer.counts == {}
+
+    stand_in.error_rate = 0.0
+    assert probe_sequence(DAY, 1, 2, writer, logger, frontier)
+    assert writer.counts == {'TTB': len(stand_in.efiled)}
+    assert not any(frontier.is_known_empty(ttbid) for ttbid in stand_in.efiled)
+    frontier.close()
+
+
+def test_failed_forms_are_returned(stand_in):
+    writer = CountingWriter()
+    assert _scrape_forms(stand_in.efiled, 2, writer, logger) == stand_in.efiled
+    assert writer.counts == {}
+
+    stand_in.error_rate = 0.0
+    assert _scrape_forms(stand_in.efiled, 2, writer, logger) == []
+    assert writer.counts == {'TTB': len(stand_in.efiled)}
+
+
+def test_missing_form_holds_watermark_for_max_form_attempts(stand_in, tmp_path, monkeypatch):
+    stand_in.error_rate = 0.0
+    broken = stand_in.efiled[0]
+    del stand_in.forms[broken]  # the site answers with its page for a TTBID without a form
+    approved = next(row['Completed Date'] for row in load_index(str(tmp_path / 'fixtures')) if row['TTB ID'] == broken)
+    held = (datetime.datetime.strptime(approved, '%m/%d/%Y') - datetime.timedelta(days=1)).strftime('%m/%d/%Y')
+
+    monkeypatch.setattr(TTB_crawler, '_all_origin_codes', None)
+    frontier = CrawlFrontier(str(tmp_path / 'frontier.sqlite'))
+    kwargs = dict(stop='01/31/2016', workers=2, images=False, parquet_dir=str(tmp_path / 'parquet'), mongo=False,
+                  max_form_attempts=2)
+
+    res = incremental(frontier, since='01/04/2016', **kwargs)
+    assert (res['forms_missing'], res['forms_given_up'], res['watermark']) == (1, [], held)
+
+    res = incremental(frontier, **kwargs)  # searched again from the held watermark, and given up on this time
+    assert (res['forms_missing'], res['forms_given_up'], res['watermark']) == (1, [broken], '01/31/2016')
+    frontier.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Tests for the pooled, rate limited sessions, run with pytest from ScrapingTools
+"""
+
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from Session_Manager import AdaptiveRateLimiter, SessionManager
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def busy_server():
+    """Server answering every request with a 503, yields (url, list of the methods it received)"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def _busy(self):
+            received.append(self.command)
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        do_GET = do_POST = _busy
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1]), received
+    server.shutdown()
+    server.server_close()
+
+
+def make_session():
+    limiter = AdaptiveRateLimiter(rate=1000.0, min_rate=1000.0, max_rate=1000.0)
+    return SessionManager(limiter=limiter, max_retries=2).session()
+
+
+def test_get_is_retried(busy_server):
+    url, received = busy_server
+    assert make_session().get(url).status_code == 503
+    assert received == ['GET'] * 3
+
+
+def test_post_is_not_retried(busy_server):
+    url, received = busy_server
+    assert make_session().post(url, data={'a': '1'}).status_code == 503
+    assert received == ['POST']
+
+
+def test_idempotent_post_is_retried(busy_server):
+    url, received = busy_server
+    assert make_session().post(url, data={'a': '1'}, idempotent=True).status_code == 503
+    assert received == ['POST'] * 3
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests for the advanced search crawler against the stand-in server, run with pytest from ScrapingTools
+"""
+
+
+import json
+
+import pytest
+import requests
+
+import Session_Manager
+import TTB_crawler
+from Session_Manager import AdaptiveRateLimiter, SessionManager
+from Stand_In_Server import StandInServer
+from TTB_crawler import US_ORIGIN_CODES, all_origin_codes
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+def search_row(ttbid, completed, origin):
+    return {'TTB ID': ttbid, 'Permit No.': 'BR-00-1', 'Serial Number': '1', 'Completed Date': completed,
+            'Fanciful Name': '', 'Brand Name': 'BRAND', 'Origin': origin, 'Origin Desc': 'ORIGIN ' + origin,
+            'Class/Type': '901', 'Class/Type Desc': 'BEER'}
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """Stand-in with 510 approvals of origin 00 on 01/10/2016, and one import each on 01/05 and 01/20"""
+    rows = [search_row('16005001{:06d}'.format(i), '01/10/2016', '00') for i in range(510)]
+    rows += [search_row('16001001000001', '01/05/2016', 'FR'), search_row('16015001000001', '01/20/2016', 'FR')]
+    with open(str(tmp_path / 'index.json'), 'w') as f:
+        json.dump(rows, f)
+
+    monkeypatch.setattr(TTB_crawler, '_all_origin_codes', None)
+    with StandInServer(str(tmp_path)) as server:
+        monkeypatch.setattr(Session_Manager, '_base_url', server.url)
+        yield server
+
+
+def test_all_origin_codes(stand_in):
+    assert all_origin_codes() == US_ORIGIN_CODES + ['FR']
+
+
+def test_crawl_reports_undecomposable_queries(stand_in):
+    incomplete = []
+    ttbids = TTB_crawler.TTB_crawler.crawl('01/01/2016', '01/31/2016', all_origin_codes(), workers=4, ids_only=True,
+                                           incomplete=incomplete)
+
+    assert incomplete == [('01/10/2016', '01/10/2016', ['00'])]
+    assert len(set(ttbids)) == 502  # the first 500 of the day that was cut off, and both imports
+    assert {'16001001000001', '16015001000001'} <= set(ttbids)
+
+
+def test_failed_query_is_incomplete(stand_in, monkeypatch):
+    origin_codes = all_origin_codes()
+    limiter = AdaptiveRateLimiter(rate=1000.0, min_rate=1000.0, max_rate=1000.0)
+    monkeypatch.setattr(Session_Manager, '_default_manager', SessionManager(limiter=limiter, max_retries=0))
+    stand_in.error_rate = 1.0
+
+    with pytest.raises(requests.HTTPError):
+        TTB_crawler.TTB_crawler.crawl('01/01/2016', '01/31/2016', origin_codes, ids_only=True)
+
+    incomplete = []
+    assert TTB_crawler.TTB_crawler.crawl('01/01/2016', '01/31/2016', origin_codes, ids_only=True,
+                                         incomplete=incomplete) == []
+    assert incomplete == [('01/01/2016', '01/31/2016', origin_codes)]
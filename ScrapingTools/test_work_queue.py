@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Tests for the shared work queue on both backends, run with pytest from ScrapingTools
+"""
+
+
+import sqlite3
+from time import sleep
+
+import mongomock
+import pytest
+
+from Work_Queue import MongoWorkQueue, QueueWorker, SQLiteWorkQueue
+
+__author__ = "Jonathan Hirokawa"
+__version__ = "0.1.0"
+__license__ = "MIT"
+
+
+LEASE = 0.2  # seconds, short enough to let leases run out in a test
+
+
+@pytest.fixture(params=['sqlite', 'mongo'])
+def make_queue(request, tmp_path):
+    """Function opening a queue on the backend under test, every call sees the same units"""
+    collection = mongomock.MongoClient().TTB.WORK_QUEUE
+    queues = []
+
+    def make(**kwargs):
+        kwargs.setdefault('lease_seconds', LEASE)
+        kwargs.setdefault('retry_base', 0.0)
+        if request.param == 'sqlite':
+            queue = SQLiteWorkQueue(str(tmp_path / 'queue.sqlite'), **kwargs)
+        else:
+            queue = MongoWorkQueue(collection, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+
+def test_claim(make_queue):
+    queue = make_queue()
+    assert queue.add('forms', {'ttbids': ['1']}, 'a')
+    assert not queue.add('forms', {'ttbids': ['2']}, 'a')  # already queued
+    assert queue.add_many([('images', {'ttbids': ['1']}, 'b'), ('sequence', {'reccode': 0}, 'c')]) == 2
+
+    unit = queue.claim('w1', kinds=['images'])
+    assert (unit.id, unit.kind, unit.payload, unit.attempts, unit.owner) == ('b', 'images', {'ttbids': ['1']}, 1, 'w1')
+
+    other = queue.claim('w2')
+    assert other.id in ('a', 'c')
+    assert queue.claim('w3').id in ('a', 'c')
+    assert queue.claim('w4') is None  # every unit is leased
+
+    assert queue.complete(unit)
+    assert queue.counts() == {'pending': 0, 'leased': 2, 'done': 1, 'failed': 0}
+
+
+def test_lease_expiry(make_queue):
+    queue = make_queue()
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+    first = queue.claim('w1')
+    assert queue.claim('w2') is None
+
+    sleep(LEASE * 1.5)
+    second = queue.claim('w2')  # w1 stopped renewing, so the unit goes to the next worker
+    assert (second.id, second.attempts) == ('a', 2)
+
+    assert not queue.renew(first)
+    assert not queue.complete(first)
+    assert queue.complete(second)
+    assert queue.counts()['done'] == 1
+
+
+def test_lease_expiry_on_last_attempt_fails(make_queue):
+    queue = make_queue(max_attempts=1)
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+    queue.claim('w1')
+
+    sleep(LEASE * 1.5)
+    assert queue.claim('w2') is None
+    assert queue.failures() == [('a', 1, 'lease expired')]
+
+
+def test_renew(make_queue):
+    queue = make_queue()
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+    unit = queue.claim('w1')
+    expires = unit.lease_expires
+
+    for _ in range(3):
+        sleep(LEASE / 2)
+        assert queue.renew(unit)
+    assert unit.lease_expires > expires
+    assert queue.claim('w2') is None  # still held, past the first lease
+    assert queue.complete(unit)
+
+
+def test_worker_counts_lost_leases(make_queue):
+    queue = make_queue()
+    queue.add_many([('forms', {'ttbids': ['1']}, 'a'), ('forms', {'ttbids': ['2']}, 'b')])
+    taken = []
+
+    def slow(payload):
+        if payload['ttbids'] == ['1']:
+            sleep(LEASE * 1.5)  # no heartbeat in time, so another worker takes the unit over
+            taken.append(queue.claim('w2'))
+
+    worker = QueueWorker(queue, {'forms': slow}, worker_id='w1', heartbeat=60.0)
+    assert worker.run() == 2
+    assert (worker.completed, worker.failed, worker.lost) == (1, 0, 1)
+    assert taken[0].id == 'a'
+    assert queue.counts() == {'pending': 0, 'leased': 1, 'done': 1, 'failed': 0}
+
+
+def test_fail_retries_then_gives_up(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+
+    unit = queue.claim('w1')
+    assert queue.fail(unit, 'first')
+    assert queue.counts()['pending'] == 1
+
+    unit = queue.claim('w1')
+    assert unit.attempts == 2
+    assert queue.fail(unit, 'second')
+    assert queue.claim('w1') is None
+    assert queue.failures() == [('a', 2, 'second')]
+
+    assert queue.retry_failed() == 1
+    assert queue.claim('w1').attempts == 1
+
+
+def test_fail_waits_for_retry_delay(make_queue):
+    queue = make_queue(retry_base=60.0)
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+    queue.fail(queue.claim('w1'), 'error')
+    assert queue.claim('w1') is None
+
+
+def test_release_does_not_count(make_queue):
+    queue = make_queue()
+    queue.add('forms', {'ttbids': ['1']}, 'a')
+    assert queue.release(queue.claim('w1'))
+    assert queue.claim('w2').attempts == 1
+
+
+def test_max_attempts_kept_per_unit(make_queue):
+    make_queue(max_attempts=1).add('forms', {'ttbids': ['1']}, 'a', max_attempts=3)
+
+    queue = make_queue(max_attempts=1)  # the workers' default does not apply to units queued with their own
+    for attempt in (1, 2):
+        unit = queue.claim('w1')
+        assert (unit.attempts, unit.max_attempts) == (attempt, 3)
+        queue.fail(unit, 'error')
+    assert queue.counts()['pending'] == 1
+
+    queue.fail(queue.claim('w1'), 'error')
+    assert queue.counts()['failed'] == 1
+
+
+def test_sqlite_queue_without_max_attempts_column(tmp_path):
+    path = str(tmp_path / 'old.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE units (id TEXT PRIMARY KEY, kind TEXT, payload TEXT, state TEXT, attempts INTEGER, '
+                 'owner TEXT, lease_expires REAL, available_at REAL, error TEXT, updated REAL)')
+    conn.execute("INSERT INTO units VALUES ('a', 'forms', '{}', 'pending', 0, NULL, NULL, 0, NULL, 0)")
+    conn.commit()
+    conn.close()
+
+    queue = SQLiteWorkQueue(path, max_attempts=1, retry_base=0.0)
+    unit = queue.claim('w1')
+    assert (unit.id, unit.max_attempts) == ('a', 1)
+    queue.fail(unit, 'error')
+    assert queue.counts()['failed'] == 1
+    queue.close()